@@ -1,53 +1,25 @@
-from utils.index import call_func, hello
-import click
-import os
-from utils.crud_files import load_files, show_files, clear_context, remove_file
-from utils.rag import query, export_chat
-
-
-@click.group()
-@click.pass_context
-def cli(ctx: click.Context) -> None :
-  """
-  ####   #   #    #    ####   #   #   ####
-     #       #   #        #   ## ##   #   #
-  ####   #   #  #      ####   # # #   #####
- #   #   #   ###      #   #   #   #   #
- #   #   #   #  #     #   #   #   #   #   #
-  ####   #   #   #     ####   #   #   ####
-
-  Aikame is a robust RAG application brought to you as a cli tool.
-  """
-  pass
-  # click.secho("Welcome to Aikame!", fg='green')
-
-
-@cli.command()
-@click.pass_context
-def set_value(ctx):
-  """Set a value in the context."""
-  os.environ['value'] = "Hello, World!"  # Store a value in the context
-  click.echo("Value set!")
-
-
-@cli.command()
-@click.pass_context
-def get_value(ctx):
-  """Get the value from the context."""
-  value = os.getenv('value', 'No value set.')
-  click.echo(f'Value: {value}')
-
-
-cli.add_command(hello)
-cli.add_command(load_files)
-cli.add_command(show_files)
-cli.add_command(clear_context)
-cli.add_command(remove_file)
-cli.add_command(set_value)
-cli.add_command(get_value)
-cli.add_command(query)
-cli.add_command(export_chat)
+import sys
+from utils.client import try_forward
 
 
-if __name__ == "__main__":
+def main():
+  """Hand the invocation over to a running daemon, or run the cli in-process."""
+  exit_code = try_forward(sys.argv[1:])
+  if exit_code is not None:
+    sys.exit(exit_code)
+  from utils.cli import cli
+
   cli()
+
+
+def __getattr__(name: str):
+  # the click cli and every command module are only imported when a command runs in-process
+  if name == "cli":
+    from utils.cli import cli
+
+    return cli
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == "__main__":
+  main()
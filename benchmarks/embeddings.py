@@ -0,0 +1,200 @@
+"""
+Embedding backend benchmark.
+
+Encodes the same texts with every embedding backend (torch, onnx, onnx-int8) and thread count,
+and reports the load time, the throughput in texts and tokens per second and the peak RSS of
+each, along with its agreement with the torch backend: mean and minimum cosine similarity of
+the vectors of the same text, and overlap of the top-k neighbours of query texts.
+Every run encodes the texts twice, in batches of `--batch-size` texts and with the length
+bucketed, token budgeted batches of `embed_texts`, and reports the padding share of both.
+Each run happens in its own process so that thread settings and peak RSS do not leak.
+
+The texts are synthetic paragraphs of mixed lengths unless `--texts-file` gives real ones, one per line.
+The onnx backends need `optimum[onnxruntime]`, their model is exported once under `onnx_models_dir`.
+
+Usage:
+  python benchmarks/embeddings.py --texts 2000 --threads 1 --threads 4 --out results.json
+  python benchmarks/embeddings.py --backend torch --backend onnx-int8 --min-agreement 0.98
+"""
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+
+repo_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_root))
+
+from retrieval import peak_rss_mb, synthetic_documents
+
+
+def read_texts(texts_file: str | None, count: int, seed: int) -> list[str]:
+  if texts_file:
+    with open(texts_file, 'r') as f:
+      texts = [line.strip() for line in f if line.strip()]
+    return texts[:count]
+  # synthetic paragraphs cut to mixed lengths, from a few words to a whole chunk
+  rng = random.Random(seed)
+  paragraphs = [paragraph for document in synthetic_documents(count, seed) for paragraph in document.split("\n\n")]
+  texts = []
+  for paragraph in paragraphs[:count]:
+    words = paragraph.split(" ")
+    texts.append(" ".join(words[:max(3, int(len(words) * rng.random() ** 2))]))
+  return texts
+
+
+def count_batches_padding(texts: list[str], lengths: list[int], batch_size: int) -> int:
+  """Padded tokens of `encode(batch_size=...)`, which sorts the texts by character length first."""
+  order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+  return sum(len(batch) * max(lengths[i] for i in batch)
+             for batch in (order[start:start + batch_size] for start in range(0, len(order), batch_size)))
+
+
+def encode_phase(workdir: str, backend: str, threads: int, options: dict, results):
+  import numpy as np
+  from utils.embedding_backends import load_embedding_model
+  from utils.embeddings import EmbeddingStats, embed_texts, token_lengths
+
+  texts = read_texts(options["texts_file"], options["texts"], options["seed"])
+  start = time.perf_counter()
+  try:
+    model = load_embedding_model(backend=backend, threads=threads)
+  except Exception as e:
+    # e.g. optimum missing for the onnx backends, the other backends are still measured
+    results.put({"backend": backend, "threads": threads, "error": f"{type(e).__name__}: {e}"})
+    return
+  load_seconds = time.perf_counter() - start
+  lengths = token_lengths(model, texts)
+  tokens = sum(lengths)
+
+  # untimed warmup, the first batches pay for allocations and graph optimizations
+  model.encode(texts[:options["batch_size"]], batch_size=options["batch_size"])
+  start = time.perf_counter()
+  model.encode(texts, batch_size=options["batch_size"])
+  count_seconds = time.perf_counter() - start
+  stats = EmbeddingStats()
+  start = time.perf_counter()
+  vectors = embed_texts(texts, model, stats=stats)
+  seconds = time.perf_counter() - start
+  vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+  np.save(Path(workdir) / f"{backend}-{threads}.npy", np.asarray(vectors, dtype=np.float32))
+  results.put({
+    "backend": backend,
+    "threads": threads,
+    "load_seconds": round(load_seconds, 3),
+    "seconds": round(seconds, 3),
+    "texts_per_second": round(len(texts) / seconds, 1),
+    "tokens_per_second": round(tokens / seconds, 1),
+    "padding": round(stats.padding, 4),
+    "batches": stats.batches,
+    "count_batching": {
+      "seconds": round(count_seconds, 3),
+      "tokens_per_second": round(tokens / count_seconds, 1),
+      "padding": round(1 - tokens / count_batches_padding(texts, lengths, options["batch_size"]), 4),
+    },
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+  })
+
+
+def run_in_process(target, *args) -> dict:
+  context = multiprocessing.get_context("spawn")
+  results = context.Queue()
+  process = context.Process(target=target, args=(*args, results))
+  process.start()
+  report = results.get()
+  process.join()
+  if process.exitcode != 0:
+    raise RuntimeError(f"{target.__name__} exited with {process.exitcode}")
+  return report
+
+
+def agreement(reference, vectors, queries: int, k: int) -> dict:
+  """Cosine similarity of the vectors of the same texts and overlap of the top-k neighbours of the first texts."""
+  import numpy as np
+
+  cosines = (reference * vectors).sum(axis=1)
+  queries = min(queries, len(reference))
+  k = min(k, len(reference) - 1)
+
+  def neighbours(matrix):
+    scores = matrix[:queries] @ matrix.T
+    # a text is its own nearest neighbour, leave it out
+    scores[np.arange(queries), np.arange(queries)] = -np.inf
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+  expected, found = neighbours(reference), neighbours(vectors)
+  overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(expected, found)])
+  return {"cosine_mean": round(float(cosines.mean()), 5), "cosine_min": round(float(cosines.min()), 5),
+          f"neighbours@{k}": round(float(overlap), 4)}
+
+
+@click.command()
+@click.option("--backend", "-b", "selected", multiple=True,
+              type=click.Choice(["torch", "onnx", "onnx-int8"]), help="Backends to measure, all by default")
+@click.option("--threads", "-t", "thread_counts", type=int, multiple=True,
+              help="Intra-op thread counts to measure (repeatable), 0 is the default of the runtime")
+@click.option("--texts", "-n", type=int, default=2000, show_default=True, help="Number of texts encoded")
+@click.option("--texts-file", type=click.Path(exists=True, dir_okay=False), help="Real texts, one per line")
+@click.option("--batch-size", type=int, default=64, show_default=True)
+@click.option("--queries", type=int, default=100, show_default=True, help="Texts whose neighbours are compared")
+@click.option("-k", type=int, default=10, show_default=True, help="Neighbours compared per query")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--out", type=click.Path(dir_okay=False), help="Write the results as json to this file")
+@click.option("--min-agreement", type=float,
+              help="Fail when the mean cosine similarity of a backend with torch is lower")
+def main(selected: tuple, thread_counts: tuple, texts: int, texts_file: str, batch_size: int, queries: int,
+         k: int, seed: int, out: str, min_agreement: float):
+  import numpy as np
+
+  options = {"texts": texts, "texts_file": texts_file, "batch_size": batch_size, "seed": seed}
+  selected = list(selected or ["torch", "onnx", "onnx-int8"])
+  # torch is the reference of the agreement, it runs first and at least once
+  if "torch" in selected:
+    selected.remove("torch")
+  selected.insert(0, "torch")
+  workdir = tempfile.mkdtemp(prefix="aikame-bench-")
+  reports = []
+  try:
+    for backend in selected:
+      for threads in thread_counts or (0,):
+        report = run_in_process(encode_phase, workdir, backend, threads, options)
+        if "error" in report:
+          click.secho(f"{backend} threads {threads}: {report['error']}", fg="red")
+          if backend == "torch":
+            raise click.ClickException("the torch backend is the reference of the agreement")
+          continue
+        reports.append(report)
+    reference = np.load(Path(workdir) / f"torch-{reports[0]['threads']}.npy")
+    for report in reports:
+      vectors = np.load(Path(workdir) / f"{report['backend']}-{report['threads']}.npy")
+      report.update(agreement(reference, vectors, queries, k))
+      count = report["count_batching"]
+      click.echo(
+        f"{report['backend']:<10} threads {report['threads'] or 'default':>7}  load {report['load_seconds']:7.2f} s  "
+        f"{report['texts_per_second']:9.1f} texts/s  {report['tokens_per_second']:10.1f} tokens/s "
+        f"({report['padding']:.1%} padding, {count['tokens_per_second']:.1f} tokens/s and {count['padding']:.1%} "
+        f"in batches of {batch_size})  rss {report['peak_rss_mb']:7.1f} MB  "
+        f"cosine mean {report['cosine_mean']:.5f} min {report['cosine_min']:.5f}  "
+        f"neighbours@{k} {report[f'neighbours@{k}']:.3f}")
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  results = {"options": options, "python": platform.python_version(), "backends": reports}
+  if out:
+    Path(out).write_text(json.dumps(results, indent=2))
+  if min_agreement is not None:
+    failed = [report for report in reports if report["cosine_mean"] < min_agreement]
+    for report in failed:
+      click.secho(f"{report['backend']} agrees with torch at {report['cosine_mean']} only", fg="red")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
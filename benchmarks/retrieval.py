@@ -0,0 +1,351 @@
+"""
+Offline retrieval and ingestion benchmark.
+
+Generates a synthetic corpus as files, ingests them into a scratch store with the pipeline of
+`load_files` (text store, lexical index, offset-only chunks), builds consolidated faiss indexes
+from it, and reports per stage throughput, query latency percentiles, recall@k against
+an exact brute-force search, size on disk and peak RSS of every backend. Compressed faiss
+backends (fp16, int8, pq) also report the recall of their codes alone, before rescoring,
+and the size of the index next to the size of the float32 side file used to rescore.
+Each backend runs in its own process so that its peak RSS is its own.
+
+By default the pipeline embeds the chunks with synthetic clustered vectors, so that large corpora
+(up to millions of chunks) can be measured without the embedding model; `--embedder model`
+encodes the chunks with `model_label` instead (the model must be available locally).
+
+Usage:
+  python benchmarks/retrieval.py --chunks 10000 --out results.json
+  python benchmarks/retrieval.py --chunks 10000 --baseline results.json
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+
+repo_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_root))
+
+# faiss backends are faiss-<kind>[-<compression>]
+backends = ["chroma", "faiss-flat", "faiss-ivf", "faiss-hnsw",
+            "faiss-flat-fp16", "faiss-flat-int8", "faiss-flat-pq", "faiss-ivf-pq"]
+paragraphs_per_document = 50
+
+
+def percentile(samples: list[float], q: float) -> float:
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() -> float:
+  # kilobytes on linux, bytes on macos
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+
+def disk_size_mb(path: Path) -> float:
+  if path.is_file():
+    return path.stat().st_size / (1024 * 1024)
+  return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / (1024 * 1024)
+
+
+def synthetic_documents(chunks: int, seed: int) -> list[str]:
+  """Documents of random words, sized so that splitting them gives about `chunks` chunks."""
+  from utils.constants import Constants
+
+  rng = random.Random(seed)
+  vocabulary = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 10))) for _ in range(20000)]
+  # words average 7 characters with their space, so that a paragraph fits in one chunk
+  words_per_paragraph = max(8, Constants.chunk_size // 8)
+  documents = []
+  for start in range(0, chunks, paragraphs_per_document):
+    paragraphs = [" ".join(rng.choices(vocabulary, k=words_per_paragraph)) + "."
+                  for _ in range(min(paragraphs_per_document, chunks - start))]
+    documents.append("\n\n".join(paragraphs))
+  return documents
+
+
+def clustered_vectors(count: int, dimension: int, rng, centers):
+  import numpy as np
+
+  assignment = rng.integers(0, len(centers), size=count)
+  vectors = centers[assignment] + 0.35 * rng.standard_normal((count, dimension)).astype(np.float32)
+  return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exact_neighbours(corpus, queries, k: int, block: int = 65536):
+  """Brute-force top-k (squared l2) positions of every query, computed block by block."""
+  import numpy as np
+
+  best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+  best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+  query_norms = (queries ** 2).sum(axis=1, keepdims=True)
+  for start in range(0, len(corpus), block):
+    part = corpus[start:start + block]
+    distances = query_norms - 2 * queries @ part.T + (part ** 2).sum(axis=1)
+    ids = np.broadcast_to(np.arange(start, start + len(part)), distances.shape)
+    distances = np.concatenate([best_distances, distances], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    best_distances = np.take_along_axis(distances, top, axis=1)
+    best_ids = np.take_along_axis(ids, top, axis=1)
+  return best_ids
+
+
+def recall_at_k(found: list[list[int]], truth) -> float:
+  hits = sum(len(set(row) & set(expected.tolist())) for row, expected in zip(found, truth))
+  return hits / truth.size
+
+
+def synthetic_embedder(dimension: int, clusters: int, seed: int):
+  """An `embed_texts` replacement giving every text a clustered vector derived from its hash."""
+  import hashlib
+  import numpy as np
+
+  centers = np.random.default_rng(seed).standard_normal((clusters, dimension)).astype(np.float32)
+
+  def embed_texts(texts: list[str], stats=None, **_):
+    vectors = np.empty((len(texts), dimension), dtype=np.float32)
+    for row, text in enumerate(texts):
+      rng = np.random.default_rng(int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little"))
+      vectors[row] = clustered_vectors(1, dimension, rng, centers)[0]
+    return vectors
+  return embed_texts, centers
+
+
+def stored_vectors(page_size: int = 5000):
+  """Chunk ids and embeddings of the collection, row i of the chunk id i."""
+  import numpy as np
+  from utils.resources import Resources
+
+  collection = Resources.collection()
+  ids, vectors = [], []
+  while True:
+    page = collection.get(limit=page_size, offset=len(ids), include=["embeddings"])
+    if not page["ids"]:
+      break
+    ids.extend(page["ids"])
+    vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+  return ids, np.concatenate(vectors)
+
+
+def ingest_phase(workdir: str, options: dict, results):
+  """
+  Generate the corpus as files and ingest them with the pipeline of `load_files` (text store,
+  lexical index and offset-only chunks), then compute the exact neighbours of the queries.
+  """
+  os.environ["parent_path"] = os.path.join(workdir, "store")
+  import numpy as np
+  import utils.ingest
+  from utils.resources import Resources
+
+  start = time.perf_counter()
+  documents = synthetic_documents(options["chunks"], options["seed"])
+  corpus_dir = Path(workdir) / "corpus"
+  corpus_dir.mkdir()
+  paths = []
+  for number, document in enumerate(documents):
+    path = corpus_dir / f"{number}.txt"
+    path.write_text(document)
+    paths.append(path)
+  generate_seconds = time.perf_counter() - start
+
+  rng = np.random.default_rng(options["seed"])
+  if options["embedder"] == "synthetic":
+    # the pipeline embeds through `embed_texts`, swapped for hashed synthetic vectors
+    utils.ingest.embed_texts, centers = synthetic_embedder(
+      options["dimension"], max(1, options["chunks"] // 100), options["seed"])
+
+  start = time.perf_counter()
+  pipeline = utils.ingest.IngestionPipeline(workers=options["workers"])
+  # the pipeline reports every document, keep the benchmark output to its results
+  with contextlib.redirect_stdout(io.StringIO()):
+    pipeline.run(paths)
+  ingest_seconds = time.perf_counter() - start
+
+  ids, corpus = stored_vectors()
+  if options["embedder"] == "model":
+    question_rng = random.Random(options["seed"] + 1)
+    paragraphs = [paragraph for document in documents for paragraph in document.split("\n\n")]
+    questions = [" ".join(question_rng.choice(paragraphs).split()[:12]) for _ in range(options["queries"])]
+    queries = Resources.embedding_model().encode(questions, convert_to_numpy=True).astype(np.float32)
+  else:
+    queries = clustered_vectors(options["queries"], options["dimension"], rng, centers)
+
+  np.save(os.path.join(workdir, "queries.npy"), queries)
+  np.save(os.path.join(workdir, "truth.npy"), exact_neighbours(corpus, queries, options["k"]))
+  Path(workdir, "chunk_ids.json").write_text(json.dumps(ids))
+  stages = {"generate": (len(ids), generate_seconds), "ingest": (len(ids), ingest_seconds)}
+  stages.update({name: (counter.chunks, counter.seconds) for name, counter in pipeline.counters.items()})
+  results.put({
+    "chunks": len(ids),
+    "documents": len(documents),
+    "dimension": int(corpus.shape[1]),
+    "stages": {name: {"seconds": round(seconds, 3), "chunks_per_second": round(count / seconds, 1)}
+               for name, (count, seconds) in stages.items() if seconds > 0},
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+  })
+
+
+def query_phase(workdir: str, backend: str, options: dict, results):
+  """Search every query against one backend, building its index first for faiss."""
+  os.environ["parent_path"] = os.path.join(workdir, "store")
+  import numpy as np
+  from utils.constants import Constants
+
+  queries = np.load(os.path.join(workdir, "queries.npy"))
+  truth = np.load(os.path.join(workdir, "truth.npy"))
+  positions = {chunk_id: i for i, chunk_id in enumerate(json.loads(Path(workdir, "chunk_ids.json").read_text()))}
+  k = options["k"]
+  report = {}
+
+  if backend == "chroma":
+    from utils.resources import Resources
+
+    collection = Resources.collection()
+
+    def search(vector) -> list[int]:
+      found = collection.query(query_embeddings=[vector.tolist()], n_results=k, include=[])
+      return [positions[chunk_id] for chunk_id in found["ids"][0]]
+    size = disk_size_mb(Constants.parent_path / "chromadb")
+  else:
+    from utils.faiss_index import FaissIndex
+
+    _, kind, *compression = backend.split("-")
+    compression = compression[0] if compression else "none"
+    index = FaissIndex(Path(workdir) / backend)
+    start = time.perf_counter()
+    count = index.build(kind, compression)
+    seconds = time.perf_counter() - start
+    report["build"] = {"seconds": round(seconds, 3), "chunks_per_second": round(count / seconds, 1)}
+    start = time.perf_counter()
+    index.load()
+    report["load_seconds"] = round(time.perf_counter() - start, 4)
+
+    def search(vector) -> list[int]:
+      return [positions[chunk_id] for chunk_id, _, _ in index.search([vector], k)[0]]
+    size = disk_size_mb(index.index_file) + disk_size_mb(index.ids_file)
+    report["index_mb"] = round(disk_size_mb(index.index_file), 2)
+    if compression != "none":
+      # what the codes alone find, before the rescoring with the float32 side file
+      codes_only = [[positions[chunk_id] for chunk_id, _, _ in hits]
+                    for hits in index.search(queries, k, rescore=False)]
+      report[f"recall@{k}_codes_only"] = round(recall_at_k(codes_only, truth), 4)
+      report["rescore_mb"] = round(disk_size_mb(index.vectors_file), 2)
+      size += report["rescore_mb"]
+
+  for vector in queries[:options["warmup"]]:
+    search(vector)
+  latencies, found = [], []
+  for vector in queries:
+    start = time.perf_counter()
+    found.append(search(vector))
+    latencies.append((time.perf_counter() - start) * 1000)
+
+  report.update({
+    "backend": backend,
+    "latency_ms": {
+      "p50": round(percentile(latencies, 50), 3),
+      "p95": round(percentile(latencies, 95), 3),
+      "p99": round(percentile(latencies, 99), 3),
+      "mean": round(statistics.fmean(latencies), 3),
+    },
+    f"recall@{k}": round(recall_at_k(found, truth), 4),
+    "disk_mb": round(size, 2),
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+  })
+  results.put(report)
+
+
+def run_in_process(target, *args) -> dict:
+  context = multiprocessing.get_context("spawn")
+  results = context.Queue()
+  process = context.Process(target=target, args=(*args, results))
+  process.start()
+  report = results.get()
+  process.join()
+  if process.exitcode != 0:
+    raise RuntimeError(f"{target.__name__} exited with {process.exitcode}")
+  return report
+
+
+def regressions(current: dict, baseline: dict, tolerance: float) -> list[str]:
+  """Latencies slower and recalls lower than the baseline by more than `tolerance`."""
+  found = []
+  previous = {report["backend"]: report for report in baseline.get("backends", [])}
+  for report in current["backends"]:
+    before = previous.get(report["backend"])
+    if before is None:
+      continue
+    for name in ("p50", "p95", "p99"):
+      if report["latency_ms"][name] > before["latency_ms"][name] * (1 + tolerance):
+        found.append(f"{report['backend']} {name} latency {before['latency_ms'][name]} -> {report['latency_ms'][name]} ms")
+    recall = f"recall@{current['options']['k']}"
+    if recall in before and report[recall] < before[recall] - tolerance * before[recall]:
+      found.append(f"{report['backend']} {recall} {before[recall]} -> {report[recall]}")
+  return found
+
+
+@click.command()
+@click.option("--chunks", "-c", type=int, default=10000, show_default=True, help="Approximate corpus size in chunks")
+@click.option("--queries", "-q", type=int, default=200, show_default=True, help="Number of timed queries")
+@click.option("--warmup", type=int, default=10, show_default=True, help="Untimed queries run first")
+@click.option("-k", type=int, default=10, show_default=True, help="Neighbours per query, recall is measured at k")
+@click.option("--embedder", type=click.Choice(["synthetic", "model"]), default="synthetic", show_default=True,
+              help="Synthetic clustered vectors, or the embedding model of model_label")
+@click.option("--dimension", type=int, default=384, show_default=True, help="Dimension of the synthetic vectors")
+@click.option("--backend", "-b", "selected", type=click.Choice(backends), multiple=True,
+              help="Backends to measure, all by default")
+@click.option("--workers", "-w", type=int, default=4, show_default=True, help="Parsing processes of the pipeline")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--out", type=click.Path(dir_okay=False), help="Write the results as json to this file")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False),
+              help="Fail when slower or less accurate than these earlier results")
+@click.option("--tolerance", type=float, default=0.2, show_default=True, help="Allowed relative regression")
+def main(chunks: int, queries: int, warmup: int, k: int, embedder: str, dimension: int, selected: tuple,
+         workers: int, seed: int, out: str, baseline: str, tolerance: float):
+  options = {"chunks": chunks, "queries": queries, "warmup": warmup, "k": k,
+             "embedder": embedder, "dimension": dimension, "workers": workers, "seed": seed}
+  workdir = tempfile.mkdtemp(prefix="aikame-bench-")
+  try:
+    ingestion = run_in_process(ingest_phase, workdir, options)
+    click.echo(f"Ingested {ingestion['chunks']} chunks of dimension {ingestion['dimension']}")
+    for name, stage in ingestion["stages"].items():
+      click.echo(f"  {name:>8}: {stage['seconds']:9.3f} s  {stage['chunks_per_second']:12.1f} chunks/s")
+    reports = []
+    for backend in selected or backends:
+      report = run_in_process(query_phase, workdir, backend, options)
+      latency = report["latency_ms"]
+      click.echo(
+        f"{backend:<15} p50 {latency['p50']:8.3f} ms  p95 {latency['p95']:8.3f} ms  p99 {latency['p99']:8.3f} ms  "
+        f"recall@{k} {report[f'recall@{k}']:.3f}  disk {report['disk_mb']:8.1f} MB  rss {report['peak_rss_mb']:7.1f} MB"
+        + (f"  (codes only: recall {report[f'recall@{k}_codes_only']:.3f}, index {report['index_mb']:.1f} MB)"
+           if f"recall@{k}_codes_only" in report else ""))
+      reports.append(report)
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  results = {"options": options, "python": platform.python_version(), "ingestion": ingestion, "backends": reports}
+  if out:
+    Path(out).write_text(json.dumps(results, indent=2))
+  if baseline:
+    found = regressions(results, json.loads(Path(baseline).read_text()), tolerance)
+    for line in found:
+      click.secho(f"regression: {line}", fg="red")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+  main()
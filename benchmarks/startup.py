@@ -0,0 +1,132 @@
+"""
+Startup benchmark for the cli.
+
+Runs metadata-only commands in fresh interpreters and reports how long they take,
+and fails if any of them pulled in the embedding model or the vector store.
+Then measures the overhead of the thin client in front of a daemon: forwardable commands are
+sent to a stub daemon that answers at once, and the run fails if the client imported the cli.
+
+Usage: python benchmarks/startup.py [--runs 5]
+"""
+import json
+import os
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import click
+
+
+repo_root = Path(__file__).resolve().parent.parent
+
+# modules that must never be imported by commands which only touch metadata
+heavy_modules = ["torch", "sentence_transformers", "transformers", "chromadb"]
+
+metadata_commands = [
+  ["--help"],
+  ["hello", "benchmark"],
+  ["show_files"],
+]
+
+# modules a forwarded invocation must not import
+cli_modules = ["click", "utils.cli", "utils.constants"]
+
+forwarded_commands = [
+  ["show_files"],
+  ["ask", "-q", "benchmark"],
+  ["--workspace", "benchmark", "remove_file", "/benchmark.txt"],
+]
+
+probe = """
+import json, sys, time
+start = time.perf_counter()
+import aikame
+try:
+  aikame.cli.main(args=sys.argv[1:], prog_name="aikame", standalone_mode=False)
+except SystemExit:
+  pass
+elapsed = time.perf_counter() - start
+heavy = [name for name in %r if name in sys.modules]
+sys.stderr.write("\\n" + json.dumps({"seconds": elapsed, "heavy_modules": heavy}) + "\\n")
+"""
+
+forward_probe = """
+import json, sys, time
+start = time.perf_counter()
+import aikame
+sys.argv = ["aikame", *sys.argv[1:]]
+try:
+  aikame.main()
+except SystemExit:
+  pass
+elapsed = time.perf_counter() - start
+heavy = [name for name in %r if name in sys.modules]
+sys.stderr.write("\\n" + json.dumps({"seconds": elapsed, "heavy_modules": heavy}) + "\\n")
+"""
+
+
+class StubDaemon(socketserver.StreamRequestHandler):
+  """Answers every forwarded invocation with a zero exit code, without running it."""
+
+  def handle(self):
+    self.rfile.readline()
+    self.wfile.write(b'{"exit": 0}\n')
+
+
+def run_once(args: list[str], parent_path: str, script: str = probe, modules: list[str] = heavy_modules) -> dict:
+  env = dict(os.environ, parent_path=parent_path)
+  env.pop("daemon_socket", None)
+  completed = subprocess.run(
+    [sys.executable, "-c", script % (modules,), *args],
+    cwd=repo_root, env=env, capture_output=True, text=True)
+  if completed.returncode != 0:
+    raise RuntimeError(f"`aikame {' '.join(args)}` failed:\n{completed.stderr}")
+  return json.loads(completed.stderr.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option("--runs", "-n", type=int, default=5, help="Runs per command")
+@click.option("--json", "as_json", is_flag=True, help="Emit machine-readable results")
+def main(runs: int, as_json: bool):
+  results = []
+  with tempfile.TemporaryDirectory() as parent_path:
+    for args in metadata_commands:
+      samples = [run_once(args, parent_path) for _ in range(runs)]
+      results.append({
+        "command": " ".join(args),
+        "median_seconds": statistics.median(s["seconds"] for s in samples),
+        "heavy_modules": sorted({m for s in samples for m in s["heavy_modules"]}),
+      })
+    server = socketserver.ThreadingUnixStreamServer(os.path.join(parent_path, "aikame.sock"), StubDaemon)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      for args in forwarded_commands:
+        samples = [run_once(args, parent_path, forward_probe, cli_modules) for _ in range(runs)]
+        results.append({
+          "command": " ".join(args),
+          "forwarded": True,
+          "median_seconds": statistics.median(s["seconds"] for s in samples),
+          "heavy_modules": sorted({m for s in samples for m in s["heavy_modules"]}),
+        })
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  failed = [r for r in results if r["heavy_modules"]]
+  if as_json:
+    click.echo(json.dumps(results, indent=2))
+  else:
+    for r in results:
+      status = "FAIL" if r["heavy_modules"] else "ok"
+      click.echo(
+        f"{status:4}  aikame {r['command']:<20} {r['median_seconds'] * 1000:8.1f} ms  "
+        f"{'(forwarded) ' if r.get('forwarded') else ''}{', '.join(r['heavy_modules'])}")
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
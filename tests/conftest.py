@@ -0,0 +1,17 @@
+import os
+import tempfile
+import uuid
+import pytest
+
+# Constants are read from the environment on import, keep everything the tests write out of ~/.aikame-dump
+os.environ["parent_path"] = tempfile.mkdtemp(prefix="aikame-tests-")
+os.environ.pop("workspace", None)
+
+
+@pytest.fixture
+def fresh_workspace():
+  """An empty workspace of its own, current for the duration of the test."""
+  from utils.workspace import in_workspace
+
+  with in_workspace(f"test-{uuid.uuid4().hex[:12]}") as current:
+    yield current
@@ -0,0 +1,28 @@
+import pytest
+from utils.batch import retrieve_all
+from utils.constants import Constants
+from utils.context import candidate_count
+from utils.lexical import lexical_index
+from utils.rag import retrieve
+from utils.resources import Resources
+
+chunks = {
+  "c0": ("restart the pump after ERR-1234", [0.0, 1.0]),
+  "c1": ("check the pressure in bar", [1.0, 0.0]),
+  "c2": ("the manual lists every error code", [1.0, 1.0]),
+}
+
+
+@pytest.mark.parametrize("hybrid", [True, False])
+def test_retrieve_all_matches_retrieve(fresh_workspace, monkeypatch, hybrid):
+  monkeypatch.setattr(Constants, "hybrid_retrieval", hybrid)
+  ids = list(chunks)
+  Resources.collection().upsert(ids=ids, embeddings=[chunks[id][1] for id in ids],
+                                documents=[chunks[id][0] for id in ids],
+                                metadatas=[{"source": f"/docs/{id}.txt", "chunk_index": 0} for id in ids])
+  lexical_index.add(ids, [chunks[id][0] for id in ids])
+  questions = ["what does ERR-1234 mean", "pressure unit"]
+  embeddings = [[0.9, 0.1], [0.1, 0.9]]
+
+  assert retrieve_all(questions, embeddings) == [
+    retrieve(embedding, candidate_count(), question) for question, embedding in zip(questions, embeddings)]
@@ -0,0 +1,22 @@
+import json
+from utils.catalog import catalog
+
+
+def test_migrates_baseline_metadata_file(fresh_workspace):
+  fresh_workspace.path.mkdir(parents=True)
+  legacy = {"/docs/a.txt": {"chunks": 2, "ids": ["a1", "a2"]}, "/docs/b.txt": {"chunks": 1, "ids": ["b1"]}}
+  fresh_workspace.metadata_file.write_text(json.dumps(legacy))
+
+  manifest = catalog.get("/docs/a.txt")
+  assert manifest == {"chunks": 2, "ids": ["a1", "a2"], "file_hash": "", "size": 0, "mtime": 0}
+  assert catalog.get("/docs/b.txt")["ids"] == ["b1"]
+  assert not fresh_workspace.metadata_file.exists()
+  assert fresh_workspace.metadata_file.with_suffix(".json.migrated").exists()
+
+
+def test_migrates_current_metadata_file(fresh_workspace):
+  fresh_workspace.path.mkdir(parents=True)
+  legacy = {"/docs/a.txt": {"chunks": 1, "ids": ["a1"], "file_hash": "abc", "size": 10, "mtime": 1.5}}
+  fresh_workspace.metadata_file.write_text(json.dumps(legacy))
+
+  assert catalog.get("/docs/a.txt") == {"chunks": 1, "ids": ["a1"], "file_hash": "abc", "size": 10, "mtime": 1.5}
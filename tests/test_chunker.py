@@ -0,0 +1,51 @@
+import random
+import pytest
+from utils.chunker import Chunker
+
+
+def corpus(seed: int = 0) -> str:
+  rng = random.Random(seed)
+  words = ["alpha", "béta", "gamma", "δέλτα", "epsilon", "zeta", "日本語", "eta."]
+  paragraphs = [" ".join(rng.choices(words, k=rng.randint(5, 60))) for _ in range(30)]
+  return "\n\n".join(paragraphs) + "\n"
+
+
+def test_split_offsets():
+  text = corpus()
+  spans = list(Chunker(chunk_size=120, overlap=20).split(text))
+
+  assert spans
+  covered = set()
+  for (start, end), (next_start, _) in zip(spans, spans[1:] + [(len(text), None)]):
+    chunk = text[start:end]
+    assert 0 < end - start <= 120
+    assert chunk == chunk.strip()
+    assert start < next_start
+    covered.update(range(start, end))
+  # every character but whitespace ends up in a chunk
+  assert all(i in covered for i, character in enumerate(text) if not character.isspace())
+
+
+def test_chunks_overlap_on_word_starts():
+  text = corpus(1)
+  spans = list(Chunker(chunk_size=100, overlap=30).split(text))
+
+  for (_, end), (next_start, _) in zip(spans, spans[1:]):
+    assert next_start == 0 or text[next_start - 1].isspace()
+    assert next_start <= end
+
+
+@pytest.mark.parametrize("block_size", [1, 37, 500])
+def test_stream_gives_the_chunks_of_the_whole_text(block_size):
+  text = corpus(2)
+  chunker = Chunker(chunk_size=150, overlap=25)
+  blocks = [text[i:i + block_size] for i in range(0, len(text), block_size)]
+
+  streamed = list(chunker.stream(blocks))
+  assert [(start, end) for start, end, _ in streamed] == list(chunker.split(text))
+  assert all(chunk == text[start:end] for start, end, chunk in streamed)
+
+
+def test_rejects_an_overlap_larger_than_the_chunks():
+  with pytest.raises(ValueError):
+    Chunker(chunk_size=50, overlap=50)
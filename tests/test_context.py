@@ -0,0 +1,32 @@
+from utils.context import Span, estimate_tokens, pack_spans
+from utils.resources import Resources
+
+
+class WordTokenizer:
+  def __call__(self, text, **_):
+    return {"input_ids": text.split()}
+
+
+class Model:
+  tokenizer = WordTokenizer()
+
+
+def test_estimate_tokens_without_a_model(monkeypatch):
+  monkeypatch.setattr(Resources, "_embedding_model", None)
+  assert estimate_tokens("abcdefghi") == 3
+
+
+def test_estimate_tokens_with_the_loaded_tokenizer(monkeypatch):
+  monkeypatch.setattr(Resources, "_embedding_model", Model())
+  assert estimate_tokens("one two three four five six seven eight nine ten") == 10
+
+
+def test_pack_spans_cuts_the_best_span_to_the_budget(monkeypatch):
+  monkeypatch.setattr(Resources, "_embedding_model", Model())
+  long = Span("/docs/a.txt", 0, 3, " ".join(f"word{i}" for i in range(100)), 0.1, start=0, end=588)
+  short = Span("/docs/b.txt", 0, 0, "two words", 0.5)
+
+  packed = pack_spans([short, long], 12)
+  assert [span.source for span in packed] == ["/docs/a.txt"]
+  assert packed[0].text.split() == [f"word{i}" for i in range(12)]
+  assert packed[0].end == len(packed[0].text)
@@ -0,0 +1,10 @@
+import sys
+import click
+import pytest
+from utils.embedding_backends import load_embedding_model
+
+
+def test_onnx_backend_without_optimum_names_the_extra(monkeypatch):
+  monkeypatch.setitem(sys.modules, "optimum.onnxruntime", None)
+  with pytest.raises(click.ClickException, match=r"aikame\[onnx\]"):
+    load_embedding_model("some-model", backend="onnx")
@@ -0,0 +1,29 @@
+import faiss
+import numpy as np
+from utils.catalog import catalog
+from utils.faiss_index import faiss_index
+from utils.resources import Resources
+
+
+def per_file_index(path, vectors: list[list[float]]):
+  index = faiss.IndexFlatL2(len(vectors[0]))
+  index.add(np.asarray(vectors, dtype=np.float32))
+  faiss.write_index(index, str(path))
+  return path
+
+
+def test_merged_ledger_vectors_are_retrievable(fresh_workspace, tmp_path):
+  vectors = [[0.0, 1.0], [1.0, 0.0], [5.0, 5.0]]
+  ids = ["c0", "c1", "c2"]
+  Resources.collection().upsert(ids=ids, embeddings=vectors, documents=["zero", "one", "two"],
+                                metadatas=[{"source": "/docs/a.txt", "chunk_index": i} for i in range(3)])
+  catalog.put("/docs/a.txt", {"ids": ids, "file_hash": "abc", "size": 3, "mtime": 1.0})
+  entries = [("/docs/a.txt", per_file_index(tmp_path / "a.index", vectors)),
+             ("/docs/missing.txt", per_file_index(tmp_path / "missing.index", [[9.0, 9.0]]))]
+
+  assert faiss_index.merge(entries) == 3
+  results = faiss_index.query([1.0, 0.1], 2)
+  assert results["ids"][0] == ["c1", "c0"]
+  assert results["documents"][0] == ["one", "zero"]
+  # merging again adds nothing, the chunks are already indexed
+  assert faiss_index.merge(entries) == 0
@@ -0,0 +1,32 @@
+from utils.ingest import DocumentJob, IngestionPipeline
+from utils.resources import Resources
+from utils.text_store import text_store, text_version
+
+
+def job(path: str, text: str, spans: list[tuple[int, int]], manifest: dict = None) -> DocumentJob:
+  file_hash = f"{abs(hash(text)):016x}"
+  text_store.write(path, text_version(file_hash), text)
+  ids = [f"{path}:{start}" for start, _ in spans]
+  return DocumentJob({"path": path, "file_hash": file_hash, "size": len(text), "mtime": 1.0, "ids": ids,
+                      "spans": spans}, manifest)
+
+
+def test_write_stage_finalizes_every_document_once(fresh_workspace, monkeypatch):
+  pipeline = IngestionPipeline(write_batch_size=1)
+  finalized = []
+  finalize = pipeline._finalize
+  monkeypatch.setattr(pipeline, "_finalize", lambda job: (finalized.append(job.path), finalize(job)))
+
+  changed = job("/docs/a.txt", "alpha beta gamma", [(0, 5), (6, 10), (11, 16)])
+  kept = job("/docs/b.txt", "delta", [(0, 5)])
+  Resources.collection().upsert(ids=kept.ids, embeddings=[[0.0, 1.0]], metadatas=[kept.metadata(0)])
+  unchanged = job("/docs/b.txt", "delta", [(0, 5)], manifest={"ids": kept.ids})
+  rows = [(changed, i) for i in changed.new]
+  pipeline.write_queue.put(([changed, unchanged], rows, [[float(i), 1.0] for i in range(len(rows))]))
+  pipeline.write_queue.put(None)
+  pipeline._write_stage()
+
+  assert pipeline.error is None
+  assert sorted(finalized) == ["/docs/a.txt", "/docs/b.txt"]
+  assert pipeline.finished["/docs/a.txt"]["ids"] == changed.ids
+  assert Resources.collection().count() == 4
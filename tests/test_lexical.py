@@ -0,0 +1,62 @@
+import math
+import pytest
+from utils.constants import Constants
+from utils.lexical import lexical_index, tokenize
+from utils.resources import Resources
+
+texts = {
+  "c0": "the pump failed with ERR-1234 after the restart",
+  "c1": "restart the pump, then check the pressure",
+  "c2": "pressure sensors report in bar",
+  "c3": "the manual lists every error code",
+}
+
+
+def load(texts: dict[str, str]):
+  ids = list(texts)
+  Resources.collection().upsert(ids=ids, embeddings=[[float(i), 1.0] for i in range(len(ids))],
+                                documents=[texts[id] for id in ids])
+  lexical_index.add(ids, [texts[id] for id in ids])
+
+
+def bm25(query: str, k: int) -> list[tuple[str, float]]:
+  documents = {id: tokenize(text) for id, text in texts.items()}
+  average = sum(map(len, documents.values())) / len(documents)
+  k1, b = Constants.bm25_k1, Constants.bm25_b
+  scores = {}
+  for term in set(tokenize(query)):
+    df = sum(term in tokens for tokens in documents.values())
+    if not df:
+      continue
+    idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+    for id, tokens in documents.items():
+      tf = tokens.count(term)
+      if tf:
+        scores[id] = scores.get(id, 0) + idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / average))
+  return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+
+def test_search_scores_bm25(fresh_workspace, monkeypatch):
+  monkeypatch.setattr(Constants, "lexical_max_df", 1.0)
+  load(texts)
+  for query in ("pump restart", "err-1234", "pressure bar", "nothing"):
+    found = lexical_index.search(query, 3)
+    expected = bm25(query, 3)
+    assert [id for id, _ in found] == [id for id, _ in expected]
+    assert [score for _, score in found] == pytest.approx([score for _, score in expected])
+
+
+def test_index_created_with_the_collection_needs_no_backfill(fresh_workspace):
+  load(texts)
+  assert lexical_index._get("backfilled") == 1
+
+
+def test_backfill_indexes_chunks_loaded_before_the_index(fresh_workspace):
+  ids = list(texts)
+  Resources.collection().upsert(ids=ids, embeddings=[[float(i), 1.0] for i in range(len(ids))],
+                                documents=[texts[id] for id in ids])
+  lexical_index.add(["c9"], ["a chunk added later"])
+  assert lexical_index._get("backfilled") == 0
+  assert lexical_index.search("pressure", 5)[0][0] == "c2"
+  assert lexical_index._get("backfilled") == 1
+  assert lexical_index._get("chunks") == 5
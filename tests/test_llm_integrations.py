@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from utils.exceptions import LLMProviderError
+from utils.llm_integrations.base import AsyncProvider, build_messages
+from utils.llm_integrations.fake import FakeProvider
+from utils.llm import run_sync
+
+
+def test_providers_must_implement_stream():
+  class Incomplete(AsyncProvider):
+    name = "incomplete"
+
+  with pytest.raises(TypeError):
+    Incomplete()
+
+
+def test_fake_provider_streams_an_answer():
+  completion = run_sync(FakeProvider().complete(build_messages("hello", "some context")))
+  assert "hello" in completion.text
+  assert completion.attempts == 1
+
+
+class SlowProvider(AsyncProvider):
+  name = "slow"
+
+  def __init__(self, first_delay: float, delay: float, tokens: int, **options):
+    super().__init__(**options)
+    self.first_delay, self.delay, self.tokens = first_delay, delay, tokens
+
+  async def _stream(self, messages):
+    await asyncio.sleep(self.first_delay)
+    for i in range(self.tokens):
+      if i:
+        await asyncio.sleep(self.delay)
+      yield f"{i} "
+
+
+def test_a_long_streaming_answer_is_not_cut_by_the_timeout():
+  provider = SlowProvider(0.01, 0.03, 10, timeout=0.1, max_retries=0)
+  completion = run_sync(provider.complete([]))
+  assert completion.text.split() == [str(i) for i in range(10)]
+  assert completion.total_seconds > provider.timeout
+
+
+def test_timeout_before_the_first_token():
+  with pytest.raises(LLMProviderError, match="2 attempt"):
+    run_sync(SlowProvider(0.2, 0, 1, timeout=0.05, max_retries=1, backoff=0).complete([]))
+
+
+def test_timeout_between_tokens():
+  with pytest.raises(LLMProviderError, match="1 attempt"):
+    run_sync(SlowProvider(0, 0.2, 3, timeout=0.05, max_retries=1, backoff=0).complete([]))
@@ -0,0 +1,46 @@
+import uuid
+import pytest
+from utils.constants import Constants
+from utils.lexical import lexical_index
+from utils.rag import retrieve_across
+from utils.resources import Resources
+from utils.workspace import in_workspace
+
+
+def load(name: str, chunks: dict[str, tuple[str, list[float]]]):
+  with in_workspace(name):
+    ids = list(chunks)
+    Resources.collection().upsert(
+      ids=ids, embeddings=[chunks[id][1] for id in ids], documents=[chunks[id][0] for id in ids],
+      metadatas=[{"source": f"/docs/{id}.txt", "chunk_index": 0} for id in ids])
+    lexical_index.add(ids, [chunks[id][0] for id in ids])
+
+
+@pytest.fixture
+def workspaces():
+  near, far = f"test-{uuid.uuid4().hex[:12]}", f"test-{uuid.uuid4().hex[:12]}"
+  load(near, {"b1": ("bravo one", [0.1, 0.0]), "b2": ("bravo two", [0.2, 0.0]), "shared": ("shared", [0.5, 0.0])})
+  load(far, {"a1": ("alpha one", [3.0, 0.0]), "shared": ("shared", [0.4, 0.0])})
+  return {near: None, far: None}, near, far
+
+
+@pytest.mark.parametrize("hybrid", [True, False])
+def test_retrieve_across_orders_by_vector_distance(workspaces, monkeypatch, hybrid):
+  scopes, near, far = workspaces
+  monkeypatch.setattr(Constants, "hybrid_retrieval", hybrid)
+  results = retrieve_across([0.0, 0.0], 4, "nothing matches this", scopes)
+
+  # the best chunk of the far workspace is still behind the close chunks of the other one
+  assert results["ids"][0] == ["b1", "b2", "shared", "a1"]
+  assert [metadata["workspace"] for metadata in results["metadatas"][0]] == [near, near, far, far]
+  assert results["documents"][0][0] == "bravo one"
+  distances = results["distances"][0]
+  assert distances == sorted(distances)
+
+
+def test_retrieve_across_fuses_lexical_matches(workspaces):
+  scopes, _, far = workspaces
+  results = retrieve_across([0.0, 0.0], 2, "alpha", scopes)
+
+  assert "a1" in results["ids"][0]
+  assert results["metadatas"][0][results["ids"][0].index("a1")]["workspace"] == far
@@ -0,0 +1,54 @@
+import uuid
+import pytest
+from utils.catalog import catalog
+from utils.constants import Constants
+from utils.lexical import lexical_index
+from utils.resources import Resources
+from utils.snapshot import export_snapshot, import_snapshot
+from utils.text_store import text_store, text_version
+from utils.workspace import in_workspace
+
+text = "the quick brown fox jumps over the lazy dog, café au lait"
+spans = [(0, 19), (20, 43), (45, 57)]
+ids = [f"chunk-{i}" for i in range(len(spans))]
+vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+file_hash = "ab" * 32
+
+
+@pytest.fixture
+def snapshot(fresh_workspace, tmp_path):
+  text_store.write("/docs/a.txt", text_version(file_hash), text)
+  Resources.collection().upsert(
+    ids=ids, embeddings=vectors,
+    metadatas=[{"source": "/docs/a.txt", "chunk_index": i, "start": start, "end": end,
+                "text": text_version(file_hash)}
+               for i, (start, end) in enumerate(spans)])
+  lexical_index.add(ids, [text[start:end] for start, end in spans])
+  catalog.put("/docs/a.txt", {"ids": ids, "file_hash": file_hash, "size": len(text), "mtime": 1.0})
+  catalog.add_tags("/docs/a.txt", ["animals"])
+  description = export_snapshot(tmp_path / "snapshot")
+  return tmp_path / "snapshot", description
+
+
+def test_export_then_import_in_another_workspace(snapshot):
+  directory, description = snapshot
+  assert (description["chunks"], description["documents"], description["dimension"]) == (3, 1, 3)
+
+  with in_workspace(f"test-{uuid.uuid4().hex[:12]}"):
+    import_snapshot(directory)
+    assert Resources.collection().count() == 3
+    assert catalog.get("/docs/a.txt")["ids"] == ids
+    assert catalog.tags("/docs/a.txt") == ["animals"]
+    results = text_store.fill_results(Resources.collection().query(
+      query_embeddings=[[0.0, 0.9, 0.1]], n_results=1, include=["documents", "metadatas", "distances"]))
+    assert results["ids"][0] == ["chunk-1"]
+    assert results["documents"][0] == [text[20:43]]
+    assert [chunk_id for chunk_id, _ in lexical_index.search("café", 3)] == ["chunk-2"]
+
+
+def test_import_refuses_another_model(snapshot, monkeypatch):
+  directory, _ = snapshot
+  monkeypatch.setattr(Constants, "model_label", "another-model")
+  with in_workspace(f"test-{uuid.uuid4().hex[:12]}"):
+    with pytest.raises(ValueError, match="another-model"):
+      import_snapshot(directory)
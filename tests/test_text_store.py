@@ -0,0 +1,46 @@
+import pytest
+from utils.text_store import index_stride, text_store
+
+
+@pytest.mark.parametrize("text", [
+  "plain ascii text, " * 100,
+  "unicode: café, δέλτα, 日本語 and 🙂 " * 100,
+])
+def test_slices_round_trip(fresh_workspace, text):
+  text_store.write("/docs/a.txt", "v1", text)
+
+  for start, end in [(0, 10), (5, index_stride + 7), (index_stride - 1, index_stride + 1),
+                     (len(text) - 20, len(text)), (0, len(text))]:
+    assert text_store.slice("/docs/a.txt", "v1", start, end) == text[start:end]
+
+
+def test_writer_commits_block_by_block(fresh_workspace):
+  blocks = ["première page ", "é" * (index_stride + 3), " dernière page"]
+  with text_store.writer("/docs/b.txt", "v1") as writer:
+    for block in blocks:
+      writer.write(block)
+    assert not text_store.path("/docs/b.txt", "v1").exists()
+  text = "".join(blocks)
+  assert text_store.slice("/docs/b.txt", "v1", 10, len(text) - 5) == text[10:-5]
+
+
+def test_fill_keeps_stored_documents_and_slices_the_others(fresh_workspace):
+  text_store.write("/docs/a.txt", "v1", "hello world")
+  metadatas = [{"source": "/docs/a.txt", "text": "v1", "start": 6, "end": 11},
+               {"source": "/docs/old.txt", "chunk_index": 0},
+               {"source": "/docs/gone.txt", "text": "v1", "start": 0, "end": 4}]
+
+  assert text_store.fill([None, "stored text", None], metadatas) == ["world", "stored text", ""]
+
+
+def test_prune_keeps_the_current_version(fresh_workspace):
+  text_store.write("/docs/a.txt", "v1", "old text")
+  text_store.write("/docs/a.txt", "v2", "new text")
+  text_store.write("/docs/b.txt", "v1", "other")
+
+  text_store.prune("/docs/a.txt", keep="v2")
+  assert not text_store.path("/docs/a.txt", "v1").exists()
+  assert text_store.slice("/docs/a.txt", "v2", 0, 3) == "new"
+  text_store.delete("/docs/a.txt")
+  assert not text_store.path("/docs/a.txt", "v2").exists()
+  assert text_store.path("/docs/b.txt", "v1").exists()
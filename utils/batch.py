@@ -0,0 +1,167 @@
+import asyncio
+import click
+import json
+import time
+from pathlib import Path
+from .constants import Constants
+from .resources import Resources
+from .cache import query_cache, answer_cache
+from .llm import get_provider, run_sync
+from .llm_integrations.base import build_messages
+from .context import assemble_context, candidate_count, estimate_tokens
+from .lexical import fuse_results
+from .rag import retrieve
+from .scope import Scope, uses_partition
+from .tracing import tracer
+from .text_store import text_store
+
+
+class RateLimiter:
+  """Spaces calls at least `1 / rate` seconds apart, no limit when rate is 0."""
+
+  def __init__(self, rate: float):
+    self.interval = 1.0 / rate if rate > 0 else 0.0
+    self.next_slot = time.monotonic()
+
+  async def wait(self):
+    if not self.interval:
+      return
+    now = time.monotonic()
+    slot = max(now, self.next_slot)
+    self.next_slot = slot + self.interval
+    await asyncio.sleep(slot - now)
+
+
+def read_questions(file_path: Path) -> list[dict]:
+  """Questions of a jsonl file, each line `{"id": ..., "question": ...}` (the id defaults to the line number)."""
+  questions = []
+  with open(file_path, 'r') as f:
+    for line_number, line in enumerate(f, start=1):
+      if not line.strip():
+        continue
+      item = json.loads(line)
+      question = item.get("question", item.get("query"))
+      if not question:
+        raise ValueError(f"Line {line_number} of {file_path} has no question")
+      questions.append({"id": str(item.get("id", line_number)), "question": question})
+  return questions
+
+
+def answered_ids(file_path: Path) -> set[str]:
+  """Ids already answered in an output file, so that an interrupted batch can resume."""
+  if not file_path.exists():
+    return set()
+  done = set()
+  with open(file_path, 'r') as f:
+    for line in f:
+      try:
+        item = json.loads(line)
+      except json.JSONDecodeError:
+        # a line cut short by the interruption
+        continue
+      if "answer" in item:
+        done.add(str(item["id"]))
+  return done
+
+
+def retrieve_all(questions: list[str], embeddings: list[list[float]], scope: Scope = None) -> list[dict]:
+  """
+  Retrieved chunks of every question, one chroma query for all of them, then fused with the
+  lexical matches of each question. The faiss backend and scopes searched by partition retrieve
+  question by question, as `ask` does.
+  """
+  if Constants.retrieval_backend == "faiss" or (scope is not None and uses_partition(scope)):
+    return [retrieve(embedding, candidate_count(), question, scope) for question, embedding in zip(questions, embeddings)]
+  where = scope.where() if scope else None
+  with tracer.span("retrieve", backend="chroma") as span:
+    results = Resources.collection().query(
+      query_embeddings=embeddings,
+      n_results=candidate_count(),
+      where=where,
+      include=["documents", "metadatas", "distances"]
+    )
+    text_store.fill_results(results)
+    span.count(chunks=sum(len(ids) for ids in results["ids"]))
+  retrieved = [{name: [results[name][i]] for name in ("ids", "documents", "metadatas", "distances")}
+               for i in range(len(questions))]
+  if Constants.hybrid_retrieval:
+    with tracer.span("lexical_fusion"):
+      retrieved = [fuse_results(question, results, candidate_count(), where)
+                   for question, results in zip(questions, retrieved)]
+  return retrieved
+
+
+def run_batch(questions_file: Path, out_file: Path, concurrency: int = Constants.batch_concurrency,
+              rate: float = Constants.batch_rate, use_cache: bool = True, scope: Scope = None) -> None:
+  """
+  Answer every question of `questions_file` into `out_file`.
+  All questions are embedded in one batch and retrieved with one collection query,
+  then the llm calls run concurrently, each answer being appended as soon as it is ready.
+  """
+  questions = read_questions(questions_file)
+  done = answered_ids(out_file)
+  pending = [item for item in questions if item["id"] not in done]
+  click.secho(
+    f"{len(questions)} questions, {len(questions) - len(pending)} already answered, {len(pending)} to go.",
+    fg="yellow")
+  if not pending:
+    return
+
+  start = time.perf_counter()
+  with tracer.span("embed_query") as span:
+    embeddings = query_cache.embed_many([item["question"] for item in pending])
+    span.count(questions=len(pending))
+  results = retrieve_all([item["question"] for item in pending], embeddings, scope)
+  click.secho(
+    f"Embedded and retrieved context for {len(pending)} questions in {time.perf_counter() - start:.2f} seconds",
+    fg="green")
+
+  provider = get_provider()
+  limiter = RateLimiter(rate)
+
+  async def answer(i: int, semaphore: asyncio.Semaphore) -> dict:
+    item = pending[i]
+    retrieved = results[i]
+    with tracer.span("context", question=item["id"]) as span:
+      context = assemble_context(
+        retrieved["ids"][0], retrieved["documents"][0], retrieved["metadatas"][0], retrieved["distances"][0])
+      span.count(chunks=len(retrieved["ids"][0]), tokens=estimate_tokens(context))
+    sources = sorted({metadata["source"] for metadata in retrieved["metadatas"][0]})
+    started = time.perf_counter()
+    record = {**item, "sources": sources}
+    # the cache is sqlite, keep its blocking calls off the event loop
+    response = await asyncio.to_thread(answer_cache.lookup, embeddings[i], context) if use_cache else None
+    if response is None:
+      async with semaphore:
+        await limiter.wait()
+        completion = await provider.complete(build_messages(item["question"], context))
+      response = completion.text
+      record["time_to_first_token"] = round(completion.time_to_first_token, 3)
+      if use_cache:
+        await asyncio.to_thread(answer_cache.store, item["question"], embeddings[i], context, response)
+    return {**record, "answer": response, "seconds": round(time.perf_counter() - started, 3)}
+
+  async def answer_all(out) -> tuple[int, int]:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = {asyncio.ensure_future(answer(i, semaphore)): pending[i]["id"] for i in range(len(pending))}
+    answered, failed = 0, 0
+    for task in asyncio.as_completed(tasks):
+      try:
+        line = json.dumps(await task)
+      except Exception as e:
+        failed += 1
+        click.secho(f"\nQuestion failed: {e}", fg="red")
+        continue
+      out.write(line + "\n")
+      out.flush()
+      answered += 1
+      click.echo(f"\r{answered}/{len(pending)} answered", nl=False)
+    return answered, failed
+
+  out_file.parent.mkdir(parents=True, exist_ok=True)
+  with open(out_file, 'a') as out:
+    answered, failed = run_sync(answer_all(out))
+  click.echo()
+  click.secho(
+    f"Batch finished in {time.perf_counter() - start:.2f} seconds: {answered} answered, {failed} failed.",
+    fg="green" if not failed else "yellow")
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from .constants import Constants
+from .resources import Resources
+from .embedding_backends import model_key
+from .embeddings import embed_texts
+from .text_store import text_store
+from .workspace import PerWorkspace, Workspace
+
+
+# The caches live in one sqlite file next to the collection, so that they survive across
+# processes. Retrieval results are keyed with the collection version, which ingestion and
+# deletion bump, so a stale result can never be served.
+
+schema = """
+create table if not exists meta (key text primary key, value integer not null);
+create table if not exists embeddings (key text primary key, vector blob not null, used real not null);
+create table if not exists results (key text primary key, version integer not null, payload text not null, used real not null);
+create table if not exists answers (
+  id integer primary key, context_hash text not null, vector blob not null,
+  query text not null, answer text not null, created real not null, used real not null);
+create index if not exists embeddings_used on embeddings (used);
+create index if not exists results_used on results (used);
+create index if not exists answers_context on answers (context_hash);
+create index if not exists answers_used on answers (used);
+"""
+
+
+def normalize_query(text: str) -> str:
+  """Queries differing only in unicode form or whitespace share a cache entry."""
+  return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def pack_vector(vector: list[float]) -> bytes:
+  return struct.pack(f"{len(vector)}f", *vector)
+
+
+def unpack_vector(blob: bytes) -> list[float]:
+  return list(struct.unpack(f"{len(blob) // 4}f", blob))
+
+
+class SqliteCache:
+  """Lazily opened connection to the cache database of a workspace, shared by the caches below."""
+
+  def __init__(self, workspace: Workspace):
+    self.workspace = workspace
+    self._connection = None
+    self._lock = threading.RLock()
+
+  @property
+  def connection(self) -> sqlite3.Connection:
+    if self._connection is None:
+      self.workspace.path.mkdir(parents=True, exist_ok=True)
+      self._connection = sqlite3.connect(
+        self.workspace.cache_file, check_same_thread=False, isolation_level=None, timeout=30)
+      self._connection.execute("pragma journal_mode=wal")
+      self._connection.executescript(schema)
+    return self._connection
+
+  def _trim(self, table: str, max_items: int):
+    self.connection.execute(
+      f"delete from {table} where rowid in (select rowid from {table} order by used desc limit -1 offset ?)",
+      (max_items,))
+
+  def _counter(self, key: str) -> int:
+    row = self.connection.execute("select value from meta where key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+  def _increment(self, key: str):
+    self.connection.execute(
+      "insert into meta values (?, 1) on conflict (key) do update set value = value + 1", (key,))
+
+
+class QueryCache(SqliteCache):
+  """
+  LRU cache of query embeddings (keyed by model and normalized text)
+  and of retrieval results (keyed by embedding, number of results and collection version).
+  """
+
+  def __init__(self, workspace: Workspace, max_embeddings: int = Constants.query_cache_size,
+               max_results: int = Constants.results_cache_size, memory_items: int = 256):
+    super().__init__(workspace)
+    self.max_embeddings = max_embeddings
+    self.max_results = max_results
+    self.memory_items = memory_items
+    self._memory: OrderedDict[str, list[float]] = OrderedDict()
+
+  def collection_version(self) -> int:
+    with self._lock:
+      return self._counter("collection_version")
+
+  def bump_version(self):
+    """Invalidate every cached retrieval result, called whenever the collection changes."""
+    with self._lock:
+      self._increment("collection_version")
+      self.connection.execute(
+        "delete from results where version < (select value from meta where key = 'collection_version')")
+
+  def _key(self, normalized: str) -> str:
+    # vectors of the onnx backends differ slightly, they are cached apart from the torch ones
+    return hashlib.sha256(f"{model_key()}\0{normalized}".encode()).hexdigest()
+
+  def _cached(self, key: str) -> list[float] | None:
+    if key in self._memory:
+      self._memory.move_to_end(key)
+      return self._memory[key]
+    row = self.connection.execute("select vector from embeddings where key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    self.connection.execute("update embeddings set used = ? where key = ?", (time.time(), key))
+    return self._remember(key, unpack_vector(row[0]))
+
+  def _remember(self, key: str, vector: list[float]) -> list[float]:
+    self._memory[key] = vector
+    if len(self._memory) > self.memory_items:
+      self._memory.popitem(last=False)
+    return vector
+
+  def embed(self, query: str) -> list[float]:
+    """Embedding of a query, computed at most once per model and normalized text."""
+    return self.embed_many([query])[0]
+
+  def embed_many(self, queries: list[str]) -> list[list[float]]:
+    """Embeddings of several queries, the ones not cached yet are encoded in a single batch."""
+    normalized = [normalize_query(query) for query in queries]
+    keys = [self._key(text) for text in normalized]
+    with self._lock:
+      vectors = [self._cached(key) for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+      encoded = embed_texts([normalized[i] for i in missing]).tolist()
+      now = time.time()
+      with self._lock:
+        self.connection.executemany(
+          "insert or replace into embeddings values (?, ?, ?)",
+          [(keys[i], pack_vector(vector), now) for i, vector in zip(missing, encoded)])
+        self._trim("embeddings", self.max_embeddings)
+        for i, vector in zip(missing, encoded):
+          vectors[i] = self._remember(keys[i], vector)
+    return vectors
+
+  def query(self, embedding: list[float], n_results: int, where: dict = None) -> dict:
+    """Chroma query results for an embedding, served from the cache while the collection is unchanged."""
+    version = self.collection_version()
+    digest = hashlib.sha256(pack_vector(embedding))
+    digest.update(f"\0{n_results}\0{version}\0{json.dumps(where, sort_keys=True)}".encode())
+    key = digest.hexdigest()
+    with self._lock:
+      row = self.connection.execute("select payload from results where key = ?", (key,)).fetchone()
+      if row is not None:
+        self.connection.execute("update results set used = ? where key = ?", (time.time(), key))
+        return text_store.fill_results(json.loads(row[0]))
+
+    results = Resources.collection().query(
+      query_embeddings=[embedding],
+      n_results=n_results,
+      where=where,
+      include=["documents", "metadatas", "distances"]
+    )
+    results = {name: results[name] for name in ("ids", "documents", "metadatas", "distances")}
+    with self._lock:
+      self.connection.execute(
+        "insert or replace into results values (?, ?, ?, ?)",
+        (key, version, json.dumps(results), time.time()))
+      self._trim("results", self.max_results)
+    # the cached results hold the offsets of the chunks, their text is sliced from the text store
+    return text_store.fill_results(results)
+
+  def clear(self):
+    with self._lock:
+      self._memory.clear()
+      self.connection.execute("delete from embeddings")
+      self.connection.execute("delete from results")
+
+
+class AnswerCache(SqliteCache):
+  """
+  Semantic cache of llm answers.
+  An answer is reused when a new query embeds within `threshold` cosine similarity of an answered one
+  and the retrieved context is exactly the same.
+  """
+
+  def __init__(self, workspace: Workspace, threshold: float = Constants.answer_cache_threshold,
+               max_items: int = Constants.answer_cache_size, ttl: float = Constants.answer_cache_ttl):
+    super().__init__(workspace)
+    self.threshold = threshold
+    self.max_items = max_items
+    self.ttl = ttl
+
+  @staticmethod
+  def context_hash(context: str) -> str:
+    return hashlib.sha256(f"{Constants.model_label}\0{context}".encode()).hexdigest()
+
+  def lookup(self, embedding: list[float], context: str) -> str | None:
+    import numpy as np
+
+    with self._lock:
+      rows = self.connection.execute(
+        "select id, vector, answer from answers where context_hash = ? and created > ?",
+        (self.context_hash(context), time.time() - self.ttl)).fetchall()
+      best, best_score = None, self.threshold
+      if rows:
+        query = np.asarray(embedding, dtype=np.float32)
+        vectors = np.stack([np.frombuffer(vector, dtype=np.float32) for _, vector, _ in rows])
+        scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+        index = int(np.argmax(scores))
+        if scores[index] >= best_score:
+          best = rows[index]
+      if best is None:
+        self._increment("answer_cache_misses")
+        return None
+      self._increment("answer_cache_hits")
+      self.connection.execute("update answers set used = ? where id = ?", (time.time(), best[0]))
+      return best[2]
+
+  def store(self, query: str, embedding: list[float], context: str, answer: str):
+    now = time.time()
+    with self._lock:
+      self.connection.execute(
+        "insert into answers (context_hash, vector, query, answer, created, used) values (?, ?, ?, ?, ?, ?)",
+        (self.context_hash(context), pack_vector(embedding), query, answer, now, now))
+      self.connection.execute("delete from answers where created <= ?", (now - self.ttl,))
+      self._trim("answers", self.max_items)
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "entries": self.connection.execute("select count(*) from answers").fetchone()[0],
+        "hits": self._counter("answer_cache_hits"),
+        "misses": self._counter("answer_cache_misses"),
+      }
+
+  def clear(self):
+    with self._lock:
+      self.connection.execute("delete from answers")
+      self.connection.execute(
+        "delete from meta where key in ('answer_cache_hits', 'answer_cache_misses')")
+
+
+query_cache = PerWorkspace(QueryCache)
+answer_cache = PerWorkspace(AnswerCache)
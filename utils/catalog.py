@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import threading
+import time
+from .workspace import PerWorkspace, Workspace
+
+
+# Catalog of the loaded documents, of their chunks and of their tags, in `catalog.db`.
+# A manifest (file hash, size, mtime and ordered chunk ids) is read and written with indexed
+# lookups of its document, instead of parsing and rewriting a json file of every document.
+
+schema = """
+create table if not exists documents (
+  path text primary key, file_hash text not null, size integer not null, mtime real not null,
+  chunks integer not null, updated real not null);
+create table if not exists chunks (
+  id text not null, path text not null, position integer not null, primary key (path, position));
+create index if not exists chunks_id on chunks (id);
+create table if not exists tags (path text not null, tag text not null, primary key (path, tag));
+create index if not exists tags_tag on tags (tag);
+"""
+
+
+class Catalog:
+
+  def __init__(self, workspace: Workspace):
+    self.workspace = workspace
+    self._connection = None
+    self._lock = threading.RLock()
+
+  @property
+  def connection(self) -> sqlite3.Connection:
+    if self._connection is None:
+      with self._lock:
+        if self._connection is None:
+          self.workspace.path.mkdir(parents=True, exist_ok=True)
+          connection = sqlite3.connect(
+            self.workspace.catalog_file, check_same_thread=False, isolation_level=None, timeout=30)
+          connection.execute("pragma journal_mode=wal")
+          connection.executescript(schema)
+          self._connection = connection
+          self._migrate_metadata_file()
+    return self._connection
+
+  def _migrate_metadata_file(self):
+    """Import the manifests of the old `metadata.json`, once."""
+    legacy = self.workspace.metadata_file
+    if not legacy.exists():
+      return
+    with open(legacy, 'r') as f:
+      manifests = json.load(f)
+    # the old format only kept the chunk ids, such documents count as changed on the next load
+    self.put_many({path: {"ids": manifest.get("ids", []), "file_hash": manifest.get("file_hash", ""),
+                          "size": manifest.get("size", 0), "mtime": manifest.get("mtime", 0)}
+                   for path, manifest in manifests.items()})
+    legacy.rename(legacy.with_suffix(".json.migrated"))
+
+  def _transaction(self, work):
+    with self._lock:
+      connection = self.connection
+      connection.execute("begin immediate")
+      try:
+        result = work(connection)
+        connection.execute("commit")
+        return result
+      except BaseException:
+        connection.execute("rollback")
+        raise
+
+  def get(self, path: str) -> dict | None:
+    """Manifest of a loaded document, None when it is not loaded."""
+    with self._lock:
+      row = self.connection.execute(
+        "select file_hash, size, mtime, chunks from documents where path = ?", (path,)).fetchone()
+      if row is None:
+        return None
+      ids = [id for id, in self.connection.execute(
+        "select id from chunks where path = ? order by position", (path,))]
+    return {"chunks": row[3], "ids": ids, "file_hash": row[0], "size": row[1], "mtime": row[2]}
+
+  def stats(self) -> dict[str, dict]:
+    """Hash, size, mtime and chunk count of every document, without their chunk ids."""
+    with self._lock:
+      rows = self.connection.execute("select path, file_hash, size, mtime, chunks from documents").fetchall()
+    return {path: {"file_hash": file_hash, "size": size, "mtime": mtime, "chunks": chunks}
+            for path, file_hash, size, mtime, chunks in rows}
+
+  def paths(self) -> list[str]:
+    with self._lock:
+      return [path for path, in self.connection.execute("select path from documents order by updated")]
+
+  def tags(self, path: str) -> list[str]:
+    with self._lock:
+      return [tag for tag, in self.connection.execute("select tag from tags where path = ? order by tag", (path,))]
+
+  def add_tags(self, path: str, tags: list[str]):
+    self._transaction(lambda connection: connection.executemany(
+      "insert or ignore into tags values (?, ?)", ((path, tag) for tag in tags)))
+
+  def tagged_paths(self, tags: list[str]) -> set[str]:
+    """Documents carrying any of the given tags."""
+    with self._lock:
+      return {path for path, in self.connection.execute(
+        f"select distinct path from tags where tag in ({','.join('?' * len(tags))})", tuple(tags))}
+
+  def chunk_count(self, paths: list[str]) -> int:
+    with self._lock:
+      total = 0
+      # stay below the sqlite limit of bound parameters
+      for start in range(0, len(paths), 500):
+        part = paths[start:start + 500]
+        total += self.connection.execute(
+          f"select coalesce(sum(chunks), 0) from documents where path in ({','.join('?' * len(part))})",
+          tuple(part)).fetchone()[0]
+      return total
+
+  def contains(self, path: str) -> bool:
+    with self._lock:
+      return self.connection.execute("select 1 from documents where path = ?", (path,)).fetchone() is not None
+
+  @staticmethod
+  def _put(connection: sqlite3.Connection, path: str, manifest: dict):
+    connection.execute(
+      "insert or replace into documents values (?, ?, ?, ?, ?, ?)",
+      (path, manifest["file_hash"], manifest["size"], manifest["mtime"], len(manifest["ids"]), time.time()))
+    connection.execute("delete from chunks where path = ?", (path,))
+    connection.executemany(
+      "insert into chunks values (?, ?, ?)", ((id, path, i) for i, id in enumerate(manifest["ids"])))
+
+  def put(self, path: str, manifest: dict):
+    self._transaction(lambda connection: self._put(connection, path, manifest))
+
+  def put_many(self, manifests: dict[str, dict]):
+    """Record the manifests of many documents in one transaction."""
+    def work(connection):
+      for path, manifest in manifests.items():
+        self._put(connection, path, manifest)
+    self._transaction(work)
+
+  def touch(self, stats: dict[str, tuple[int, float]]):
+    """Refresh the size and mtime of unchanged documents."""
+    self._transaction(lambda connection: connection.executemany(
+      "update documents set size = ?, mtime = ? where path = ?",
+      ((size, mtime, path) for path, (size, mtime) in stats.items())))
+
+  def delete(self, path: str):
+    def work(connection):
+      connection.execute("delete from chunks where path = ?", (path,))
+      connection.execute("delete from tags where path = ?", (path,))
+      connection.execute("delete from documents where path = ?", (path,))
+    self._transaction(work)
+
+  def clear(self):
+    def work(connection):
+      connection.execute("delete from chunks")
+      connection.execute("delete from tags")
+      connection.execute("delete from documents")
+    self._transaction(work)
+
+
+catalog = PerWorkspace(Catalog)
@@ -0,0 +1,146 @@
+import bisect
+import re
+from typing import Iterable, Iterator
+from .constants import Constants
+
+
+# Chunks are (start, end) character offsets into the text of a document instead of copies of it.
+# The text is split in place, a chunk is only sliced out when it is embedded or stored, and its
+# offsets are kept in the chunk metadata, so that context can be rebuilt from the source.
+# A chunk holds at most `chunk_size` units (characters, or tokens of the embedding model with
+# `chunk_unit=tokens`) and ends on the strongest boundary (paragraph, line, sentence, word) of its
+# second half. The next chunk starts `overlap` units before that end, at the start of a word.
+
+chunk_units = ("characters", "tokens")
+
+# boundaries a chunk may end on, strongest first, a chunk ends where the match ends (whitespace trimmed)
+boundaries = [re.compile(pattern) for pattern in (r"\n[^\S\n]*\n", r"\n", r"[.!?][\"')\]]*\s", r"\s")]
+
+
+class CharacterMeasure:
+
+  def __init__(self, text: str):
+    self.length = len(text)
+
+  def forward(self, position: int, units: int) -> int:
+    return min(position + units, self.length)
+
+  def backward(self, position: int, units: int) -> int:
+    return max(position - units, 0)
+
+
+class TokenMeasure:
+  """Positions of the tokens of a text, from the offsets given by the tokenizer of the embedding model."""
+
+  def __init__(self, text: str, tokenizer):
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)["offset_mapping"]
+    self.starts = [start for start, _ in offsets]
+    self.ends = [end for _, end in offsets]
+    self.length = len(text)
+
+  def forward(self, position: int, units: int) -> int:
+    """Furthest position such that the text from `position` holds at most `units` tokens."""
+    last = bisect.bisect_right(self.ends, position) + units
+    return self.starts[last] if last < len(self.starts) else self.length
+
+  def backward(self, position: int, units: int) -> int:
+    first = bisect.bisect_left(self.starts, position) - units
+    return self.starts[first] if self.starts and first > 0 else 0
+
+
+class SpanTexts:
+  """Read-only sequence of the texts of spans of a text, each sliced out when it is read."""
+
+  def __init__(self, text: str, spans: list[tuple[int, int]]):
+    self.text = text
+    self.spans = spans
+
+  def __len__(self) -> int:
+    return len(self.spans)
+
+  def __getitem__(self, i: int) -> str:
+    start, end = self.spans[i]
+    return self.text[start:end]
+
+  def __iter__(self) -> Iterator[str]:
+    return (self.text[start:end] for start, end in self.spans)
+
+
+class Chunker:
+
+  def __init__(self, chunk_size: int = Constants.chunk_size, overlap: int = Constants.overlap,
+               unit: str = Constants.chunk_unit, tokenizer=None):
+    if unit not in chunk_units:
+      raise ValueError(f"Unknown chunk unit: {unit}, use one of {', '.join(chunk_units)}")
+    if not 0 <= overlap < chunk_size:
+      raise ValueError(f"The overlap ({overlap}) must be smaller than the chunk size ({chunk_size})")
+    self.chunk_size = chunk_size
+    self.overlap = overlap
+    self.unit = unit
+    self._tokenizer = tokenizer
+
+  @property
+  def tokenizer(self):
+    if self._tokenizer is None:
+      from .resources import Resources
+
+      self._tokenizer = Resources.embedding_model().tokenizer
+    return self._tokenizer
+
+  def measure(self, text: str) -> CharacterMeasure | TokenMeasure:
+    return TokenMeasure(text, self.tokenizer) if self.unit == "tokens" else CharacterMeasure(text)
+
+  @staticmethod
+  def _skip_space(text: str, position: int, end: int) -> int:
+    while position < end and text[position].isspace():
+      position += 1
+    return position
+
+  @staticmethod
+  def _snap(text: str, start: int, limit: int) -> int:
+    """End of a chunk starting at `start`, on the strongest boundary of the second half of the window."""
+    lowest = start + (limit - start) // 2
+    for pattern in boundaries:
+      found = None
+      for found in pattern.finditer(text, lowest, limit):
+        pass
+      if found is not None:
+        return found.end()
+    return limit
+
+  def split(self, text: str) -> Iterator[tuple[int, int]]:
+    """Offsets of the chunks of a text, in order, without leading or trailing whitespace."""
+    length = len(text)
+    measure = self.measure(text)
+    position = self._skip_space(text, 0, length)
+    while position < length:
+      limit = max(measure.forward(position, self.chunk_size), position + 1)
+      end = length if limit >= length else self._snap(text, position, limit)
+      while end > position and text[end - 1].isspace():
+        end -= 1
+      if end > position:
+        yield position, end
+      if limit >= length:
+        return
+      following = measure.backward(end, self.overlap) if self.overlap else end
+      # start on a word, and always move forward
+      while position < following < end and not text[following - 1].isspace():
+        following += 1
+      position = self._skip_space(text, max(following, position + 1), length)
+
+  def stream(self, blocks: Iterable[str]) -> Iterator[tuple[int, int, str]]:
+    """
+    Offsets and text of the chunks of a document given block by block (pages, parts of a file).
+    Only the last chunk of the blocks read so far is held back, it is split again with the next block,
+    so the chunks are the ones of the whole document while memory stays bounded by a block.
+    """
+    buffer, base = "", 0
+    for block in blocks:
+      buffer += block
+      spans = list(self.split(buffer))
+      for start, end in spans[:-1]:
+        yield base + start, base + end, buffer[start:end]
+      keep = spans[-1][0] if spans else len(buffer)
+      buffer, base = buffer[keep:], base + keep
+    for start, end in self.split(buffer):
+      yield base + start, base + end, buffer[start:end]
@@ -0,0 +1,80 @@
+from .index import call_func, hello
+import click
+import os
+from .crud_files import load_files, show_files, clear_context, remove_file
+from .rag import query, export_chat, answer_cache_stats
+from .daemon import ForwardingGroup, serve
+from .sync import sync
+from .faiss_index import build_index
+from .snapshot import export_index, import_index
+from .tracing import tracer, finish_profile
+from .workspace import use_workspace, validate_workspace, workspaces
+from .constants import Constants
+
+
+def select_workspace(ctx, param, value: str) -> str:
+  try:
+    return validate_workspace(value)
+  except ValueError as e:
+    raise click.BadParameter(str(e))
+
+
+@click.group(cls=ForwardingGroup)
+@click.option("--workspace", default=Constants.workspace, show_default=True, callback=select_workspace,
+              help="Workspace the command works in, each one has its own documents, caches and chats")
+@click.option("--profile", is_flag=True,
+              help="Time the stages of the command (parse, embed, retrieve, llm ...) and print a summary")
+@click.option("--trace", "trace_file", type=click.Path(dir_okay=False),
+              help="Write the spans of the command to this file, as jsonl for a `.jsonl` file and "
+                   "as a chrome trace otherwise, implies --profile")
+@click.pass_context
+def cli(ctx: click.Context, workspace: str, profile: bool, trace_file: str) -> None :
+  """
+  ####   #   #    #    ####   #   #   ####
+     #       #   #        #   ## ##   #   #
+  ####   #   #  #      ####   # # #   #####
+ #   #   #   ###      #   #   #   #   #
+ #   #   #   #  #     #   #   #   #   #   #
+  ####   #   #   #     ####   #   #   ####
+
+  Aikame is a robust RAG application brought to you as a cli tool.
+  """
+  use_workspace(workspace)
+  if profile or trace_file:
+    tracer.start("aikame", command=ctx.invoked_subcommand)
+    ctx.call_on_close(lambda: finish_profile(trace_file))
+  # click.secho("Welcome to Aikame!", fg='green')
+
+
+@cli.command()
+@click.pass_context
+def set_value(ctx):
+  """Set a value in the context."""
+  os.environ['value'] = "Hello, World!"  # Store a value in the context
+  click.echo("Value set!")
+
+
+@cli.command()
+@click.pass_context
+def get_value(ctx):
+  """Get the value from the context."""
+  value = os.getenv('value', 'No value set.')
+  click.echo(f'Value: {value}')
+
+
+cli.add_command(hello)
+cli.add_command(load_files)
+cli.add_command(show_files)
+cli.add_command(clear_context)
+cli.add_command(remove_file)
+cli.add_command(set_value)
+cli.add_command(get_value)
+cli.add_command(query)
+cli.add_command(export_chat)
+cli.add_command(answer_cache_stats)
+cli.add_command(serve)
+cli.add_command(sync)
+cli.add_command(build_index)
+cli.add_command(export_index)
+cli.add_command(import_index)
+cli.add_command(workspaces)
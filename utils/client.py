@@ -0,0 +1,129 @@
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+
+
+# Thin client of the daemon (`aikame serve`). `aikame` first tries to hand its argv over to a
+# running daemon from here, with the standard library only, and imports the click cli and its
+# command modules only when the command has to run in-process.
+# Protocol over the unix socket, one json object per line:
+#   client -> daemon: {"argv": [<str>], "cwd": <str>, "tty": <bool>}
+#   daemon -> client: {"out": <str>} | {"err": <str>} ... then {"exit": <int>}
+
+# commands that are handed over to a running daemon
+forwardable_commands = {"ask", "load_files", "show_files", "remove_file"}
+
+# options of the cli group, and whether they take a value
+group_options = {"--workspace": True, "--trace": True, "--profile": False}
+
+connect_timeout = 0.5
+
+
+def _dotenv_file() -> Path | None:
+  """The `.env` file `load_dotenv` of the constants would find, searched from their directory upwards."""
+  directory = Path(__file__).resolve().parent
+  for candidate in (directory, *directory.parents):
+    if (candidate / ".env").is_file():
+      return candidate / ".env"
+  return None
+
+
+def _settings() -> tuple[Path, str]:
+  """Socket of the daemon and default workspace, read like the constants do, without loading them when possible."""
+  if "utils.constants" in sys.modules or _dotenv_file() is not None:
+    from .constants import Constants
+
+    return Constants.daemon_socket, Constants.workspace
+  parent_path = Path(os.environ.get("parent_path", Path.home() / ".aikame-dump")).expanduser()
+  return (Path(os.environ.get("daemon_socket", parent_path / "aikame.sock")).expanduser(),
+          os.environ.get("workspace", "default"))
+
+
+def send_message(connection: socket.socket, message: dict):
+  connection.sendall((json.dumps(message) + "\n").encode())
+
+
+def needs_terminal(command: str, args: list[str]) -> bool:
+  """Interactive invocations (dedicated chat, file dialog) stay in the calling process."""
+  if command == "ask":
+    return not any(arg in ("-q", "--query", "--batch") or arg.startswith(("--query=", "--batch="))
+                   for arg in args)
+  if command == "load_files":
+    return not any(not arg.startswith("-") for arg in args)
+  return False
+
+
+def forward(argv: list[str]) -> int | None:
+  """
+  Run a cli invocation in the daemon, if one is listening.
+  Returns the exit code of the command, or None when it has to run in-process.
+  """
+  daemon_socket, _ = _settings()
+  if not daemon_socket.exists():
+    return None
+
+  try:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(connect_timeout)
+    connection.connect(str(daemon_socket))
+  except OSError:
+    # stale socket file, the daemon is gone
+    return None
+
+  with connection:
+    connection.settimeout(None)
+    send_message(connection, {
+      "argv": argv,
+      "cwd": os.getcwd(),
+      "tty": sys.stdout.isatty(),
+    })
+    for line in connection.makefile("r", encoding="utf-8"):
+      message = json.loads(line)
+      if "out" in message:
+        sys.stdout.write(message["out"])
+        sys.stdout.flush()
+      elif "err" in message:
+        sys.stderr.write(message["err"])
+        sys.stderr.flush()
+      elif "exit" in message:
+        return message["exit"]
+  # the daemon went away mid-request
+  return 1
+
+
+def split_command(argv: list[str]) -> tuple[dict[str, str | bool], str | None, list[str]] | None:
+  """Group options, command name and arguments of an argv, None when it is not a plain invocation."""
+  options, position = {}, 0
+  while position < len(argv) and argv[position].startswith("-"):
+    name, _, value = argv[position].partition("=")
+    if name not in group_options:
+      return None
+    if not group_options[name]:
+      options[name] = True
+    elif value:
+      options[name] = value
+    elif position + 1 < len(argv):
+      position += 1
+      options[name] = argv[position]
+    else:
+      return None
+    position += 1
+  if position == len(argv):
+    return options, None, []
+  return options, argv[position], argv[position + 1:]
+
+
+def try_forward(argv: list[str]) -> int | None:
+  """Exit code of the invocation run by the daemon, None when it runs in-process."""
+  parsed = split_command(argv)
+  if parsed is None:
+    return None
+  options, command, args = parsed
+  if command not in forwardable_commands or needs_terminal(command, args):
+    return None
+  # the daemon runs the command in the workspace of the caller, whatever its own default
+  if "--workspace" not in options:
+    argv = ["--workspace", _settings()[1], *argv]
+  return forward(argv)
@@ -1,8 +1,6 @@
 import os
 import json
-import chromadb
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
 '''
@@ -44,31 +42,133 @@ class Constants:
 
   # give path to the env file if required
   load_dotenv()
-  parent_path: Path = os.environ.get(
-    "parent_path", Path.home() / ".aikame-dump")
+  parent_path: Path = Path(os.environ.get(
+    "parent_path", Path.home() / ".aikame-dump")).expanduser()
+  # text of the loaded documents, chunks are offsets into it, see `utils/text_store.py`
   docs_dir: Path = parent_path / "documents"
+  # legacy json catalog, migrated into `catalog.db` on first use
   metadata_file = parent_path / "metadata.json"
+  catalog_file = parent_path / "catalog.db"
+  # rewritten whenever the collection is dropped and recreated
+  collection_generation_file = parent_path / "collection.generation"
+  # legacy single-file history, migrated into the "default" session on first use
   chat_history_file = parent_path / "chat_history.json"
-  max_history_length = os.environ.get("max_history_length", 7)
-  relevant_items = os.environ.get("relevant_items", 3)
-  chunk_size = os.environ.get("chunk_size", 256)
-  overlap = os.environ.get("overlap", 50)
+  chats_dir = parent_path / "chats"
+  cache_file = parent_path / "cache.db"
+  # named workspaces (`aikame --workspace <name>`) keep their own collection, catalog and chats
+  # in `workspaces_dir/<name>`, see `utils/workspace.py`
+  workspace = os.environ.get("workspace", "default")
+  workspaces_dir = parent_path / "workspaces"
+  daemon_socket = Path(os.environ.get(
+    "daemon_socket", parent_path / "aikame.sock")).expanduser()
+  max_history_length = int(os.environ.get("max_history_length", 7))
+  relevant_items = int(os.environ.get("relevant_items", 3))
+  # chunks hold at most `chunk_size` units and overlap by `overlap` units, a unit being
+  # a character or, with `chunk_unit=tokens`, a token of the embedding model, see `utils/chunker.py`
+  chunk_size = int(os.environ.get("chunk_size", 256))
+  overlap = int(os.environ.get("overlap", 50))
+  chunk_unit = os.environ.get("chunk_unit", "characters")
   model_label = os.environ.get("model_label", 'all-MiniLM-L6-v2')
+  # how the embedding model runs on cpu: torch, onnx or onnx-int8 (dynamically quantized onnx),
+  # onnx models are exported once under `onnx_models_dir`, see `utils/embedding_backends.py`
+  embedding_backend = os.environ.get("embedding_backend", "torch")
+  # intra-op threads of the embedding backend, 0 keeps the default of the runtime
+  embedding_threads = int(os.environ.get("embedding_threads", 0))
+  # one of arm64, avx2, avx512, avx512_vnni
+  onnx_quantization = os.environ.get("onnx_quantization", "avx512_vnni")
+  onnx_models_dir = parent_path / "onnx_models"
+
+  # query caches
+  query_cache_size = int(os.environ.get("query_cache_size", 10000))
+  results_cache_size = int(os.environ.get("results_cache_size", 10000))
+  answer_cache_enabled = os.environ.get("answer_cache", "true").lower() not in ("0", "false", "no")
+  answer_cache_threshold = float(os.environ.get("answer_cache_threshold", 0.95))
+  answer_cache_size = int(os.environ.get("answer_cache_size", 1000))
+  answer_cache_ttl = float(os.environ.get("answer_cache_ttl", 7 * 24 * 3600))
+
+  # chat sessions, appended turns are flushed to disk at most `chat_flush_interval` seconds later
+  chat_session = os.environ.get("chat_session", "default")
+  chat_flush_interval = float(os.environ.get("chat_flush_interval", 1.0))
+
+  # retrieval from the chroma collection, or from the consolidated faiss index (see `build_index`)
+  retrieval_backend = os.environ.get("retrieval_backend", "chroma")
+  faiss_dir = parent_path / "faiss"
+  faiss_index_kind = os.environ.get("faiss_index_kind", "flat")
+  # number of ivf lists, 0 picks one from the number of vectors
+  faiss_nlist = int(os.environ.get("faiss_nlist", 0))
+  faiss_nprobe = int(os.environ.get("faiss_nprobe", 8))
+  faiss_hnsw_m = int(os.environ.get("faiss_hnsw_m", 32))
+  faiss_ef_search = int(os.environ.get("faiss_ef_search", 64))
+  # vector codes of the index, "none" (float32), "fp16", "int8" or "pq" (product quantization).
+  # Compressed indexes fetch `faiss_rescore_factor` times more candidates and rescore them
+  # against the float32 vectors kept in a memory-mapped side file.
+  faiss_compression = os.environ.get("faiss_compression", "none")
+  # bytes per vector of the pq codes, 0 picks a quarter of the dimension
+  faiss_pq_m = int(os.environ.get("faiss_pq_m", 0))
+  faiss_rescore_factor = int(os.environ.get("faiss_rescore_factor", 4))
+
+  # hybrid retrieval, the vector results are fused with a bm25 index of the chunks (`lexical.db`)
+  hybrid_retrieval = os.environ.get("hybrid_retrieval", "true").lower() not in ("0", "false", "no")
+  lexical_file = parent_path / "lexical.db"
+  rrf_k = int(os.environ.get("rrf_k", 60))
+  bm25_k1 = float(os.environ.get("bm25_k1", 1.2))
+  bm25_b = float(os.environ.get("bm25_b", 0.75))
+  # terms found in more than this share of the chunks are ignored
+  lexical_max_df = float(os.environ.get("lexical_max_df", 0.25))
+  # postings scored per query term, the ones with the highest term frequency
+  lexical_max_postings = int(os.environ.get("lexical_max_postings", 1000))
+
+  # queries scoped to sources or tags scan a precomputed partition of the scope
+  # (exact search over its vectors) once the scope holds at least `partition_min_chunks` chunks
+  partitions_dir = parent_path / "partitions"
+  partition_min_chunks = int(os.environ.get("partition_min_chunks", 5000))
+
+  # context assembly, the retrieved candidates are merged and packed into the token budget
+  context_token_budget = int(os.environ.get("context_token_budget", 1500))
+  context_candidates = int(os.environ.get("context_candidates", 8))
+  context_duplicate_threshold = float(os.environ.get("context_duplicate_threshold", 0.8))
+
+  # batch question answering, rate in llm requests per second (0 for no limit)
+  batch_concurrency = int(os.environ.get("batch_concurrency", 4))
+  batch_rate = float(os.environ.get("batch_rate", 0))
+
+  # ingestion pipeline
+  ingest_workers = int(os.environ.get("ingest_workers", min(4, os.cpu_count() or 1)))
+  embed_batch_size = int(os.environ.get("embed_batch_size", 512))
+  # texts are encoded in batches of similar token length, each at most `embed_token_budget`
+  # tokens once padded to its longest text, at most `embed_max_batch` texts and at most
+  # `embed_max_padding` of padding
+  embed_token_budget = int(os.environ.get("embed_token_budget", 8192))
+  embed_max_batch = int(os.environ.get("embed_max_batch", 256))
+  embed_max_padding = float(os.environ.get("embed_max_padding", 0.05))
+  write_batch_size = int(os.environ.get("write_batch_size", 1000))
+  # documents at least this large are ingested page by page
+  stream_threshold_mb = float(os.environ.get("stream_threshold_mb", 20))
+  stream_window = int(os.environ.get("stream_window", 256))
 
   # models
   gpt_model = os.environ.get("llm_model", "gpt-3.5-turbo")
   gemini_model = os.environ.get("gemini_model", "gemini-2.0-flash")
-  anthropic_model = os.environ.get("anthropic_model", "claude-v1")
+  anthropic_model = os.environ.get("anthropic_model", "claude-3-5-haiku-latest")
+
+  # llm provider layer, one of "gemini", "claude", "openai" or "fake" (offline, for tests and benchmarks)
+  llm_provider = os.environ.get("llm_provider", "gemini")
+  llm_concurrency = int(os.environ.get("llm_concurrency", 4))
+  # seconds to wait for the first token of an answer, then between two tokens
+  llm_timeout = float(os.environ.get("llm_timeout", 60))
+  llm_max_retries = int(os.environ.get("llm_max_retries", 3))
+  llm_backoff = float(os.environ.get("llm_backoff", 0.5))
+  llm_max_tokens = int(os.environ.get("llm_max_tokens", 1024))
+  fake_llm_first_token_delay = float(os.environ.get("fake_llm_first_token_delay", 0.05))
+  fake_llm_token_delay = float(os.environ.get("fake_llm_token_delay", 0.005))
 
   # api keys
   gpt_api_key = os.environ.get("llm_api_key")
   gemini_api_key = os.environ.get("gemini_api_key")
   anthropic_api_key = os.environ.get("anthropic_api_key")
 
-  embedding_model = SentenceTransformer(model_label)
-
-  local_db = chromadb.PersistentClient(path=str(parent_path / "chromadb"))
-  collection = local_db.get_or_create_collection("documents-testing")
+  # the embedding model and the chromadb collection are built lazily, see `utils/resources.py`
+  collection_name = "documents-testing"
 
   prompt_template = """Dont give the response in markdown format.
   Use the added context to answer all the questions given to you. If you don't know the answer, just say that you don't know, don't try to make up an answer. 
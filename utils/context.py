@@ -0,0 +1,148 @@
+import math
+import re
+from dataclasses import dataclass, field
+from .constants import Constants
+from .resources import Resources
+
+
+# Retrieved chunks overlap by `overlap` characters with their neighbours and often come from
+# the same part of a document. Before they are sent to the model, adjacent chunks of a source are
+# merged back into spans (exactly, from their offsets in the document, when they have them),
+# near-duplicate spans are dropped and the best spans are packed into a token budget,
+# so the prompt stays small without losing what was retrieved.
+
+word_pattern = re.compile(r"\w+")
+
+
+def candidate_count() -> int:
+  """Number of chunks retrieved per query, the assembler decides how many of them fit."""
+  return max(Constants.relevant_items, Constants.context_candidates)
+
+
+def estimate_tokens(text: str) -> int:
+  """
+  Token count of a text with the tokenizer of the embedding model once it is loaded,
+  about 4 characters per token (english prose) before that.
+  """
+  if Resources.is_loaded("embedding_model"):
+    try:
+      return len(Resources.embedding_model().tokenizer(text, add_special_tokens=False, verbose=False)["input_ids"])
+    except RuntimeError:
+      # the tokenizer is busy in another thread (rust tokenizers are not reentrant)
+      pass
+  return math.ceil(len(text) / 4)
+
+
+@dataclass
+class Span:
+  source: str
+  first_index: int
+  last_index: int
+  text: str
+  # best (lowest) distance of the merged chunks
+  distance: float
+  ids: list[str] = field(default_factory=list)
+  # offsets of the span in the text of the document, unknown for chunks loaded before they were recorded
+  start: int | None = None
+  end: int | None = None
+
+
+def overlap_length(left: str, right: str, max_overlap: int) -> int:
+  """Length of the longest suffix of `left` that is also a prefix of `right`."""
+  for k in range(min(len(left), len(right), max_overlap), 0, -1):
+    if left.endswith(right[:k]):
+      return k
+  return 0
+
+
+def merge_chunks(ids: list[str], documents: list[str], metadatas: list[dict],
+                 distances: list[float]) -> list[Span]:
+  """Merge the chunks of each source whose chunk indices follow each other into spans."""
+  max_overlap = 2 * Constants.overlap
+  chunks = sorted(
+    zip(ids, documents, metadatas, distances),
+    key=lambda chunk: (chunk[2].get("source", ""), chunk[2].get("chunk_index", -1)))
+  spans: list[Span] = []
+  for chunk_id, text, metadata, distance in chunks:
+    source, index = metadata.get("source", ""), metadata.get("chunk_index")
+    last = spans[-1] if spans else None
+    if (last is not None and index is not None and last.source == source
+        and last.last_index is not None and index <= last.last_index + 1):
+      if index > last.last_index:
+        start, end = metadata.get("start"), metadata.get("end")
+        if last.end is not None and start is not None and start <= last.end:
+          last.text += text[last.end - start:]
+        else:
+          k = overlap_length(last.text, text, max_overlap)
+          last.text += text[k:] if k else "\n" + text
+        last.last_index = index
+        last.end = end
+      last.distance = min(last.distance, distance)
+      last.ids.append(chunk_id)
+      continue
+    spans.append(Span(source, index, index, text, distance, [chunk_id], metadata.get("start"), metadata.get("end")))
+  return spans
+
+
+def shingles(text: str, size: int = 5) -> set[tuple]:
+  words = word_pattern.findall(text.lower())
+  if len(words) < size:
+    return {tuple(words)}
+  return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def drop_near_duplicates(spans: list[Span], threshold: float) -> list[Span]:
+  """Keep the best of every group of spans whose word shingles mostly coincide."""
+  kept: list[tuple[Span, set]] = []
+  for span in sorted(spans, key=lambda span: span.distance):
+    signature = shingles(span.text)
+    duplicate = False
+    for _, other in kept:
+      common = len(signature & other)
+      # a span contained in a kept one is a duplicate as well
+      if common and common / min(len(signature), len(other)) >= threshold:
+        duplicate = True
+        break
+    if not duplicate:
+      kept.append((span, signature))
+  return [span for span, _ in kept]
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+  """The longest prefix of a text within `budget` tokens, as counted by `estimate_tokens`."""
+  low, high = 0, len(text)
+  while low < high:
+    middle = (low + high + 1) // 2
+    if estimate_tokens(text[:middle]) <= budget:
+      low = middle
+    else:
+      high = middle - 1
+  return text[:low]
+
+
+def pack_spans(spans: list[Span], budget: int) -> list[Span]:
+  """Greedily pack the best spans into `budget` tokens, cutting the first one if it alone is too long."""
+  packed, used = [], 0
+  for span in sorted(spans, key=lambda span: span.distance):
+    tokens = estimate_tokens(span.text)
+    if used + tokens <= budget:
+      packed.append(span)
+      used += tokens
+    elif not packed:
+      span.text = truncate_tokens(span.text, budget)
+      if span.start is not None:
+        span.end = span.start + len(span.text)
+      packed.append(span)
+      used = estimate_tokens(span.text)
+  return packed
+
+
+def assemble_context(ids: list[str], documents: list[str], metadatas: list[dict], distances: list[float],
+                     budget: int = Constants.context_token_budget) -> str:
+  """The context sent to the model for the chunks retrieved for one query."""
+  if distances is None:
+    # keep the retrieval order when no distance was returned
+    distances = list(range(len(documents)))
+  spans = merge_chunks(ids, documents, metadatas, distances)
+  spans = drop_near_duplicates(spans, Constants.context_duplicate_threshold)
+  return "\n\n".join(span.text for span in pack_spans(spans, budget))
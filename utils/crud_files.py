@@ -1,22 +1,26 @@
 import click
 import os
-import PyPDF2
 import json
+import hashlib
 from datetime import datetime
-from .embeddings import embeddings_wrapper
+from .embeddings import embeddings_wrapper, embed_texts
 from .index import timing_decorator, get_embeddings_path_from_key
 from .constants import Constants
+from .resources import Resources
+from .cache import query_cache
+from .lexical import lexical_index
+from .catalog import catalog
+from .scope import tag_metadata, validate_tags
 from .rag import Chat
+from .tracing import tracer
+from .chunker import Chunker, SpanTexts
+from .text_store import text_store, text_version
 from .exceptions import *
 import shutil
 import fileinput
 from uuid import uuid4 as uuid
 from pathlib import Path
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders.text import TextLoader
-from langchain_community.document_loaders.pdf import PyPDFLoader
-import tkinter as tk
-from tkinter import filedialog
+from typing import Iterator
 
 
 text_suffix = ".txt"
@@ -24,84 +28,225 @@ pdf_suffix = ".pdf"
 
 acceptable_file_types = [text_suffix, pdf_suffix]
 
+# size hint of a block read from a text file while streaming
+stream_block_size = 1 << 16
+# between the pages of a pdf in the text of the document
+page_separator = "\n\n"
+
+
+def file_digest(file_path: Path) -> str:
+  """Hash of the raw file contents, used to detect unchanged documents."""
+  digest = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def chunk_id(source: str, text: str) -> str:
+  """Content derived chunk id, stable across re-loads and unique across documents."""
+  return hashlib.sha256(f"{source}\0{text}".encode()).hexdigest()[:32]
+
+
+def identify_chunks(source: str, text: str, spans: list[tuple[int, int]]) -> tuple[list[str], list[tuple[int, int]]]:
+  """Return the ids and offsets of the chunks of a text, dropping repeated chunks of the document."""
+  ids, unique_spans, seen = [], [], set()
+  for start, end in spans:
+    id = chunk_id(source, text[start:end])
+    if id in seen:
+      continue
+    seen.add(id)
+    ids.append(id)
+    unique_spans.append((start, end))
+  return ids, unique_spans
+
 
 class DocumentStore:
 
   def __init__(self):
     self._init_directories()
-    self.embedding_model = Constants.embedding_model
+
+  @property
+  def embedding_model(self):
+    return Resources.embedding_model()
 
   def _init_directories(self):
     """Initialize necessary directories and files."""
     Constants.parent_path.mkdir(exist_ok=True)
-    Constants.docs_dir.mkdir(exist_ok=True)
-
-    if not Constants.metadata_file.exists():
-      self._save_metadata({})
-
-  def _save_metadata(self, metadata: dict):
-    """Save metadata to file."""
-    with open(Constants.metadata_file, 'w') as f:
-      json.dump(metadata, f)
 
-  def _load_metadata(self) -> dict:
-    """Load metadata from file."""
-    if Constants.metadata_file.exists():
-      with open(Constants.metadata_file, 'r') as f:
-        return json.load(f)
-    return {}
-
-  def _process_document(self, file_path: Path):
-    """Process a document and return chunks."""
+  def _process_document(self, file_path: Path) -> tuple[str, list[tuple[int, int]]]:
+    """Text of a document and the offsets of its chunks."""
+    with tracer.span("parse", path=str(file_path)) as span:
+      text = "".join(self._iter_pages(file_path)[1])
+      span.count(bytes=len(text.encode()))
+    with tracer.span("split", path=str(file_path)) as span:
+      spans = list(Chunker().split(text))
+      span.count(chunks=len(spans))
+    return text, spans
+
+  def _iter_pages(self, file_path: Path) -> tuple[int | None, Iterator[str]]:
+    """
+    Lazily yield the text of a document page by page (blocks of lines for text files).
+    The text of a document, which chunk offsets point into, is the concatenation of its pages.
+    """
     if file_path.suffix.lower() not in acceptable_file_types:
       raise ValueError(f"Unsupported file type: {file_path.suffix.lower()}")
     if file_path.suffix.lower() == pdf_suffix:
-      loader = PyPDFLoader(str(file_path))
-    else:
-      loader = TextLoader(str(file_path))
-
-    documents = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=Constants.chunk_size,
-                    chunk_overlap=Constants.overlap
-    )
-    return text_splitter.split_documents(documents)
-
-  def add_document(self, file_path: Path):
-    """Add a document to the system."""
+      import pypdf
+
+      reader = pypdf.PdfReader(str(file_path))
+      return len(reader.pages), ((page.extract_text() or "") + page_separator for page in reader.pages)
+
+    def text_blocks():
+      with open(file_path, 'r') as f:
+        while True:
+          block = "".join(f.readlines(stream_block_size))
+          if not block:
+            return
+          yield block
+    return None, text_blocks()
+
+  def _stream_chunks(self, file_path: Path, writer=None) -> Iterator[tuple[int, int, str]]:
+    """
+    Split a document page by page without materializing it, yields the offsets and text of the chunks.
+    Chunks span page boundaries with the same overlap as within a page.
+    The pages are also given to `writer`, to store the text of the document.
+    """
+    total, pages = self._iter_pages(file_path)
+
+    def counted_pages():
+      for page_number, page in enumerate(pages, start=1):
+        if writer is not None:
+          writer.write(page)
+        yield page
+        label = f"Page {page_number}/{total}" if total else f"Block {page_number}"
+        click.echo(f"\r{label} processed", nl=False)
+      click.echo()
+    yield from Chunker().stream(counted_pages())
+
+  def _write_chunks(self, source: str, ids: list[str], texts: SpanTexts | list[str], spans: list[tuple[int, int]],
+                    first_index: int, known_ids: set[str], version: str, tags: list[str] = ()) -> int:
+    """
+    Embed and upsert the chunks missing from the store, refresh the position (and tags) of the others.
+    The chunks keep offsets into the `version` text of the document in the text store, not their text.
+    """
+    metadatas = [{"source": source, "chunk_index": first_index + i, "start": start, "end": end, "text": version,
+                  **tag_metadata(tags)}
+                 for i, (start, end) in enumerate(spans)]
+    new = [i for i, id in enumerate(ids) if id not in known_ids]
+    kept = [i for i, id in enumerate(ids) if id in known_ids]
+
+    if new:
+      # Generate embeddings only for the new chunks and add them to ChromaDB
+      with tracer.span("embed") as span:
+        embeddings = embed_texts([texts[i] for i in new], self.embedding_model).tolist()
+        span.count(chunks=len(new))
+      with tracer.span("upsert") as span:
+        Resources.collection().upsert(
+                embeddings=embeddings,
+                ids=[ids[i] for i in new],
+                metadatas=[metadatas[i] for i in new]
+        )
+        lexical_index.add([ids[i] for i in new], [texts[i] for i in new])
+        span.count(chunks=len(new), bytes=sum(len(texts[i].encode()) for i in new))
+    if kept:
+      # unchanged chunks may have moved within the document, or to a new version of its text
+      Resources.collection().update(
+              ids=[ids[i] for i in kept],
+              metadatas=[metadatas[i] for i in kept]
+      )
+    return len(new)
+
+  def get_manifest(self, file_path: Path) -> dict | None:
+    """Manifest (file hash, size, mtime and chunk ids) of a loaded document."""
+    return catalog.get(str(file_path))
+
+  def put_manifest(self, file_path: Path, manifest: dict):
+    catalog.put(str(file_path), manifest)
+
+  def should_stream(self, file_path: Path) -> bool:
+    """Whether a document is large enough to be ingested page by page."""
+    return file_path.stat().st_size >= Constants.stream_threshold_mb * (1 << 20)
+
+  def add_document(self, file_path: Path, stream: bool = False, tags: list[str] = ()):
+    """
+    Add a document to the system.
+    Re-loading a document only embeds the chunks that are new and removes the ones that disappeared.
+    With `stream`, the document is read page by page and embedded in fixed size windows,
+    so memory stays flat regardless of the size of the document.
+    Tags are added to the ones the document already has.
+    """
     try:
-      # Process document into chunks
-      chunks = self._process_document(file_path)
-      click.secho(f"Document processed into {len(chunks)} chunks.", fg="green")
-
-      # Generate embeddings and add to ChromaDB
-      texts = [chunk.page_content for chunk in chunks]
-      embeddings = self.embedding_model.encode(texts).tolist()
+      source = str(file_path)
+      stat = file_path.stat()
+      digest = file_digest(file_path)
+      manifest = self.get_manifest(file_path)
+      known_tags = catalog.tags(source) if manifest is not None else []
+      tags = sorted(set(tags).union(known_tags))
+      if manifest is not None and manifest.get("file_hash") == digest:
+        click.secho(f"Document unchanged, skipping: {file_path}", fg="green")
+        if (manifest.get("size"), manifest.get("mtime")) != (stat.st_size, stat.st_mtime):
+          # touched but not modified, remember the new stat so that it is not hashed again
+          catalog.touch({source: (stat.st_size, stat.st_mtime)})
+        if set(tags) != set(known_tags):
+          self.tag_document(source, manifest["ids"], tags)
+        return
+      known_ids = set(manifest["ids"]) if manifest is not None else set()
+      version = text_version(digest)
+
+      if stream:
+        ids, seen, added = [], set(), 0
+        window_ids, window_texts, window_spans = [], [], []
+
+        def flush_window():
+          nonlocal added
+          added += self._write_chunks(
+            source, window_ids, window_texts, window_spans, len(ids) - len(window_ids), known_ids, version, tags)
+          window_ids.clear()
+          window_texts.clear()
+          window_spans.clear()
+
+        with text_store.writer(source, version) as writer:
+          for start, end, text in self._stream_chunks(file_path, writer):
+            id = chunk_id(source, text)
+            if id in seen:
+              continue
+            seen.add(id)
+            ids.append(id)
+            window_ids.append(id)
+            window_texts.append(text)
+            window_spans.append((start, end))
+            if len(window_ids) >= Constants.stream_window:
+              flush_window()
+          flush_window()
+      else:
+        # Process document into chunks
+        text, spans = self._process_document(file_path)
+        # repeated chunks are dropped first, so the count matches the one of the pipeline
+        ids, spans = identify_chunks(source, text, spans)
+        click.secho(f"Document processed into {len(ids)} chunks.", fg="green")
+        text_store.write(source, version, text)
+        added = self._write_chunks(source, ids, SpanTexts(text, spans), spans, 0, known_ids, version, tags)
+
+      stale_ids = list(known_ids.difference(ids))
+      if stale_ids:
+        Resources.collection().delete(ids=stale_ids)
+        lexical_index.remove(stale_ids)
+      query_cache.bump_version()
       click.secho(
-        f"Embeddings generated for {len(chunks)} chunks.", fg="green")
-
-      # Generate IDs for chunks
-      doc_id = str(file_path.stem)
-      ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
-
-      click.secho(f"IDs generated for chunks: \n{ids}\n", fg="green")
-
-      # Add to ChromaDB
-      Constants.collection.add(
-              embeddings=embeddings,
-              documents=texts,
-              ids=ids,
-              metadatas=[{"source": str(file_path)} for _ in chunks]
-      )
+        f"{added} new, {len(ids) - added} unchanged and {len(stale_ids)} removed chunks.", fg="green")
       click.secho(f"Chunks added in local, for persistence.", fg="green")
 
       # Update metadata
-      metadata = self._load_metadata()
-      metadata[str(file_path)] = {
-                      "chunks": len(chunks),
-                      "ids": ids
-      }
-      self._save_metadata(metadata)
+      self.put_manifest(file_path, {
+                      "chunks": len(ids),
+                      "ids": ids,
+                      "file_hash": digest,
+                      "size": stat.st_size,
+                      "mtime": stat.st_mtime
+      })
+      catalog.add_tags(source, tags)
+      text_store.prune(source, keep=version)
       click.secho(f"Metadata updated for document: {file_path}", fg="green")
 
     except ValueError as e:
@@ -112,74 +257,64 @@ class DocumentStore:
       raise DocumentProcessingError(
         f"Error processing document {file_path}: {str(e)}")
 
+  def tag_document(self, source: str, ids: list[str], tags: list[str]):
+    """Add tags to every chunk of an already loaded document."""
+    Resources.collection().update(ids=ids, metadatas=[tag_metadata(tags)] * len(ids))
+    catalog.add_tags(source, tags)
+    query_cache.bump_version()
+    click.secho(f"Document tagged with {', '.join(tags)}: {source}", fg="green")
+
   def delete_document(self, file_path: Path):
-    """Delete a specific document."""
-    metadata = self._load_metadata()
-    if str(file_path) not in metadata:
+    """Delete a specific document, all its chunks in one request."""
+    manifest = catalog.get(str(file_path))
+    if manifest is None:
       raise FileNotFoundError(f"Document with path: {file_path}, not found.")
-    for chunk_id in metadata[str(file_path)]["ids"]:
-      Constants.collection.delete(ids=[chunk_id])
+    Resources.collection().delete(where={"source": str(file_path)})
+    lexical_index.remove(manifest["ids"])
+    text_store.delete(str(file_path))
+    query_cache.bump_version()
     click.secho(
       f"Document with path: {file_path}, has been removed.", fg="green")
 
-    del metadata[str(file_path)]
-    self._save_metadata(metadata)
+    catalog.delete(str(file_path))
     click.secho(
       f"Metadata for document with path: {file_path}, has been removed.", fg="green")
 
   def delete_all(self):
-    """Delete all documents."""
-    Constants.collection.delete(ids=Constants.collection.get()["ids"])
-    self._save_metadata({})
+    """Delete all documents, dropping and recreating the collection."""
+    Resources.reset_collection()
+    lexical_index.clear()
+    text_store.clear()
+    query_cache.bump_version()
+    catalog.clear()
     Chat.clear_chat()
 
   def query(self, question: str, k: int = 3) -> str:
-    """Query the system."""
+    """The context retrieved for a question: the texts of its `k` nearest chunks."""
     try:
-      # Generate embedding for the question
-      question_embedding = self.embedding_model.encode(question).tolist()
-
-      # Query ChromaDB
-      results = Constants.collection.query(
-                      query_embeddings=[question_embedding],
-                      n_results=k
-      )
-
-      if not results["documents"][0]:
-        return "I don't have enough context to answer your question."
-
-      # Prepare context for OpenAI
-      context = "\n".join(results["documents"][0])
-
-      # Query OpenAI
-      # response = openai.ChatCompletion.create(
-      #                 model="gpt-3.5-turbo",
-      #                 messages=[
-      #                                 {"role": "system", "content": "You are a helpful assistant. Answer the question based on the provided context."},
-      #                                 {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"}])
-
-      # return response.choices[0].message.content
-
+      # the embedding and the results are cached, the texts of the chunks come from the text store
+      results = query_cache.query(query_cache.embed(question), k)
     except Exception as e:
       raise QueryProcessingError(f"Error processing query: {str(e)}")
+    if not results["documents"][0]:
+      return "I don't have enough context to answer your question."
+    return "\n".join(results["documents"][0])
 
   def list_documents(self) -> list[str]:
     """List all documents in the system."""
-    metadata = self._load_metadata()
-    return list(metadata.keys())
+    return catalog.paths()
 
 
 documentStore = DocumentStore()
 
 
 def parse_and_extract_text(file_path: str) -> str:
+  import PyPDF2
+
   click.echo(f"Parsing and extracting text from pdf: {file_path}")
   pdf_file = open(file_path, "rb")
   pdf_reader = PyPDF2.PdfReader(pdf_file)
-  text = ""
-  for page in pdf_reader.pages:
-    # page = pdf_reader.getPage(page_num)
-    text += page.extract_text()
+  text = "".join(page.extract_text() for page in pdf_reader.pages)
   pdf_file.close()
   return text
 
@@ -216,10 +351,43 @@ def create_chunks(text: str, chunk_size: int) -> list[str]:
   Create chunks of text from a given text of a specified size.
   """
   click.secho(f"Creating chunks of text...", bg="green")
-  return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+  return list(SpanTexts(text, list(Chunker(chunk_size, 0).split(text))))
+
+
+def ingest_files(file_paths: list[Path], workers: int = Constants.ingest_workers,
+                 stream: bool = False, tags: list[str] = ()) -> int:
+  """
+  Add or refresh the given documents, returns how many were ingested.
+  Several files go through the parallel pipeline, large ones are streamed page by page.
+  """
+  files_added = 0
+  streamed = [file_path for file_path in file_paths
+              if stream or (file_path.is_file() and documentStore.should_stream(file_path))]
+  batched = [file_path for file_path in file_paths if file_path not in streamed]
+
+  if len(batched) > 1:
+    from .ingest import IngestionPipeline
+
+    pipeline = IngestionPipeline(workers=workers, tags=tags)
+    files_added += pipeline.run(batched)
+    click.secho(
+      f"Pipeline loaded: {files_added}, unchanged: {pipeline.skipped}, failed: {len(pipeline.failed)}", fg="green")
+    batched = []
+
+  for file_path in batched + streamed:
+    try:
+      click.secho(f"Loading file: {file_path.name}", fg="yellow")
+      documentStore.add_document(file_path, stream=file_path in streamed, tags=tags)
+      files_added += 1
+    except (DocumentProcessingError, RelativePathError, ValueError, IsADirectoryError, PermissionError, IOError, FileNotFoundError) as e:
+      click.secho(e, fg="red")
+  return files_added
 
 
 def file_selector() -> list[Path]:
+  import tkinter as tk
+  from tkinter import filedialog
+
   root = tk.Tk()
   root.withdraw()  # Hide the main window
 
@@ -236,16 +404,28 @@ def file_selector() -> list[Path]:
 
 @click.command(name="load_files")
 @click.argument("file_paths", nargs=-1)
+@click.option("--workers", "-w", type=int, default=Constants.ingest_workers, show_default=True,
+              help="Parallel parsing processes used when loading several files")
+@click.option("--stream", is_flag=True,
+              help="Ingest every file page by page with bounded memory (automatic for large files)")
+@click.option("--tag", "-t", "tags", multiple=True,
+              help="Tag the loaded files, `ask --tag` then searches only the files with that tag (repeatable)")
 @click.pass_context
 @timing_decorator
-def load_files(ctx: click.Context, file_paths: tuple[str, ...]) -> list:
+def load_files(ctx: click.Context, file_paths: tuple[str, ...], workers: int, stream: bool,
+               tags: tuple[str, ...]) -> list:
   """
   Load files from a list of (absolute) file paths. \n
   At the moment, this command only reads text files and pdfs and will throw errors for any other file type.
+  Several files are parsed, embedded and written in a parallel pipeline,
+  files larger than `stream_threshold_mb` are streamed page by page.
   """
 
+  try:
+    tags = validate_tags(tags)
+  except ValueError as e:
+    raise click.BadParameter(str(e))
   click.secho(f"Loading all files for context ...", bg="green")
-  files_added = 0
   if len(file_paths) == 0:
     file_paths = file_selector()
     click.secho(f"Files selected: {file_paths}", fg="yellow")
@@ -259,17 +439,7 @@ def load_files(ctx: click.Context, file_paths: tuple[str, ...]) -> list:
       raise ValueError(
         f"Unsupported file type: {file_path_obj.suffix.lower()}, no files loaded.")
 
-  for file_path_obj in file_path_objs:
-    try:
-      click.secho(f"Loading file: {file_path_obj.name}", fg="yellow")
-      # chunks = textSplitter.split_documents(
-      #   load_util(file_path), chunk_size=chunk_size)
-      # embeddings_wrapper(chunks, file_path, f"{uuid()}.index")
-      documentStore.add_document(file_path_obj)
-      files_added += 1
-    except (RelativePathError, ValueError, IsADirectoryError, PermissionError, IOError, FileNotFoundError) as e:
-      click.secho(e, fg="red")
-      return None
+  files_added = ingest_files(file_path_objs, workers=workers, stream=stream, tags=tags)
   click.secho(f"Files loaded: {files_added}", fg="green")
 
 
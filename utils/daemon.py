@@ -0,0 +1,156 @@
+import click
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from contextlib import redirect_stdout, redirect_stderr
+from .constants import Constants
+from .resources import Resources
+from .client import forward, forwardable_commands, needs_terminal, send_message
+
+
+# set inside the daemon, so that the commands it runs are not forwarded again
+serving = False
+
+
+class SocketWriter(io.TextIOBase):
+  """Text stream that relays everything written to it to the connected client."""
+  encoding = "utf-8"
+  errors = "strict"
+
+  def __init__(self, connection: socket.socket, stream: str, tty: bool):
+    self.connection = connection
+    self.stream = stream
+    self.tty = tty
+
+  def write(self, s: str) -> int:
+    if not isinstance(s, str):
+      raise TypeError("SocketWriter only accepts text")
+    if s:
+      send_message(self.connection, {self.stream: s})
+    return len(s)
+
+  def isatty(self) -> bool:
+    return self.tty
+
+  def writable(self) -> bool:
+    return True
+
+
+class ForwardingGroup(click.Group):
+  """Command group that hands forwardable subcommands over to a running daemon."""
+
+  def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+    ctx.meta["aikame.argv"] = list(args)
+    return super().parse_args(ctx, args)
+
+  def resolve_command(self, ctx: click.Context, args: list[str]):
+    name, command, args = super().resolve_command(ctx, args)
+    if not serving and not ctx.resilient_parsing and name in forwardable_commands and not needs_terminal(name, args):
+      # the daemon runs the command in the workspace of the caller, whatever its own default
+      argv = ctx.meta["aikame.argv"]
+      if "workspace" in ctx.params:
+        argv = ["--workspace", ctx.params["workspace"], *argv]
+      exit_code = forward(argv)
+      if exit_code is not None:
+        ctx.exit(exit_code)
+    return name, command, args
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    request = json.loads(self.rfile.readline())
+    tty = request.get("tty", False)
+    out = SocketWriter(self.connection, "out", tty)
+    err = SocketWriter(self.connection, "err", tty)
+
+    # stdout, stderr and the working directory are process wide,
+    # so requests are served one at a time
+    with self.server.lock, redirect_stdout(out), redirect_stderr(err):
+      cwd = os.getcwd()
+      try:
+        os.chdir(request.get("cwd", cwd))
+        exit_code = self.server.run(request["argv"])
+      finally:
+        os.chdir(cwd)
+    send_message(self.connection, {"exit": exit_code})
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, cli: click.Group):
+    self.cli = cli
+    self.lock = threading.Lock()
+    super().__init__(str(Constants.daemon_socket), RequestHandler)
+
+  def run(self, argv: list[str]) -> int:
+    try:
+      rv = self.cli.main(args=argv, prog_name="aikame", standalone_mode=False)
+      return rv if isinstance(rv, int) else 0
+    except click.ClickException as e:
+      e.show()
+      return e.exit_code
+    except click.Abort:
+      click.echo("Aborted!", err=True)
+      return 1
+    except Exception as e:
+      click.secho(f"Error: {e}", fg="red", err=True)
+      return 1
+
+
+def warm_up():
+  """Build everything a request would otherwise pay for on its first call."""
+  from .rag import chat_instance
+
+  Resources.embedding_model()
+  Resources.collection()
+  chat_instance.provider
+
+
+@click.command(name="serve")
+@click.pass_context
+def serve(ctx: click.Context) -> None:
+  """
+  Run aikame as a resident daemon. \n
+  While it is running, `ask -q`, `load_files`, `show_files` and `remove_file` are served
+  by the daemon over a local socket, reusing the loaded model, collection and llm client.
+  """
+  global serving
+
+  socket_path = Constants.daemon_socket
+  if socket_path.exists():
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(str(socket_path))
+      click.secho(f"A daemon is already listening on {socket_path}", fg="red")
+      return None
+    except OSError:
+      socket_path.unlink()
+    finally:
+      probe.close()
+
+  Constants.parent_path.mkdir(exist_ok=True)
+  click.secho("Loading the embedding model, collection and llm client...", fg="yellow")
+  warm_up()
+
+  serving = True
+  # the socket is created by the bind, only the user may connect to it from the start
+  umask = os.umask(0o177)
+  try:
+    server = DaemonServer(ctx.find_root().command)
+  finally:
+    os.umask(umask)
+  click.secho(f"Aikame daemon listening on {socket_path}, press Ctrl+C to stop.", fg="green")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    click.secho("\nStopping the daemon...", fg="yellow")
+  finally:
+    server.server_close()
+    socket_path.unlink(missing_ok=True)
+    serving = False
@@ -0,0 +1,103 @@
+import click
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from .constants import Constants
+
+
+# The embedding model runs on torch (the default) or on onnx runtime, optionally with its
+# weights dynamically quantized to int8, which is faster on cpu only hosts.
+# The onnx model is exported from `model_label` once, under `onnx_models_dir`, later loads only read it.
+# Onnx vectors match the torch ones up to rounding, int8 ones up to a small loss
+# (see `benchmarks/embeddings.py`), a collection is best queried with the backend that loaded it.
+
+embedding_backends = ("torch", "onnx", "onnx-int8")
+quantization_configs = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+def model_key(label: str = None, backend: str = None) -> str:
+  """Identity of the vectors of a model, the label alone for the torch backend."""
+  label = label or Constants.model_label
+  backend = backend or Constants.embedding_backend
+  return label if backend == "torch" else f"{label}:{backend}"
+
+
+def export_dir(label: str) -> Path:
+  return Constants.onnx_models_dir / hashlib.sha256(label.encode()).hexdigest()[:16]
+
+
+def quantized_file_name(quantization: str) -> str:
+  # name given by `export_dynamic_quantized_onnx_model`
+  return f"model_qint8_{quantization}.onnx"
+
+
+def export_onnx(label: str, quantization: str = None) -> Path:
+  """Export the onnx model of a label, and its int8 variant with a quantization, unless already done."""
+  from sentence_transformers import SentenceTransformer
+
+  directory = export_dir(label)
+  if not (directory / "onnx" / "model.onnx").exists():
+    click.secho(f"Exporting {label} to onnx in {directory}, this is done once", fg="yellow")
+    partial = directory.with_name(directory.name + ".partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    SentenceTransformer(label, backend="onnx").save_pretrained(str(partial))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(partial, directory)
+  if quantization and not (directory / "onnx" / quantized_file_name(quantization)).exists():
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    click.secho(f"Quantizing the onnx model of {label} to int8 ({quantization})", fg="yellow")
+    model = SentenceTransformer(str(directory), backend="onnx")
+    export_dynamic_quantized_onnx_model(model, quantization, str(directory))
+  return directory
+
+
+def require_onnx_runtime():
+  """The onnx backends run through optimum, an optional dependency."""
+  try:
+    import optimum.onnxruntime  # noqa: F401
+  except ImportError:
+    raise click.ClickException(
+      "The onnx embedding backends need optimum with onnxruntime, "
+      "install them with `pip install 'aikame[onnx]'` or use embedding_backend=torch")
+
+
+def session_options(threads: int):
+  import onnxruntime
+
+  options = onnxruntime.SessionOptions()
+  if threads:
+    options.intra_op_num_threads = threads
+  return options
+
+
+def load_embedding_model(label: str = None, backend: str = None, threads: int = None):
+  """The sentence transformer of a label, on the given backend (defaults to the settings)."""
+  from sentence_transformers import SentenceTransformer
+
+  label = label or Constants.model_label
+  backend = backend or Constants.embedding_backend
+  threads = Constants.embedding_threads if threads is None else threads
+  if backend not in embedding_backends:
+    raise ValueError(f"Unknown embedding backend: {backend}, use one of {', '.join(embedding_backends)}")
+
+  if backend == "torch":
+    if threads:
+      import torch
+
+      torch.set_num_threads(threads)
+    return SentenceTransformer(label)
+
+  require_onnx_runtime()
+  quantization = None
+  if backend == "onnx-int8":
+    quantization = Constants.onnx_quantization
+    if quantization not in quantization_configs:
+      raise ValueError(f"Unknown onnx quantization: {quantization}, use one of {', '.join(quantization_configs)}")
+  directory = export_onnx(label, quantization)
+  return SentenceTransformer(str(directory), backend="onnx", model_kwargs={
+    "file_name": quantized_file_name(quantization) if quantization else "model.onnx",
+    "provider": "CPUExecutionProvider",
+    "session_options": session_options(threads),
+  })
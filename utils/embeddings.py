@@ -1,13 +1,102 @@
-import faiss
 import os
 import click
-import numpy as np
-from sentence_transformers import SentenceTransformer
+import threading
+import time
 from .constants import Constants
-from langchain.vectorstores import chroma
-
-
-model = SentenceTransformer(model_name_or_path=Constants.model_label)
+from .resources import Resources
+from .tracing import tracer
+
+
+# Texts are encoded in batches of similar token length: the batch is padded to its longest text,
+# so mixing short and long texts spends most of the work on padding. Batches are sized by a
+# budget of padded tokens rather than a count, many short texts or a few long ones per batch,
+# which also bounds the memory of a batch. Vectors come back in the order of the texts.
+
+class EmbeddingStats:
+  """Tokens encoded by `embed_texts`, alone and with the padding of their batches."""
+
+  def __init__(self):
+    self.texts = 0
+    self.tokens = 0
+    self.padded_tokens = 0
+    self.batches = 0
+    self.seconds = 0.0
+    self._lock = threading.Lock()
+
+  def record(self, texts: int, tokens: int, padded_tokens: int, batches: int, seconds: float):
+    with self._lock:
+      self.texts += texts
+      self.tokens += tokens
+      self.padded_tokens += padded_tokens
+      self.batches += batches
+      self.seconds += seconds
+
+  @property
+  def tokens_per_second(self) -> float:
+    return self.tokens / self.seconds if self.seconds else 0.0
+
+  @property
+  def padding(self) -> float:
+    """Share of the encoded tokens that were padding."""
+    return 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+  def report(self) -> str:
+    return (f"{self.texts} texts, {self.tokens} tokens in {self.batches} batches, "
+            f"{self.tokens_per_second:.1f} tokens/s, {self.padding:.1%} padding")
+
+
+def token_lengths(model, texts: list[str]) -> list[int]:
+  """Number of tokens of every text as the model sees it, special tokens included and truncated."""
+  encoded = model.tokenizer(texts, truncation=True, max_length=model.max_seq_length)
+  return [len(ids) for ids in encoded["input_ids"]]
+
+
+def plan_batches(lengths: list[int], token_budget: int, max_batch: int, max_padding: float) -> list[list[int]]:
+  """
+  Indices of the texts grouped by length into batches of at most `token_budget` padded tokens,
+  `max_batch` texts and a `max_padding` share of padding.
+  """
+  order = sorted(range(len(lengths)), key=lengths.__getitem__)
+  batches, batch, batch_tokens = [], [], 0
+  for i in order:
+    # in ascending order, the text being added is the longest of its batch
+    padded = (len(batch) + 1) * lengths[i]
+    if batch and (padded > token_budget or len(batch) >= max_batch
+                  or 1 - (batch_tokens + lengths[i]) / padded > max_padding):
+      batches.append(batch)
+      batch, batch_tokens = [], 0
+    batch.append(i)
+    batch_tokens += lengths[i]
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+def embed_texts(texts: list[str], model=None, token_budget: int = Constants.embed_token_budget,
+                max_batch: int = Constants.embed_max_batch, max_padding: float = Constants.embed_max_padding,
+                stats: EmbeddingStats = None):
+  """Embeddings (numpy, one row per text, in order) of texts encoded in length-bucketed batches."""
+  import numpy as np
+
+  model = model or Resources.embedding_model()
+  if not texts:
+    return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+  with tracer.span("embed_batches") as span:
+    start = time.perf_counter()
+    lengths = token_lengths(model, texts)
+    batches = plan_batches(lengths, token_budget, max_batch, max_padding)
+    vectors = None
+    padded_tokens = 0
+    for batch in batches:
+      encoded = model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True)
+      if vectors is None:
+        vectors = np.empty((len(texts), encoded.shape[1]), dtype=encoded.dtype)
+      vectors[batch] = encoded
+      padded_tokens += len(batch) * lengths[batch[-1]]
+    span.count(texts=len(texts), tokens=sum(lengths), padded_tokens=padded_tokens, batches=len(batches))
+    if stats is not None:
+      stats.record(len(texts), sum(lengths), padded_tokens, len(batches), time.perf_counter() - start)
+  return vectors
 
 
 def create_parent_directory():
@@ -38,6 +127,9 @@ def update_central_ledger(key, path_of_embedding):
 
 
 def store_embeddings(embeddings, path_of_embedding: str) -> tuple:
+  import faiss
+  import numpy as np
+
   click.secho(f'Storing embeddings at {path_of_embedding}', fg='green')
   try:
     dimension = embeddings.shape[1]
@@ -58,8 +150,7 @@ def store_embeddings(embeddings, path_of_embedding: str) -> tuple:
 def create_embedding(texts: list[str]):
   try:
     click.secho(f'Creating embeddings for {len(texts)} texts', fg='green')
-    embeddings = model.encode(
-      texts, show_progress_bar=True, batch_size=Constants.chunk_size)
+    embeddings = embed_texts(texts)
     click.secho(f'Embeddings created for {len(texts)} texts', fg='green')
     click.secho(f'Embedding shape: {embeddings.shape}', fg='green')
     click.secho(f'Embedding size: {embeddings}', fg='green')
@@ -69,11 +160,13 @@ def create_embedding(texts: list[str]):
 
 
 def create_and_store_embeddings(chunks: list[str], key):
+  from langchain.vectorstores import chroma
+
   try:
     # Store embeddings in ChromaDB (persistent storage)
     vector_db = chroma.Chroma.from_documents(
 documents=chunks,
-embedding=model,
+embedding=Resources.embedding_model(),
 persist_directory="./chroma_db"
     )
     vector_db.persist()
@@ -14,4 +14,9 @@ class RelativePathError(Exception):
 
 class NotEnoughContextError(Exception):
 	"""Raised when there's not enough context for a query."""
-	pass
\ No newline at end of file
+	pass
+
+
+class LLMProviderError(Exception):
+  """Raised when a language model provider call fails for good (after retries)."""
+  pass
\ No newline at end of file
@@ -0,0 +1,341 @@
+import click
+import json
+import math
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from .constants import Constants
+from .resources import Resources
+from .cache import query_cache
+from .catalog import catalog
+from .text_store import text_store
+from .workspace import PerWorkspace
+from .index import timing_decorator
+
+
+# One consolidated faiss index for every ingested chunk, instead of one `.index` file per document.
+# Vectors are added with int64 ids that the sqlite id map resolves back to chunk ids (and sources),
+# so search cost does not depend on the number of files. The index is memory-mapped when loaded:
+# the vectors stay in the page cache instead of being copied into the process.
+# With compressed codes, the float32 vectors are kept in a side file (row i holds the vector of id i)
+# that is memory-mapped too, only the rows of the candidates of a query are read to rescore them.
+
+index_kinds = ("flat", "ivf", "hnsw")
+compressions = ("none", "fp16", "int8", "pq")
+
+schema = """
+create table if not exists meta (key text primary key, value text not null);
+create table if not exists ids (id integer primary key, chunk_id text not null, source text not null);
+create index if not exists ids_chunk on ids (chunk_id);
+"""
+
+
+def pq_subquantizers(dimension: int) -> int:
+  m = Constants.faiss_pq_m or max(1, dimension // 4)
+  while dimension % m:
+    m -= 1
+  return m
+
+
+def create_index(kind: str, dimension: int, count: int, compression: str = "none"):
+  import faiss
+
+  if compression not in compressions:
+    raise ValueError(f"Unknown faiss compression: {compression}, expected one of {', '.join(compressions)}")
+  if compression == "pq" and count < 256:
+    raise ValueError(f"Product quantization needs at least 256 vectors to train, got {count}")
+  scalar_types = {"fp16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+  if kind == "flat":
+    if compression == "none":
+      base = faiss.IndexFlatL2(dimension)
+    elif compression == "pq":
+      base = faiss.IndexPQ(dimension, pq_subquantizers(dimension), 8)
+    else:
+      base = faiss.IndexScalarQuantizer(dimension, scalar_types[compression])
+  elif kind == "ivf":
+    nlist = Constants.faiss_nlist or max(1, min(int(4 * math.sqrt(count)), count // 39 or 1))
+    quantizer = faiss.IndexFlatL2(dimension)
+    if compression == "none":
+      base = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    elif compression == "pq":
+      base = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_subquantizers(dimension), 8)
+    else:
+      base = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, scalar_types[compression])
+  elif kind == "hnsw":
+    if compression == "none":
+      base = faiss.IndexHNSWFlat(dimension, Constants.faiss_hnsw_m)
+    elif compression == "pq":
+      base = faiss.IndexHNSWPQ(dimension, pq_subquantizers(dimension), Constants.faiss_hnsw_m)
+    else:
+      base = faiss.IndexHNSWSQ(dimension, scalar_types[compression], Constants.faiss_hnsw_m)
+  else:
+    raise ValueError(f"Unknown faiss index kind: {kind}, expected one of {', '.join(index_kinds)}")
+  return faiss.IndexIDMap2(base)
+
+
+def tune_index(index, kind: str):
+  """Apply the search time parameters of the index kind."""
+  import faiss
+
+  if kind == "ivf":
+    faiss.extract_index_ivf(index).nprobe = Constants.faiss_nprobe
+  elif kind == "hnsw":
+    faiss.downcast_index(index.index).hnsw.efSearch = Constants.faiss_ef_search
+
+
+def read_ledger() -> list[tuple[str, Path]]:
+  """Keys and paths of the per-file indexes recorded in `central_ledger.txt`."""
+  ledger = Constants.parent_path / "central_ledger.txt"
+  if not ledger.exists():
+    return []
+  entries = []
+  with open(ledger, 'r') as f:
+    for line in f:
+      if ":" not in line:
+        continue
+      key, path = (part.strip() for part in line.split(":", 1))
+      entries.append((key, Constants.parent_path / path))
+  return entries
+
+
+class FaissIndex:
+  """The consolidated index and its id map, kept in `faiss_dir`."""
+
+  def __init__(self, directory: Path):
+    self.directory = directory
+    self.index_file = directory / "index.faiss"
+    self.ids_file = directory / "ids.db"
+    self.vectors_file = directory / "vectors.f32"
+    self._index = None
+    self._vectors = None
+    self._connection = None
+    self._lock = threading.RLock()
+
+  @property
+  def connection(self) -> sqlite3.Connection:
+    if self._connection is None:
+      self.directory.mkdir(parents=True, exist_ok=True)
+      self._connection = sqlite3.connect(self.ids_file, check_same_thread=False, timeout=30)
+      self._connection.executescript(schema)
+    return self._connection
+
+  def meta(self, key: str, default=None):
+    row = self.connection.execute("select value from meta where key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+  def _set_meta(self, **values):
+    self.connection.executemany(
+      "insert or replace into meta values (?, ?)", [(key, json.dumps(value)) for key, value in values.items()])
+
+  def exists(self) -> bool:
+    return self.index_file.exists()
+
+  def is_stale(self) -> bool:
+    return self.meta("collection_version") != query_cache.collection_version()
+
+  def load(self):
+    """The index, memory-mapped read only (loaded once per process)."""
+    import faiss
+
+    with self._lock:
+      if self._index is None:
+        if not self.exists():
+          raise FileNotFoundError(f"No faiss index at {self.index_file}, run `build_index` first")
+        try:
+          self._index = faiss.read_index(str(self.index_file), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+          # index types that cannot be mapped are read into memory
+          self._index = faiss.read_index(str(self.index_file))
+        tune_index(self._index, self.meta("kind", "flat"))
+      return self._index
+
+  def vectors(self):
+    """The full precision vectors of a compressed index, memory-mapped."""
+    import numpy as np
+
+    with self._lock:
+      if self._vectors is None:
+        self._vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r").reshape(-1, self.meta("dimension"))
+      return self._vectors
+
+  def _write(self, index, vectors=None):
+    import faiss
+
+    # replace atomically so that a concurrent reader keeps its mapping of the old file
+    temporary = self.index_file.with_suffix(".tmp")
+    faiss.write_index(index, str(temporary))
+    os.replace(temporary, self.index_file)
+    if vectors is not None:
+      temporary = self.vectors_file.with_suffix(".tmp")
+      vectors.tofile(temporary)
+      os.replace(temporary, self.vectors_file)
+    with self._lock:
+      self._index = None
+      self._vectors = None
+
+  def compressed(self) -> bool:
+    return self.meta("compression", "none") != "none"
+
+  def build(self, kind: str = Constants.faiss_index_kind, compression: str = Constants.faiss_compression,
+            page_size: int = 5000) -> int:
+    """Rebuild the index from every embedding of the collection, returns the number of vectors."""
+    import numpy as np
+
+    collection = Resources.collection()
+    vectors, chunk_ids, sources = [], [], []
+    offset = 0
+    while True:
+      page = collection.get(limit=page_size, offset=offset, include=["embeddings", "metadatas"])
+      if not page["ids"]:
+        break
+      vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+      chunk_ids.extend(page["ids"])
+      sources.extend(metadata.get("source", "") for metadata in page["metadatas"])
+      offset += len(page["ids"])
+    if not chunk_ids:
+      raise ValueError("The collection is empty, load some documents first")
+    return self.build_from(np.concatenate(vectors), chunk_ids, sources, kind, compression)
+
+  def build_from(self, vectors, chunk_ids: list[str], sources: list[str], kind: str = Constants.faiss_index_kind,
+                 compression: str = Constants.faiss_compression) -> int:
+    """Rebuild the index from given vectors (row i of the chunk i), e.g. the memory-mapped ones of a snapshot."""
+    import numpy as np
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = create_index(kind, vectors.shape[1], len(vectors), compression)
+    if not index.is_trained:
+      index.train(vectors)
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+    with self._lock:
+      with self.connection:
+        self.connection.execute("delete from ids")
+        self.connection.executemany(
+          "insert into ids values (?, ?, ?)", zip(range(len(chunk_ids)), chunk_ids, sources))
+        self._set_meta(kind=kind, compression=compression, dimension=int(vectors.shape[1]),
+                       model_label=Constants.model_label, collection_version=query_cache.collection_version())
+      if compression == "none":
+        self.vectors_file.unlink(missing_ok=True)
+      self._write(index, vectors if compression != "none" else None)
+    return len(chunk_ids)
+
+  def merge(self, entries: list[tuple[str, Path]]) -> int:
+    """
+    Add the vectors of per-file indexes to the consolidated one, returns the number of vectors added.
+    Those indexes carry no chunk ids: the key of a ledger entry is the path of its document, and its
+    rows are the chunks of the document in order, mapped to the chunk ids the catalog has for it.
+    Indexes of documents that are not loaded (or were chunked differently) are skipped, since the
+    collection has no chunk to serve their vectors, and so are chunks the index already holds.
+    """
+    import faiss
+    import numpy as np
+
+    with self._lock:
+      index = faiss.read_index(str(self.index_file)) if self.exists() else None
+      next_id = self.connection.execute("select coalesce(max(id) + 1, 0) from ids").fetchone()[0]
+      added = 0
+      for key, path in entries:
+        part = faiss.read_index(str(path))
+        manifest = catalog.get(key)
+        if manifest is None or len(manifest["ids"]) != part.ntotal:
+          click.secho(f"Skipping {path}: {key} is not loaded with {part.ntotal} chunks", fg="yellow")
+          continue
+        indexed = {chunk_id for chunk_id, in self.connection.execute("select chunk_id from ids where source = ?", (key,))}
+        rows = [position for position, chunk_id in enumerate(manifest["ids"]) if chunk_id not in indexed]
+        if not rows:
+          continue
+        vectors = part.reconstruct_n(0, part.ntotal)[rows]
+        if index is None:
+          # no consolidated index yet, start a flat one with the dimension of the first part
+          index = create_index("flat", part.d, part.ntotal)
+          self._set_meta(kind="flat", compression="none", dimension=part.d, model_label=Constants.model_label)
+        if part.d != index.d:
+          raise ValueError(f"Index {path} has dimension {part.d}, the consolidated index {index.d}")
+        ids = np.arange(next_id, next_id + len(rows), dtype=np.int64)
+        index.add_with_ids(vectors, ids)
+        if self.compressed():
+          with open(self.vectors_file, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with self.connection:
+          self.connection.executemany(
+            "insert into ids values (?, ?, ?)",
+            ((int(i), manifest["ids"][position], key) for position, i in zip(rows, ids)))
+        next_id += len(rows)
+        added += len(rows)
+      if index is not None:
+        self._write(index)
+      return added
+
+  def search(self, embeddings: list[list[float]], k: int, rescore: bool = True) -> list[list[tuple[str, str, float]]]:
+    """
+    (chunk id, source, distance) of the `k` nearest chunks of every embedding.
+    A compressed index is searched for more candidates, reranked by their exact distance.
+    """
+    import numpy as np
+
+    index = self.load()
+    queries = np.asarray(embeddings, dtype=np.float32)
+    rescore = rescore and self.compressed()
+    candidates = k * max(1, Constants.faiss_rescore_factor) if rescore else k
+    distances, ids = index.search(queries, candidates)
+    if rescore:
+      vectors = self.vectors()
+      for row, query in enumerate(queries):
+        # read the candidate rows in file order
+        found = np.sort(ids[row][ids[row] >= 0])
+        exact = ((vectors[found] - query) ** 2).sum(axis=1)
+        order = np.argsort(exact)[:k]
+        ids[row, :len(order)], distances[row, :len(order)] = found[order], exact[order]
+        ids[row, len(order):] = -1
+      ids, distances = ids[:, :k], distances[:, :k]
+    found = {int(i) for i in ids.ravel() if i >= 0}
+    placeholders = ",".join("?" * len(found))
+    rows = dict(((row[0], (row[1], row[2])) for row in self.connection.execute(
+      f"select id, chunk_id, source from ids where id in ({placeholders})", tuple(found)))) if found else {}
+    return [[(*rows[int(i)], float(distance)) for i, distance in zip(row_ids, row_distances) if int(i) in rows]
+            for row_ids, row_distances in zip(ids, distances)]
+
+  def query(self, embedding: list[float], n_results: int) -> dict:
+    """Same shape as the chroma query results, the documents are read from the collection by id."""
+    hits = self.search([embedding], n_results)[0]
+    stored = Resources.collection().get(ids=[chunk_id for chunk_id, _, _ in hits], include=["documents", "metadatas"])
+    by_id = dict(zip(stored["ids"], zip(text_store.fill(stored["documents"], stored["metadatas"]), stored["metadatas"])))
+    hits = [hit for hit in hits if hit[0] in by_id]
+    return {
+      "ids": [[chunk_id for chunk_id, _, _ in hits]],
+      "documents": [[by_id[chunk_id][0] for chunk_id, _, _ in hits]],
+      "metadatas": [[by_id[chunk_id][1] for chunk_id, _, _ in hits]],
+      "distances": [[distance for _, _, distance in hits]],
+    }
+
+
+faiss_index = PerWorkspace(lambda workspace: FaissIndex(workspace.faiss_dir))
+
+
+@click.command(name="build_index")
+@click.option("--kind", type=click.Choice(index_kinds), default=Constants.faiss_index_kind, show_default=True,
+              help="Exact (flat) search, or approximate with inverted lists (ivf) or a graph (hnsw)")
+@click.option("--compression", type=click.Choice(compressions), default=Constants.faiss_compression,
+              show_default=True, help="Codes of the vectors, compressed ones are rescored with the float32 vectors")
+@click.option("--merge-ledger", "merge_ledger", is_flag=True,
+              help="Merge the per-file indexes of central_ledger.txt into the consolidated index instead")
+@timing_decorator
+def build_index(kind: str, compression: str, merge_ledger: bool):
+  '''
+    Build the consolidated faiss index of every loaded chunk.
+    Set retrieval_backend=faiss to answer queries from it.
+  '''
+  if merge_ledger:
+    entries = read_ledger()
+    if not entries:
+      click.secho("No per-file index in the central ledger.", fg="yellow")
+      return
+    added = faiss_index.merge(entries)
+    click.secho(f"Merged {added} vectors from {len(entries)} indexes into {faiss_index.index_file}", fg="green")
+    return
+  try:
+    count = faiss_index.build(kind, compression)
+  except ValueError as e:
+    click.secho(str(e), fg="red")
+    return
+  click.secho(f"Built a {kind} ({compression}) index of {count} chunks at {faiss_index.index_file}", fg="green")
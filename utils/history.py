@@ -0,0 +1,165 @@
+import atexit
+import json
+import os
+import re
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Iterator
+from .constants import Constants
+from .workspace import workspace
+
+
+# Every chat session is an append-only jsonl file under the `chats_dir` of its workspace, one message per line.
+# A turn only appends its two lines (buffered and flushed shortly after) and the history sent
+# to the model is an in-memory tail, read once by seeking from the end of the file,
+# so the cost of a turn does not grow with the length of the conversation.
+
+session_name_pattern = re.compile(r"^[\w.-]+$")
+tail_block_size = 1 << 14
+
+
+class ChatLog:
+  """Append-only log of one chat session with an in-memory tail of its last messages."""
+
+  def __init__(self, session: str, max_length: int, chats_dir: Path):
+    if not session_name_pattern.match(session):
+      raise ValueError(f"Invalid session name: {session!r}, use letters, digits, '_', '-' and '.'")
+    self.session = session
+    self.path = chats_dir / f"{session}.jsonl"
+    self.max_length = max_length
+    self._tail: deque | None = None
+    # size of the log as last read or written by this process, another writer changes it
+    self._size: int | None = None
+    self._pending: list[str] = []
+    self._timer: threading.Timer | None = None
+    self._lock = threading.RLock()
+
+  def _read_tail(self) -> list[Constants.MessageInstance]:
+    if not self.path.exists():
+      return []
+    with open(self.path, 'rb') as f:
+      f.seek(0, os.SEEK_END)
+      position = f.tell()
+      data = b""
+      # one more line than needed, the first one of the window may be cut
+      while position > 0 and data.count(b"\n") <= self.max_length:
+        step = min(tail_block_size, position)
+        position -= step
+        f.seek(position)
+        data = f.read(step) + data
+    lines = data.split(b"\n")
+    if position > 0:
+      lines = lines[1:]
+    messages = []
+    for line in lines:
+      try:
+        messages.append(Constants.MessageInstance.fromDict(json.loads(line)))
+      except (ValueError, KeyError):
+        # empty lines and a line cut by an interrupted write
+        continue
+    return messages[-self.max_length:]
+
+  def _file_size(self) -> int:
+    try:
+      return self.path.stat().st_size
+    except FileNotFoundError:
+      return 0
+
+  def tail(self) -> list[Constants.MessageInstance]:
+    """The last `max_length` messages of the session."""
+    with self._lock:
+      if self._tail is None or (not self._pending and self._file_size() != self._size):
+        self._size = self._file_size()
+        self._tail = deque(self._read_tail(), maxlen=self.max_length)
+      return list(self._tail)
+
+  def append(self, *messages: Constants.MessageInstance):
+    """Add messages to the session, they reach the disk at the next flush."""
+    with self._lock:
+      self.tail()
+      self._tail.extend(messages)
+      self._pending.extend(json.dumps(message.toDict()) + "\n" for message in messages)
+      if self._timer is None:
+        self._timer = threading.Timer(Constants.chat_flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def flush(self):
+    with self._lock:
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+      if not self._pending:
+        return
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      expected = self._file_size() == self._size
+      with open(self.path, 'a') as f:
+        f.write("".join(self._pending))
+      self._pending = []
+      # when another process appended meanwhile, the tail is read again on next use
+      self._size = self._file_size() if expected else None
+
+  def clear(self):
+    with self._lock:
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+      self._pending = []
+      self._tail = deque(maxlen=self.max_length)
+      self.path.unlink(missing_ok=True)
+      self._size = 0
+
+  def messages(self) -> Iterator[dict]:
+    """Every message of the session, read lazily from the log."""
+    self.flush()
+    if not self.path.exists():
+      return
+    with open(self.path, 'r') as f:
+      for line in f:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          continue
+
+
+_logs: dict[tuple[str, str], ChatLog] = {}
+_logs_lock = threading.Lock()
+
+
+def migrate_legacy_history(log: ChatLog):
+  """Move the messages of the old `chat_history.json` into the given session log."""
+  legacy = workspace().chat_history_file
+  if not legacy.exists() or log.path.exists():
+    return
+  with open(legacy, 'r') as f:
+    history = json.load(f)
+  log.path.parent.mkdir(parents=True, exist_ok=True)
+  with open(log.path, 'w') as f:
+    f.writelines(json.dumps(message) + "\n" for message in history)
+  legacy.rename(legacy.with_suffix(".json.migrated"))
+
+
+def chat_log(session: str = None) -> ChatLog:
+  """The (shared) log of a session of the current workspace, defaults to the `chat_session` setting."""
+  session = session or Constants.chat_session
+  current = workspace()
+  with _logs_lock:
+    if (current.name, session) not in _logs:
+      log = ChatLog(session, Constants.max_history_length, current.chats_dir)
+      if session == "default":
+        migrate_legacy_history(log)
+      _logs[current.name, session] = log
+    return _logs[current.name, session]
+
+
+def list_sessions() -> list[str]:
+  return sorted(path.stem for path in workspace().chats_dir.glob("*.jsonl"))
+
+
+@atexit.register
+def flush_all():
+  with _logs_lock:
+    logs = list(_logs.values())
+  for log in logs:
+    log.flush()
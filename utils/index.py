@@ -2,6 +2,7 @@ import click
 from functools import wraps
 import time
 from .constants import Constants
+from .tracing import tracer
 
 
 def call_func(a: int, b: int) -> int:
@@ -12,7 +13,8 @@ def timing_decorator(f):
   @wraps(f)
   def wrapper(*args, **kwargs):
     start = time.perf_counter()
-    result = f(*args, **kwargs)
+    with tracer.span(f.__name__):
+      result = f(*args, **kwargs)
     end = time.perf_counter()
     click.secho(f"{f.__name__} took {end - start:.2f} seconds", fg="yellow")
     return result
@@ -0,0 +1,358 @@
+import click
+import contextvars
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from .constants import Constants
+from .resources import Resources
+from .cache import query_cache
+from .lexical import lexical_index
+from .crud_files import documentStore, file_digest, identify_chunks
+from .catalog import catalog
+from .chunker import SpanTexts
+from .scope import tag_metadata
+from .text_store import text_store, text_version
+from .tracing import tracer
+from .embeddings import EmbeddingStats, embed_texts
+from .workspace import use_workspace, workspace
+
+
+# Stages of the pipeline:
+#   parse  - process pool, loads and splits every file into chunks, writes its text to the text store
+#   embed  - single thread, encodes the new chunks of many files in large batches
+#   write  - single thread, upserts to chromadb in fixed size batches and finalizes documents
+
+
+class StageCounter:
+  """Throughput counter of a pipeline stage."""
+
+  def __init__(self, name: str):
+    self.name = name
+    self.documents = 0
+    self.chunks = 0
+    self.seconds = 0.0
+    self._lock = threading.Lock()
+
+  def record(self, documents: int, chunks: int, seconds: float):
+    with self._lock:
+      self.documents += documents
+      self.chunks += chunks
+      self.seconds += seconds
+
+  def report(self) -> str:
+    rate = self.chunks / self.seconds if self.seconds else 0.0
+    return (f"{self.name:>6}: {self.documents} documents, {self.chunks} chunks, "
+            f"{self.seconds:.2f}s busy, {rate:.1f} chunks/s")
+
+
+class TextSlices:
+  """The text of a document in the text store, sliced like a string."""
+
+  def __init__(self, source: str, version: str):
+    self.source = source
+    self.version = version
+
+  def __getitem__(self, span: slice) -> str:
+    return text_store.slice(self.source, self.version, span.start, span.stop)
+
+
+class DocumentJob:
+  """A parsed document on its way through the embed and write stages."""
+
+  def __init__(self, result: dict, manifest: dict | None, tags: list[str] = ()):
+    self.path = result["path"]
+    self.tags = tags
+    self.file_hash = result["file_hash"]
+    self.size = result["size"]
+    self.mtime = result["mtime"]
+    self.ids = result["ids"]
+    self.spans = result["spans"]
+    self.version = text_version(self.file_hash)
+    self.texts = SpanTexts(TextSlices(self.path, self.version), result["spans"])
+
+    known_ids = set(manifest["ids"]) if manifest is not None else set()
+    self.new = [i for i, id in enumerate(self.ids) if id not in known_ids]
+    self.kept = [i for i, id in enumerate(self.ids) if id in known_ids]
+    self.stale_ids = list(known_ids.difference(self.ids))
+    self.remaining = len(self.new)
+
+  def metadata(self, i: int) -> dict:
+    start, end = self.spans[i]
+    return {"source": self.path, "chunk_index": i, "start": start, "end": end, "text": self.version,
+            **tag_metadata(self.tags)}
+
+  def manifest(self) -> dict:
+    return {
+      "chunks": len(self.ids),
+      "ids": self.ids,
+      "file_hash": self.file_hash,
+      "size": self.size,
+      "mtime": self.mtime
+    }
+
+
+def parse_document(file_path: str, known_hash: str | None, profile: bool = False, workspace_name: str = None) -> dict:
+  """Runs in a worker process: parse and split a document, along with the spans of the worker when profiling."""
+  if workspace_name is not None:
+    # the text of the document goes to the text store of the workspace of the pipeline
+    use_workspace(workspace_name)
+  if not profile:
+    return _parse_document(file_path, known_hash)
+  tracer.start("parse_document", path=file_path)
+  result = _parse_document(file_path, known_hash)
+  result["trace"] = [(span.name, span.start, span.seconds, span.process, span.counters, span.attributes)
+                     for span in tracer.stop()]
+  return result
+
+
+def _parse_document(file_path: str, known_hash: str | None) -> dict:
+  start = time.perf_counter()
+  path = Path(file_path)
+  try:
+    stat = path.stat()
+    digest = file_digest(path)
+    if digest == known_hash:
+      return {"path": file_path, "unchanged": True, "size": stat.st_size, "mtime": stat.st_mtime,
+              "seconds": time.perf_counter() - start}
+    text, spans = documentStore._process_document(path)
+    ids, spans = identify_chunks(file_path, text, spans)
+    # the text of the document goes to the text store, only the offsets of the chunks cross the process boundary
+    text_store.write(file_path, text_version(digest), text)
+    return {
+      "path": file_path,
+      "file_hash": digest,
+      "size": stat.st_size,
+      "mtime": stat.st_mtime,
+      "ids": ids,
+      "spans": spans,
+      "seconds": time.perf_counter() - start
+    }
+  except Exception as e:
+    return {"path": file_path, "error": str(e), "seconds": time.perf_counter() - start}
+
+
+class IngestionPipeline:
+  """
+  Loads many documents at once, overlapping parsing, embedding and writing.
+  Queues between the stages are bounded, so memory stays flat however many files are given.
+  """
+
+  def __init__(self, workers: int = Constants.ingest_workers,
+               embed_batch_size: int = Constants.embed_batch_size,
+               write_batch_size: int = Constants.write_batch_size,
+               queue_size: int = 4,
+               tags: list[str] = ()):
+    self.workers = max(1, workers)
+    self.tags = list(tags)
+    self.embed_batch_size = embed_batch_size
+    self.write_batch_size = write_batch_size
+    self.embed_queue = queue.Queue(maxsize=queue_size)
+    self.write_queue = queue.Queue(maxsize=queue_size)
+    self.counters = {name: StageCounter(name) for name in ("parse", "embed", "write")}
+    self.embedding_stats = EmbeddingStats()
+    self.finished: dict[str, dict] = {}
+    # unchanged documents whose stat (size and mtime) has to be refreshed in the catalog
+    self.touched: dict[str, tuple[int, float]] = {}
+    # tags of the loaded documents, and unchanged documents given new tags (chunk ids and tags)
+    self.tagged: dict[str, list[str]] = {}
+    self.retagged: dict[str, tuple[list[str], list[str]]] = {}
+    self.failed: dict[str, str] = {}
+    self.skipped = 0
+    self.error: Exception | None = None
+
+  def run(self, file_paths: list[Path]) -> int:
+    """Ingest the given files, returns the number of documents added or updated."""
+    start = time.perf_counter()
+    manifests = {}
+    # the stages run in a copy of the current context, so that their spans nest under the current one
+    stages = [
+      threading.Thread(target=contextvars.copy_context().run, args=(self._embed_stage,),
+                       name="aikame-embed", daemon=True),
+      threading.Thread(target=contextvars.copy_context().run, args=(self._write_stage,),
+                       name="aikame-write", daemon=True),
+    ]
+    for stage in stages:
+      stage.start()
+
+    try:
+      self._parse_stage(file_paths, manifests)
+    finally:
+      self.embed_queue.put(None)
+      for stage in stages:
+        stage.join()
+      # one catalog transaction for the whole run, including on failure
+      if self.touched:
+        catalog.touch(self.touched)
+      if self.finished:
+        catalog.put_many(self.finished)
+        for path, manifest in self.finished.items():
+          text_store.prune(path, keep=text_version(manifest["file_hash"]))
+      for path, (ids, tags) in self.retagged.items():
+        Resources.collection().update(ids=ids, metadatas=[tag_metadata(tags)] * len(ids))
+        self.tagged[path] = tags
+      for path, tags in self.tagged.items():
+        if path in self.finished or path in self.retagged:
+          catalog.add_tags(path, tags)
+      if self.finished or self.retagged:
+        query_cache.bump_version()
+
+    if self.error is not None:
+      raise self.error
+    click.secho(f"Pipeline finished in {time.perf_counter() - start:.2f} seconds", fg="green")
+    for counter in self.counters.values():
+      click.secho(counter.report(), fg="yellow")
+    if self.embedding_stats.texts:
+      click.secho(f"{'tokens':>6}: {self.embedding_stats.report()}", fg="yellow")
+    return len(self.finished)
+
+  def _parse_stage(self, file_paths: list[Path], manifests: dict):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+      pending = set()
+      paths = iter(file_paths)
+      exhausted = False
+      while not exhausted or pending:
+        # keep a bounded number of documents in flight
+        while not exhausted and len(pending) < self.workers * 2:
+          path = next(paths, None)
+          if path is None:
+            exhausted = True
+            break
+          manifest = manifests[str(path)] = catalog.get(str(path))
+          pending.add(pool.submit(
+            parse_document, str(path), manifest.get("file_hash") if manifest else None, tracer.enabled,
+            workspace().name))
+        if not pending:
+          break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          self._dispatch(future.result(), manifests)
+        if self.error is not None:
+          for future in pending:
+            future.cancel()
+          return
+
+  def _dispatch(self, result: dict, manifests: dict):
+    manifest = manifests.pop(result["path"], None)
+    for name, start, seconds, process, counters, attributes in result.get("trace", ()):
+      tracer.record(name, start, seconds, thread="parse worker", process=process, counters=counters, **attributes)
+    if "error" in result:
+      self.failed[result["path"]] = result["error"]
+      click.secho(f"Error processing document {result['path']}: {result['error']}", fg="red")
+      return
+    # new tags add up with the ones the document already has
+    known_tags = catalog.tags(result["path"]) if manifest is not None else []
+    tags = sorted(set(self.tags).union(known_tags))
+    if result.get("unchanged"):
+      self.skipped += 1
+      click.secho(f"Document unchanged, skipping: {result['path']}", fg="green")
+      if (manifest.get("size"), manifest.get("mtime")) != (result["size"], result["mtime"]):
+        self.touched[result["path"]] = (result["size"], result["mtime"])
+      if set(tags) != set(known_tags):
+        self.retagged[result["path"]] = (manifest["ids"], tags)
+      return
+    self.counters["parse"].record(1, len(result["ids"]), result["seconds"])
+    click.secho(f"Parsed {result['path']} into {len(result['ids'])} chunks.", fg="green")
+    self.tagged[result["path"]] = tags
+    self.embed_queue.put(DocumentJob(result, manifest, tags))
+
+  def _embed_stage(self):
+    jobs, rows = [], []
+
+    def flush():
+      if self.error is None and rows:
+        start = time.perf_counter()
+        with tracer.span("embed") as span:
+          embeddings = embed_texts([job.texts[i] for job, i in rows], stats=self.embedding_stats).tolist()
+          span.count(chunks=len(rows))
+        self.counters["embed"].record(len(jobs), len(rows), time.perf_counter() - start)
+      else:
+        embeddings = []
+      self.write_queue.put((list(jobs), list(rows), embeddings))
+      jobs.clear()
+      rows.clear()
+
+    try:
+      while True:
+        job = self.embed_queue.get()
+        if job is None:
+          break
+        jobs.append(job)
+        rows.extend((job, i) for i in job.new)
+        if len(rows) >= self.embed_batch_size:
+          flush()
+      flush()
+    except Exception as e:
+      self.error = self.error or e
+      # keep draining so that the parse stage never blocks on a full queue
+      while self.embed_queue.get() is not None:
+        pass
+    finally:
+      self.write_queue.put(None)
+
+  def _write_stage(self):
+    buffer = []
+
+    def flush():
+      if self.error is not None or not buffer:
+        buffer.clear()
+        return
+      start = time.perf_counter()
+      with tracer.span("upsert") as span:
+        Resources.collection().upsert(
+          ids=[job.ids[i] for job, i, _ in buffer],
+          embeddings=[embedding for _, _, embedding in buffer],
+          metadatas=[job.metadata(i) for job, i, _ in buffer]
+        )
+        texts = [job.texts[i] for job, i, _ in buffer]
+        lexical_index.add([job.ids[i] for job, i, _ in buffer], texts)
+        span.count(chunks=len(buffer), bytes=sum(len(text.encode()) for text in texts))
+      finished = set()
+      for job, _, _ in buffer:
+        job.remaining -= 1
+        if job.remaining == 0:
+          finished.add(job)
+      self.counters["write"].record(len(finished), len(buffer), time.perf_counter() - start)
+      buffer.clear()
+      for job in finished:
+        self._finalize(job)
+
+    try:
+      while True:
+        batch = self.write_queue.get()
+        if batch is None:
+          break
+        jobs, rows, embeddings = batch
+        for (job, i), embedding in zip(rows, embeddings):
+          buffer.append((job, i, embedding))
+          if len(buffer) >= self.write_batch_size:
+            flush()
+        # documents without new chunks have no rows to wait for, the others are finalized by `flush`
+        for job in jobs:
+          if not job.new:
+            self._finalize(job)
+      flush()
+    except Exception as e:
+      self.error = self.error or e
+      while self.write_queue.get() is not None:
+        pass
+
+  def _finalize(self, job: DocumentJob):
+    """Refresh moved chunks, drop stale ones and record the manifest of a fully written document."""
+    if self.error is not None:
+      return
+    if job.kept:
+      Resources.collection().update(
+        ids=[job.ids[i] for i in job.kept],
+        metadatas=[job.metadata(i) for i in job.kept]
+      )
+    if job.stale_ids:
+      Resources.collection().delete(ids=job.stale_ids)
+      lexical_index.remove(job.stale_ids)
+    self.finished[job.path] = job.manifest()
+    click.secho(
+      f"Document loaded: {job.path} ({len(job.new)} new, {len(job.kept)} unchanged, "
+      f"{len(job.stale_ids)} removed chunks)", fg="green")
@@ -0,0 +1,231 @@
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from .constants import Constants
+from .resources import Resources
+from .text_store import text_store
+from .workspace import PerWorkspace, Workspace
+
+
+# BM25 inverted index of the chunk texts, next to the collection in `lexical.db`.
+# Terms and chunks are interned to integers so that a posting is three small integers,
+# postings are clustered by term for the lookups, indexed by chunk for the deletions and by
+# term frequency so that a query scores at most `lexical_max_postings` postings per term, in sqlite.
+# Exact identifiers (part numbers, error codes) are indexed whole and by their parts,
+# so "ERR-1234" matches both "err-1234" and "1234".
+
+schema = """
+create table if not exists meta (key text primary key, value integer not null);
+create table if not exists terms (id integer primary key, term text not null unique, df integer not null);
+create table if not exists chunks (id integer primary key, chunk_id text not null unique, length integer not null);
+create table if not exists postings (
+  term integer not null, chunk integer not null, tf integer not null,
+  primary key (term, chunk)) without rowid;
+create index if not exists postings_chunk on postings (chunk);
+create index if not exists postings_tf on postings (term, tf desc);
+"""
+
+word_pattern = re.compile(r"\w+")
+identifier_pattern = re.compile(r"\w+(?:[.\-/:]\w+)+")
+
+
+def tokenize(text: str) -> list[str]:
+  text = text.lower()
+  tokens = word_pattern.findall(text)
+  tokens.extend(identifier_pattern.findall(text))
+  return tokens
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = Constants.rrf_k) -> list[tuple[str, float]]:
+  """Ids of several rankings ordered by the sum of `1 / (k + rank)` over the rankings they appear in."""
+  scores = Counter()
+  for ranking in rankings:
+    for rank, id in enumerate(ranking, start=1):
+      scores[id] += 1.0 / (k + rank)
+  return scores.most_common()
+
+
+class LexicalIndex:
+
+  def __init__(self, workspace: Workspace):
+    self.workspace = workspace
+    self._connection = None
+    self._lock = threading.RLock()
+
+  @property
+  def connection(self) -> sqlite3.Connection:
+    if self._connection is None:
+      self.workspace.path.mkdir(parents=True, exist_ok=True)
+      new = not self.workspace.lexical_file.exists()
+      self._connection = sqlite3.connect(
+        self.workspace.lexical_file, check_same_thread=False, isolation_level=None, timeout=30)
+      self._connection.execute("pragma journal_mode=wal")
+      self._connection.executescript(schema)
+      if new:
+        # chunks loaded before the index existed are indexed on the first search
+        self._set("backfilled", 0)
+    return self._connection
+
+  def _get(self, key: str) -> int:
+    row = self.connection.execute("select value from meta where key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+  def _set(self, key: str, value: int):
+    self.connection.execute("insert or replace into meta values (?, ?)", (key, value))
+
+  def add(self, ids: list[str], texts: list[str]):
+    """Index chunks, the ones already indexed (same id, hence same text) are skipped."""
+    with self._lock:
+      created = self._connection is None and not self.workspace.lexical_file.exists()
+      connection = self.connection
+      if created and Resources.collection(self.workspace.name).count() <= len(ids):
+        # the index is created along with the first chunks of the collection, there is nothing to backfill
+        self._set("backfilled", 1)
+      connection.execute("begin")
+      try:
+        added, added_length = 0, 0
+        for chunk_id, text in zip(ids, texts):
+          if connection.execute("select 1 from chunks where chunk_id = ?", (chunk_id,)).fetchone():
+            continue
+          counts = Counter(tokenize(text))
+          length = sum(counts.values())
+          chunk = connection.execute(
+            "insert into chunks (chunk_id, length) values (?, ?)", (chunk_id, length)).lastrowid
+          connection.executemany(
+            "insert into terms (term, df) values (?, 1) on conflict (term) do update set df = df + 1",
+            ((term,) for term in counts))
+          connection.executemany(
+            "insert into postings select id, ?, ? from terms where term = ?",
+            ((chunk, tf, term) for term, tf in counts.items()))
+          added += 1
+          added_length += length
+        self._set("chunks", self._get("chunks") + added)
+        self._set("total_length", self._get("total_length") + added_length)
+        connection.execute("commit")
+      except BaseException:
+        connection.execute("rollback")
+        raise
+
+  def remove(self, ids: list[str]):
+    with self._lock:
+      connection = self.connection
+      connection.execute("begin")
+      try:
+        removed, removed_length = 0, 0
+        for chunk_id in ids:
+          row = connection.execute("select id, length from chunks where chunk_id = ?", (chunk_id,)).fetchone()
+          if row is None:
+            continue
+          chunk, length = row
+          connection.execute(
+            "update terms set df = df - 1 where id in (select term from postings where chunk = ?)", (chunk,))
+          connection.execute("delete from postings where chunk = ?", (chunk,))
+          connection.execute("delete from chunks where id = ?", (chunk,))
+          removed += 1
+          removed_length += length
+        self._set("chunks", self._get("chunks") - removed)
+        self._set("total_length", self._get("total_length") - removed_length)
+        connection.execute("commit")
+      except BaseException:
+        connection.execute("rollback")
+        raise
+
+  def clear(self):
+    with self._lock:
+      self.connection.executescript(
+        "delete from postings; delete from chunks; delete from terms; delete from meta;")
+      self._set("backfilled", 1)
+
+  def backfill(self, page_size: int = 5000):
+    """Index every chunk of the collection, once, for stores created before the index."""
+    with self._lock:
+      if self._get("backfilled"):
+        return
+      collection = Resources.collection(self.workspace.name)
+      offset = 0
+      while True:
+        page = collection.get(limit=page_size, offset=offset, include=[])
+        if not page["ids"]:
+          break
+        offset += len(page["ids"])
+        # only the chunks missing from the index are read and tokenized
+        placeholders = ",".join("?" * len(page["ids"]))
+        indexed = {chunk_id for chunk_id, in self.connection.execute(
+          f"select chunk_id from chunks where chunk_id in ({placeholders})", page["ids"])}
+        missing = [chunk_id for chunk_id in page["ids"] if chunk_id not in indexed]
+        if missing:
+          stored = collection.get(ids=missing, include=["documents", "metadatas"])
+          self.add(stored["ids"], text_store.fill(stored["documents"], stored["metadatas"]))
+      self._set("backfilled", 1)
+
+  def search(self, query: str, k: int) -> list[tuple[str, float]]:
+    """(chunk id, bm25 score) of the best `k` chunks for the terms of a query, scored in sqlite."""
+    self.backfill()
+    terms = set(tokenize(query))
+    if not terms:
+      return []
+    with self._lock:
+      count = self._get("chunks")
+      if not count:
+        return []
+      average_length = self._get("total_length") / count
+      placeholders = ",".join("?" * len(terms))
+      rows = self.connection.execute(
+        f"select id, df from terms where term in ({placeholders}) and df > 0", tuple(terms)).fetchall()
+      # terms found in most chunks say little and have long postings, skip them when the query has others
+      rows = [row for row in rows if row[1] <= Constants.lexical_max_df * count] or rows
+      if not rows:
+        return []
+      k1, b = Constants.bm25_k1, Constants.bm25_b
+      weights = [(math.log(1 + (count - df + 0.5) / (df + 0.5)), term) for term, df in rows]
+      # the postings of a term with the highest term frequencies, which have the best scores
+      hits = " union all ".join(
+        ["select * from (select chunk, ? as idf, tf from postings where term = ? order by tf desc limit ?)"] * len(weights))
+      return self.connection.execute(
+        f"with hits as ({hits}) "
+        "select c.chunk_id, sum(h.idf * h.tf * ? / (h.tf + ? + ? * c.length)) as score "
+        "from hits h join chunks c on c.id = h.chunk group by h.chunk order by score desc limit ?",
+        (*[value for idf, term in weights for value in (idf, term, Constants.lexical_max_postings)],
+         k1 + 1, k1 * (1 - b), k1 * b / average_length, k)).fetchall()
+
+
+lexical_index = PerWorkspace(LexicalIndex)
+
+
+def lexical_candidates(query: str, known: dict, n_results: int, where: dict = None) -> list[str]:
+  """
+  Ids of the best lexical matches of a query, their document and metadata are added to `known`
+  (chunk id to document and metadata). With a `where` filter, matches outside of it are dropped.
+  """
+  # the lexical index is not scoped, look further when only part of it is eligible
+  lexical = [chunk_id for chunk_id, _ in lexical_index.search(query, n_results * (4 if where else 1))]
+  missing = [chunk_id for chunk_id in lexical if chunk_id not in known]
+  if missing:
+    stored = Resources.collection().get(ids=missing, where=where, include=["documents", "metadatas"])
+    known.update(zip(stored["ids"], zip(text_store.fill(stored["documents"], stored["metadatas"]), stored["metadatas"])))
+  return [chunk_id for chunk_id in lexical if chunk_id in known][:n_results]
+
+
+def fused_results(rankings: list[list[str]], known: dict, n_results: int) -> dict:
+  """Chroma query shape of the reciprocal rank fusion of rankings, the fused score replaces the distance."""
+  fused = reciprocal_rank_fusion(rankings)[:n_results]
+  return {
+    "ids": [[chunk_id for chunk_id, _ in fused]],
+    "documents": [[known[chunk_id][0] for chunk_id, _ in fused]],
+    "metadatas": [[known[chunk_id][1] for chunk_id, _ in fused]],
+    "distances": [[-score for _, score in fused]],
+  }
+
+
+def fuse_results(query: str, results: dict, n_results: int, where: dict = None) -> dict:
+  """
+  Fuse the vector results of a query (chroma query shape, one query) with the best lexical
+  matches by reciprocal rank fusion. The fused score replaces the distance (lower is better).
+  With a `where` filter, lexical matches outside of it are dropped before the fusion.
+  """
+  known = {chunk_id: (document, metadata) for chunk_id, document, metadata in zip(
+    results["ids"][0], results["documents"][0], results["metadatas"][0])}
+  lexical = lexical_candidates(query, known, n_results, where)
+  return fused_results([results["ids"][0], lexical], known, n_results)
@@ -1,22 +1,67 @@
-import openai
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+from typing import Coroutine
 from .constants import Constants
 
 
-def get_response(augmented_query: str) -> str:
-  try:
-    response = openai.chat.completions.create(
-      model = Constants.llm_model,
-      messages=[{
-        'role': 'system',
-        # TODO: determine whether the formatting is working correctly
-        'content': Constants.prompt_template.format(context=augmented_query, question="What is the answer to this question?")
-                        },
-      {
-        'role': "user"
-        'content':
-                        }
-
-                        ]
-                )
-  except Exception as e:
-    return str(e)
+# Provider clients hold pooled connections bound to an event loop, so every call of the process
+# goes through one long-lived loop running in a background thread instead of a fresh `asyncio.run`.
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+_providers = {}
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread(target=_loop.run_forever, name="aikame-llm", daemon=True).start()
+  return _loop
+
+
+def run_sync(coroutine: Coroutine):
+  """
+  Run a coroutine on the shared loop and wait for its result.
+  It runs in a copy of the context of the caller, so that it stays in its workspace (and under its span).
+  """
+  loop = event_loop()
+  context = contextvars.copy_context()
+  done = concurrent.futures.Future()
+
+  def finish(task: asyncio.Task):
+    if task.cancelled():
+      done.cancel()
+    elif task.exception() is not None:
+      done.set_exception(task.exception())
+    else:
+      done.set_result(task.result())
+
+  def start():
+    loop.create_task(coroutine, context=context).add_done_callback(finish)
+
+  loop.call_soon_threadsafe(start)
+  return done.result()
+
+
+def get_provider(name: str = None):
+  """The (shared) provider of the given name, defaults to the `llm_provider` setting."""
+  name = name or Constants.llm_provider
+  with _loop_lock:
+    if name in _providers:
+      return _providers[name]
+    if name == "gemini":
+      from .llm_integrations.gemini import GeminiProvider as provider_class
+    elif name == "claude":
+      from .llm_integrations.anthropic import ClaudeProvider as provider_class
+    elif name == "openai":
+      from .llm_integrations.openai import OpenAIProvider as provider_class
+    elif name == "fake":
+      from .llm_integrations.fake import FakeProvider as provider_class
+    else:
+      raise ValueError(f"Unknown llm provider: {name}")
+    _providers[name] = provider_class()
+    return _providers[name]
@@ -1,41 +1,32 @@
 import anthropic
 from utils.constants import Constants
-import click
+from utils.llm_integrations.base import AsyncProvider
 
 
-# give the system instruction to the model
-# attach the chat history to the model at the beginning of every chat session
+class ClaudeProvider(AsyncProvider):
+  name = "claude"
 
-class ClaudeModel:
-  def __init__(self):
-    self.client = anthropic.Client(api_key=Constants.anthropic_api_key)
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    if Constants.anthropic_api_key is None:
+      raise ValueError("Anthropic API key is not set")
+    # retries are handled by the provider layer
+    self.client = anthropic.AsyncAnthropic(api_key=Constants.anthropic_api_key, max_retries=0)
     self.model = Constants.anthropic_model
 
-  def invoke(self, query: str, chat_history: list[Constants.MessageInstance],  local_context) -> str:
+  def _is_retryable(self, error: Exception) -> bool:
+    return super()._is_retryable(error) or isinstance(error, (
+      anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError))
 
-    if isinstance(local_context, list):
-      context_text = "\n".join(local_context)
-    else:
-      context_text = local_context
+  async def _stream(self, messages: list[dict]):
+    system = "\n".join(m["content"] for m in messages if m["role"] == Constants.EntityRole.system)
+    conversation = [m for m in messages if m["role"] != Constants.EntityRole.system]
 
-    history_for_context = f"System instructions:\n{Constants.prompt_template}Chat history:\n"
-    for message in chat_history:
-      history_for_context += f"{message.role}: {message.content}\n"
-
-    prompt = f"{context_text}\n\User: {query}\n\nAssistant:"
-
-    # Request a streaming completion from the Claude model.
-    response_stream = self.client.completions.create(
+    async with self.client.messages.stream(
         model=self.model,
-        prompt=prompt,
-        max_tokens_to_sample=1024,
-        stream=True
-    )
-
-    response = ""
-    for chunk in response_stream:
-      # Each chunk is expected to be a dict with a 'completion' key.
-      click.echo(chunk["completion"], nl=False)
-      response += chunk["completion"]
-
-    return response
+        system=system,
+        messages=conversation,
+        max_tokens=Constants.llm_max_tokens
+    ) as response_stream:
+      async for text in response_stream.text_stream:
+        yield text
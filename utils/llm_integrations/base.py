@@ -0,0 +1,92 @@
+import abc
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Callable
+from utils.constants import Constants
+from utils.exceptions import LLMProviderError
+from utils.tracing import tracer
+from utils.context import estimate_tokens
+
+
+class Completion:
+  """Full text of a streamed answer along with its timings."""
+
+  def __init__(self, text: str, time_to_first_token: float, total_seconds: float, attempts: int):
+    self.text = text
+    self.time_to_first_token = time_to_first_token
+    self.total_seconds = total_seconds
+    self.attempts = attempts
+
+
+def build_messages(query: str, context: str,
+                   chat_history: list[Constants.MessageInstance] | None = None) -> list[dict]:
+  """Provider independent prompt: system instructions, chat history, then context and question."""
+  messages = [{"role": Constants.EntityRole.system, "content": Constants.prompt_template}]
+  messages.extend(message.toDict() for message in chat_history or [])
+  content = ""
+  if context:
+    content += f"Context:\n{context}\n\n"
+  content += f"Question: {query}"
+  messages.append({"role": Constants.EntityRole.user, "content": content})
+  return messages
+
+
+class AsyncProvider(abc.ABC):
+  """
+  Base of the llm providers.
+  Subclasses only implement `_stream`, this class adds the per-provider concurrency limit,
+  the timeout (to the first token, then between tokens), retries with exponential backoff and the time to first token.
+  A provider keeps its sdk client, and so its connections, for its whole lifetime.
+  """
+  name = "base"
+
+  def __init__(self, max_concurrency: int = Constants.llm_concurrency, timeout: float = Constants.llm_timeout,
+               max_retries: int = Constants.llm_max_retries, backoff: float = Constants.llm_backoff):
+    self.semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.backoff = backoff
+
+  @abc.abstractmethod
+  def _stream(self, messages: list[dict]) -> AsyncIterator[str]:
+    """Yield the text of the answer as it arrives."""
+
+  def _is_retryable(self, error: Exception) -> bool:
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+  async def stream(self, messages: list[dict], on_token: Callable[[str], None] | None = None) -> Completion:
+    """Stream an answer, calling `on_token` for every piece of text."""
+    with tracer.span("llm", provider=self.name) as span:
+      completion = await self._stream_with_retries(messages, on_token)
+      span.set(time_to_first_token=round(completion.time_to_first_token, 6), attempts=completion.attempts)
+      span.count(tokens=estimate_tokens(completion.text), bytes=len(completion.text.encode()))
+      return completion
+
+  async def _stream_with_retries(self, messages: list[dict], on_token: Callable[[str], None] | None) -> Completion:
+    async with self.semaphore:
+      for attempt in range(1, self.max_retries + 2):
+        start = time.perf_counter()
+        first_token, parts = None, []
+        try:
+          # `timeout` bounds the wait for the first token and then the wait between two tokens,
+          # a long answer that keeps streaming is never cut
+          async with asyncio.timeout(self.timeout) as deadline:
+            async for token in self._stream(messages):
+              if first_token is None:
+                first_token = time.perf_counter() - start
+                tracer.record("llm.first_token", start, first_token, attempt=attempt)
+              parts.append(token)
+              if on_token is not None:
+                on_token(token)
+              deadline.reschedule(asyncio.get_running_loop().time() + self.timeout)
+          total = time.perf_counter() - start
+          return Completion("".join(parts), first_token if first_token is not None else total, total, attempt)
+        except Exception as e:
+          # once text was handed out, a retry would repeat it
+          if parts or attempt > self.max_retries or not self._is_retryable(e):
+            raise LLMProviderError(f"{self.name} call failed after {attempt} attempt(s): {e}") from e
+          await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (1 + random.random() / 2))
+
+  async def complete(self, messages: list[dict]) -> Completion:
+    return await self.stream(messages)
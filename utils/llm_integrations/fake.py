@@ -0,0 +1,41 @@
+import asyncio
+from typing import Callable
+from utils.constants import Constants
+from utils.llm_integrations.base import AsyncProvider
+
+
+def echo_answer(messages: list[dict]) -> str:
+  question = messages[-1]["content"].rsplit("Question: ", 1)[-1]
+  context_size = len(messages[-1]["content"]) - len(question)
+  return (f"This is an offline answer to: {question} "
+          f"It was given {context_size} characters of context and {len(messages) - 2} history messages. "
+          "thanks for asking!")
+
+
+class FakeProvider(AsyncProvider):
+  """
+  Local provider that needs no network nor api key, for tests and offline benchmarks of the chat path.
+  It waits `first_token_delay` before the first token and `token_delay` between tokens,
+  and fails its first `failures` calls with a retryable error.
+  """
+  name = "fake"
+
+  def __init__(self, first_token_delay: float = Constants.fake_llm_first_token_delay,
+               token_delay: float = Constants.fake_llm_token_delay, failures: int = 0,
+               answer: Callable[[list[dict]], str] = echo_answer, **kwargs):
+    super().__init__(**kwargs)
+    self.first_token_delay = first_token_delay
+    self.token_delay = token_delay
+    self.failures = failures
+    self.answer = answer
+    self.calls = 0
+
+  async def _stream(self, messages: list[dict]):
+    self.calls += 1
+    await asyncio.sleep(self.first_token_delay)
+    if self.calls <= self.failures:
+      raise ConnectionError(f"fake failure {self.calls} of {self.failures}")
+    for i, word in enumerate(self.answer(messages).split(" ")):
+      if i:
+        await asyncio.sleep(self.token_delay)
+      yield word if i == 0 else f" {word}"
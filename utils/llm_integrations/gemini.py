@@ -1,57 +1,42 @@
 import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
 from utils.constants import Constants
-from google.generativeai.types import generation_types
-import click
+from utils.llm_integrations.base import AsyncProvider
 import os
 
 
-class GeminiPlugin:
-  def __init__(self):
+class GeminiProvider(AsyncProvider):
+  name = "gemini"
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    if Constants.gemini_api_key is None:
+      raise ValueError("Gemini API key is not set")
+    os.environ["GRPC_VERBOSITY"] = "FATAL"
+    os.environ["GLOG_minloglevel"] = "3"
     genai.configure(api_key=Constants.gemini_api_key)
     self.model = genai.GenerativeModel(
-      'gemini-2.0-flash', system_instruction=Constants.prompt_template,
+      Constants.gemini_model, system_instruction=Constants.prompt_template,
         generation_config={
           "response_mime_type": "text/plain",
           "temperature": 0.9,
-          "max_output_tokens": 1024,
+          "max_output_tokens": Constants.llm_max_tokens,
         }
       )
-    self.chat_session = None
-    os.environ["GRPC_VERBOSITY"] = "FATAL"
-    os.environ["GLOG_minloglevel"] = "3"
-
-  def start_chat(self, chat_history: list[Constants.MessageInstance] = None):
-    if chat_history is None:
-      chat_history = []
-
-    history = []
-    for message in chat_history:
-      history.append({
-          "role": message.role,
-          "parts": [{"text": message.content}]
-      })
-
-    self.chat_session = self.model.start_chat(history=history)
-
-  def invoke(self, query: str, chat_history: list[Constants.MessageInstance], context: str) -> generation_types.GenerateContentResponse:
-    try:
-      if Constants.gemini_api_key is None:
-        raise ValueError("Gemini API key is not set")
-      if self.chat_session is None:
-        # click.secho(
-        #   "No previous chat session, starting new session..", fg="yellow")
-        self.start_chat(chat_history)
-      message = ""
-
-      if context:
-        message += f"Context:\n{context}\n\n"
-        click.secho("Context added to the message", fg="yellow")
-      message += f"Question: {query}"
 
-      response = self.chat_session.send_message(message, stream=True)
-      click.secho("recieved response from llm", fg="green")
-      for chunk in response:
-        click.echo(chunk.text, nl=False)
-      return response.text
-    except Exception as e:
-      raise e
+  def _is_retryable(self, error: Exception) -> bool:
+    return super()._is_retryable(error) or isinstance(error, (
+      api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable,
+      api_exceptions.DeadlineExceeded, api_exceptions.InternalServerError))
+
+  async def _stream(self, messages: list[dict]):
+    # the system prompt is part of the model, gemini calls the assistant "model"
+    contents = [{
+        "role": "model" if message["role"] == Constants.EntityRole.assistant else "user",
+        "parts": [{"text": message["content"]}]
+    } for message in messages if message["role"] != Constants.EntityRole.system]
+
+    response = await self.model.generate_content_async(contents, stream=True)
+    async for chunk in response:
+      if chunk.parts:
+        yield chunk.text
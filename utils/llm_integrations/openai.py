@@ -1,17 +1,30 @@
-from openai import OpenAI
+import openai
 from utils.constants import Constants
+from utils.llm_integrations.base import AsyncProvider
 
 
-class OpenAIPlugin:
+class OpenAIProvider(AsyncProvider):
+  name = "openai"
 
-  def __init__(self):
-    self.ai_client = OpenAI(api_key=Constants.api_key)
-    pass
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    if Constants.gpt_api_key is None:
+      raise ValueError("OpenAI API key is not set")
+    # retries are handled by the provider layer
+    self.client = openai.AsyncOpenAI(api_key=Constants.gpt_api_key, max_retries=0)
+    self.model = Constants.gpt_model
 
-  def invoke(self, query: str, chat_history: str, context: str) -> str:
-    try:
-      return self.ai_client.chat.completions.create(
-      model=Constants.llm_model,
-      messages=[{"role": "system", "content": Constants.prompt_template},{"role": "user", "content": f"Chat history:\n{chat_history}\nContext:\n{context}\n\nQuestion: {query}\n"}])
-    except Exception as e:
-      raise e
+  def _is_retryable(self, error: Exception) -> bool:
+    return super()._is_retryable(error) or isinstance(error, (
+      openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+  async def _stream(self, messages: list[dict]):
+    response_stream = await self.client.chat.completions.create(
+      model=self.model,
+      messages=messages,
+      max_tokens=Constants.llm_max_tokens,
+      stream=True
+    )
+    async for chunk in response_stream:
+      if chunk.choices and chunk.choices[0].delta.content:
+        yield chunk.choices[0].delta.content
@@ -1,84 +1,73 @@
 
 from .constants import Constants
+from .cache import query_cache, answer_cache
 from .exceptions import NotEnoughContextError
-from .llm_integrations.gemini import GeminiPlugin
-import faiss
-import numpy as np
+from .history import chat_log, list_sessions
+from .context import assemble_context, candidate_count, estimate_tokens
+from .scope import Scope
+from .tracing import tracer
+from .workspace import in_workspace, list_workspaces, validate_workspace, workspace
 import click
+import contextvars
 import os
 import json
 from pathlib import Path
-from openai import OpenAI
-import tkinter as tk
-from tkinter import filedialog
 
 
-# Format of the chat history:
-# [
-#   {
-#     role: <"user" | "system" | "assistant">,
-#     content: <str>
-# 	}
-# ]
+# Format of a chat session log (one message per line):
+# {"role": <"user" | "system" | "assistant">, "content": <str>}
 
 class Chat:
 
-  def __init__(self):
-    self.geminiPlugin = GeminiPlugin()
+  def __init__(self, session: str = Constants.chat_session):
+    self._provider = None
+    self.session = session
+
+  @property
+  def provider(self):
+    # the provider sdk is heavy to import, only pay for it when a query is made
+    if self._provider is None:
+      from .llm import get_provider
+      self._provider = get_provider()
+    return self._provider
 
   def upsert_chat(self, query: str, response: str):
-    try:
-      history = self.load_chat()
-      history.append(Constants.MessageInstance(
-        role=Constants.EntityRole.user, content=query))
-      history.append(Constants.MessageInstance(
-        role=Constants.EntityRole.assistant, content=response))
-      history = history[-Constants.max_history_length:]
-      history = [itr.toDict() for itr in history]
-
-      with open(Constants.chat_history_file, 'w') as f:
-        json.dump(history, f)
-    except Exception as e:
-      raise e
+    chat_log(self.session).append(
+      Constants.MessageInstance(role=Constants.EntityRole.user, content=query),
+      Constants.MessageInstance(role=Constants.EntityRole.assistant, content=response))
+
+  def load_chat(self) -> list[Constants.MessageInstance]:
+    return chat_log(self.session).tail()
 
   @staticmethod
-  def load_chat() -> list[Constants.MessageInstance]:
-    try:
-      if not Constants.chat_history_file.exists():
-        return []
-      with open(Constants.chat_history_file, 'r') as f:
-        history = json.load(f)
-        return [Constants.MessageInstance.fromDict(itr) for itr in history]
-    except Exception as e:
-      raise e
-    
-  @staticmethod
-  def clear_chat():
-    try:
-      with open(Constants.chat_history_file, 'w') as f:
-        json.dump([], f)
-    except Exception as e:
-      raise e
+  def clear_chat(session: str = None):
+    chat_log(session).clear()
 
-  def load_context(self, query: str) -> str:
+  def load_context(self, query: str, scope: Scope = None, fan_out: dict[str, Scope | None] = None) -> str:
     try:
       '''Load the context from the chat history.'''
-      click.secho(f"Loading context for query", fg="yellow")
-      question_embedding = Constants.embedding_model.encode(query).tolist()
-      results = Constants.collection.query(
-                                                      query_embeddings=[
-                                                        question_embedding],
-                                                      n_results=Constants.relevant_items
-                                      )
+      click.secho(f"Loading context for query" + (f" within {scope.describe()}" if scope else "")
+                  + (f" across {len(fan_out)} workspaces" if fan_out else ""), fg="yellow")
+      with tracer.span("embed_query"):
+        question_embedding = query_cache.embed(query)
+      if fan_out:
+        results = retrieve_across(question_embedding, candidate_count(), query, fan_out)
+      else:
+        results = retrieve(question_embedding, candidate_count(), query, scope)
       if not results["documents"][0]:
         raise NotEnoughContextError(
                 "I don't have enough context to answer your question.")
 
-      return "\n".join(results["documents"][0])
+      with tracer.span("context") as span:
+        context = assemble_context(
+          results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0])
+        span.count(chunks=len(results["ids"][0]), tokens=estimate_tokens(context))
+      return context
     except Exception as e:
       raise e
 
-  def handle_dedicated_chat(self):
+  def handle_dedicated_chat(self, use_cache: bool = True, scope: Scope = None,
+                            fan_out: dict[str, Scope | None] = None):
     '''
 		Handle a dedicated chat.
 		'''
@@ -90,19 +79,41 @@ class Chat:
       if query == "exit":
         break
       click.secho("Agent: ", fg="green")
-      self.handle_query(query)
+      self.handle_query(query, use_cache=use_cache, scope=scope, fan_out=fan_out)
 
-  def handle_query(self, query: str) -> None:
+  def handle_query(self, query: str, use_cache: bool = True, scope: Scope = None,
+                   fan_out: dict[str, Scope | None] = None) -> None:
     try:
+      use_cache = use_cache and Constants.answer_cache_enabled
       chat_history = self.load_chat()
       # click.secho(f"\n\nChat history: {chat_history}\n\n", fg="yellow")
-      context = self.load_context(query)
+      context = self.load_context(query, scope, fan_out)
       # click.secho("Relevant context has been loaded succesfully")
       # response = ai_client.chat.completions.create(
       #   model=Constants.llm_model,
       #   messages=[{"role": "system", "content": Constants.prompt_template},{"role": "user", "content": f"Chat history:\n{chat_history}\nContext:\n{context}\n\nQuestion: {query}\n"}])
-      response = self.geminiPlugin.invoke(
-        query=query, chat_history=chat_history, context=context)
+      response = None
+      if use_cache:
+        with tracer.span("answer_cache"):
+          response = answer_cache.lookup(query_cache.embed(query), context)
+        if response is not None:
+          click.secho("Answer served from the cache", fg="yellow")
+          click.echo(response)
+      if response is None:
+        from .llm import run_sync
+        from .llm_integrations.base import build_messages
+
+        with tracer.span("prompt") as span:
+          messages = build_messages(query, context, chat_history)
+          span.count(tokens=sum(estimate_tokens(message["content"]) for message in messages))
+        completion = run_sync(self.provider.stream(messages, on_token=lambda token: click.echo(token, nl=False)))
+        click.echo()
+        click.secho(
+          f"({self.provider.name}: first token after {completion.time_to_first_token:.2f}s, "
+          f"answer streamed in {completion.total_seconds:.2f}s)", fg="yellow")
+        response = completion.text
+        if use_cache:
+          answer_cache.store(query, query_cache.embed(query), context, response)
 
       self.upsert_chat(query, response)
       # return response
@@ -120,43 +131,145 @@ def embed_query(query: str):
   '''
           Embed a query using the model.
   '''
-  return Constants.embedding_model.encode([query], show_progress_bar=False)
+  import numpy as np
 
+  return np.array([query_cache.embed(query)], dtype=np.float32)
 
-def merge_indices() :
-  pass
 
+def retrieve(embedding: list[float], n_results: int, query: str = None, scope: Scope = None) -> dict:
+  '''
+          Nearest chunks of an embedding from the configured retrieval backend,
+          fused with the lexical matches of the query text when hybrid retrieval is on.
+          A scope is pushed down to the collection (or to its partition), whatever the backend.
+  '''
+  with tracer.span("retrieve", backend="scope" if scope is not None else Constants.retrieval_backend) as span:
+    if scope is not None:
+      from .scope import scoped_query
 
-def get_context_util(query: str, file_path: str, k: int = 1):
-  try:
-    index = faiss.read_index(file_path)
-    query_embedding = embed_query(query)
-    distances, indices = index.search(
-      np.array(query_embedding, dtype=np.float32), k)
-    click.echo(f"Distances: {distances}")
-    click.echo(f"Indices: {indices}")
-  except Exception as e:
-    raise e
+      results = scoped_query(embedding, n_results, scope)
+    elif Constants.retrieval_backend == "faiss":
+      from .faiss_index import faiss_index
+
+      if faiss_index.is_stale():
+        click.secho("The faiss index is older than the collection, run `build_index` to refresh it", fg="yellow")
+      results = faiss_index.query(embedding, n_results)
+    else:
+      results = query_cache.query(embedding, n_results)
+    span.count(chunks=len(results["ids"][0]))
+  if query is not None and Constants.hybrid_retrieval:
+    from .lexical import fuse_results
+
+    with tracer.span("lexical_fusion"):
+      results = fuse_results(query, results, n_results, scope.where() if scope else None)
+  return results
+
+
+def fan_out_scopes(names: str, sources=(), tags=()) -> dict[str, Scope | None]:
+  '''
+          Scope of each of the workspaces of `ask --workspaces` (comma separated names or `all`).
+          Sources are resolved in every workspace, the ones without a matching document are left out.
+  '''
+  names = list_workspaces() if names == "all" else [name.strip() for name in names.split(",") if name.strip()]
+  scopes = {}
+  for name in dict.fromkeys(names):
+    if not workspace(validate_workspace(name)).exists():
+      raise ValueError(f"No workspace named {name}")
+    with in_workspace(name):
+      try:
+        scopes[name] = Scope.from_options(sources, tags)
+      except ValueError:
+        if not sources:
+          raise
+  if not scopes:
+    raise ValueError(f"No loaded document of the workspaces {', '.join(names)} matches the sources")
+  return scopes
+
+
+def retrieve_across(embedding: list[float], n_results: int, query: str, scopes: dict[str, Scope | None]) -> dict:
+  '''
+          Retrieve from several workspaces at once, one concurrent search per workspace.
+          The workspaces share the embedding model, so the raw vector distances compare and the vector
+          results are merged on them. With hybrid retrieval, one reciprocal rank fusion then runs over that
+          merged ranking and the lexical ranking of every workspace (lexical scores do not compare across indexes).
+          A chunk found in several workspaces is kept once, the metadata tells the workspace of each chunk.
+  '''
+  from concurrent.futures import ThreadPoolExecutor
+  from .lexical import fused_results, lexical_candidates
+
+  hybrid = query is not None and Constants.hybrid_retrieval
+
+  def search(name: str) -> tuple[str, dict, list[str], dict]:
+    with in_workspace(name):
+      scope = scopes[name]
+      results = retrieve(embedding, n_results, scope=scope)
+      known, lexical = {}, []
+      if hybrid:
+        with tracer.span("lexical_search"):
+          lexical = lexical_candidates(query, known, n_results, scope.where() if scope else None)
+      return name, results, lexical, known
 
+  with tracer.span("fan_out", workspaces=len(scopes)) as span:
+    with ThreadPoolExecutor(max_workers=len(scopes), thread_name_prefix="aikame-fan-out") as pool:
+      # every search runs in a copy of the current context, under the fan out span
+      found = [future.result() for future in
+               [pool.submit(contextvars.copy_context().run, search, name) for name in scopes]]
+    best, chunks, rankings = {}, {}, []
+    for name, results, lexical, known in found:
+      for id, document, metadata, distance in zip(
+          results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0]):
+        if id not in best or distance < best[id]:
+          best[id] = distance
+          chunks[id] = (document, {**metadata, "workspace": name})
+      for id in lexical:
+        if id not in chunks:
+          chunks[id] = (known[id][0], {**known[id][1], "workspace": name})
+      rankings.append(lexical)
+    ranked = sorted(best, key=best.get)
+    if hybrid:
+      merged = fused_results([ranked, *rankings], chunks, n_results)
+    else:
+      ranked = ranked[:n_results]
+      merged = {
+        "ids": [ranked],
+        "documents": [[chunks[id][0] for id in ranked]],
+        "metadatas": [[chunks[id][1] for id in ranked]],
+        "distances": [[best[id] for id in ranked]],
+      }
+    span.count(chunks=len(merged["ids"][0]))
+  return merged
 
-def get_context_for_query(query: str):
+
+def merge_indices() -> int:
   '''
-          Get the context for a query.
+          Merge the per-file indexes of the central ledger into the consolidated index.
   '''
+  from .faiss_index import faiss_index, read_ledger
+
+  return faiss_index.merge(read_ledger())
+
+
+def get_context_for_query(query: str, k: int = Constants.relevant_items):
+  '''
+          Get the context for a query from the consolidated faiss index.
+  '''
+  from .faiss_index import faiss_index
+
   click.echo(f"Getting context for query: {query}")
   try:
-    click.secho(f"Searching for all relevant files in context", fg="yellow")
-    for file_path in os.listdir(Constants.parent_path):
-      if file_path.endswith('.index'):
-        get_context_util(query, os.path.join(Constants.parent_path, file_path))
+    hits = faiss_index.search([query_cache.embed(query)], int(k))[0]
+    for chunk_id, source, distance in hits:
+      click.echo(f"{distance:.4f}  {source}  {chunk_id}")
+    return hits
   except Exception as e:
     raise e
-  
 
-  
+
 # returns the dir path including the file name
 
 def select_save_location() -> str:
+  import tkinter as tk
+  from tkinter import filedialog
+
   root = tk.Tk()
   root.withdraw()
   
@@ -169,23 +282,90 @@ def select_save_location() -> str:
   print("the path from the window is ", file_path)
   return file_path
 
+def validate_session(ctx, param, value: str) -> str:
+  try:
+    chat_log(value)
+  except ValueError as e:
+    raise click.BadParameter(str(e))
+  return value
+
+
 @click.command(name="ask")
 # @click.argument("query", type=str, cls=)
 @click.option("--query", "-q", type=str, help="Query for the model", default=Constants.no_inline_query)
-def query(query: str):
+@click.option("--no-cache", "no_cache", is_flag=True, help="Always ask the model, bypassing the answer cache")
+@click.option("--session", "-s", type=str, default=Constants.chat_session, show_default=True,
+              callback=validate_session, help="Named chat session the conversation is kept in")
+@click.option("--source", "sources", multiple=True,
+              help="Only search this loaded document, or the documents below this directory (repeatable)")
+@click.option("--tag", "tags", multiple=True, help="Only search the documents loaded with this tag (repeatable)")
+@click.option("--workspaces", "workspace_names",
+              help="Search these workspaces at once (comma separated, or `all`), the chat stays in the current one")
+@click.option("--batch", "batch_file", type=click.Path(exists=True, dir_okay=False),
+              help="Answer every question of a jsonl file ({\"id\": ..., \"question\": ...} per line)")
+@click.option("--out", "out_file", type=click.Path(dir_okay=False),
+              help="Jsonl file the batch answers are appended to, defaults to <batch>.answers.jsonl")
+@click.option("--concurrency", type=int, default=Constants.batch_concurrency, show_default=True,
+              help="Concurrent llm calls in batch mode")
+@click.option("--rate", type=float, default=Constants.batch_rate, show_default=True,
+              help="Maximum llm calls per second in batch mode, 0 for no limit")
+def query(query: str, no_cache: bool, session: str, sources: tuple[str, ...], tags: tuple[str, ...],
+          workspace_names: str, batch_file: str, out_file: str, concurrency: int, rate: float):
   '''
     Query the model for a context.
+    --source and --tag restrict the search to some documents.
+    --workspaces searches several workspaces concurrently and merges their results.
+    With --batch, answers a whole file of questions and resumes where an interrupted run stopped.
   '''
+  scope, fan_out = None, None
+  try:
+    if workspace_names:
+      if batch_file is not None:
+        raise ValueError("--workspaces cannot be combined with --batch")
+      fan_out = fan_out_scopes(workspace_names, sources, tags)
+    else:
+      scope = Scope.from_options(sources, tags)
+  except ValueError as e:
+    raise click.BadParameter(str(e))
+  if batch_file is not None:
+    from .batch import run_batch
+
+    batch_path = Path(batch_file)
+    out_path = Path(out_file) if out_file else batch_path.with_suffix(".answers.jsonl")
+    run_batch(batch_path, out_path, concurrency=concurrency, rate=rate, use_cache=not no_cache, scope=scope)
+    return
+  chat_instance.session = session
   if query == Constants.no_inline_query:
-    chat_instance.handle_dedicated_chat()
+    chat_instance.handle_dedicated_chat(use_cache=not no_cache, scope=scope, fan_out=fan_out)
     return
   click.secho(f"Querying the model for context: {query}", fg="green")
-  chat_instance.handle_query(query)
+  chat_instance.handle_query(query, use_cache=not no_cache, scope=scope, fan_out=fan_out)
+
+
+@click.command(name="answer_cache")
+@click.option("--clear", is_flag=True, help="Drop every cached answer and reset the counters")
+def answer_cache_stats(clear: bool):
+  '''
+    Show the hit/miss counters of the semantic answer cache.
+  '''
+  if clear:
+    answer_cache.clear()
+    click.secho("Answer cache cleared.", fg="green")
+    return
+  stats = answer_cache.stats()
+  lookups = stats["hits"] + stats["misses"]
+  hit_rate = stats["hits"] / lookups if lookups else 0.0
+  click.secho(
+    f"Entries: {stats['entries']}, hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {hit_rate:.1%}",
+    fg="green")
 
 
 @click.command(name="export_chat")
 @click.option("--file_path", "-f", type=str, help="File path to export the chat history", default = Constants.random_id)
-def export_chat(file_path: str):
+@click.option("--session", "-s", type=str, default=Constants.chat_session, show_default=True,
+              callback=validate_session, help="Chat session to export")
+@click.option("--list", "list_only", is_flag=True, help="List the existing chat sessions instead")
+def export_chat(file_path: str, session: str, list_only: bool):
   '''
     Export the chat history to a location of your choosing.
 
@@ -196,12 +376,20 @@ def export_chat(file_path: str):
 
   '''
   try:
+    if list_only:
+      for name in list_sessions():
+        click.echo(name)
+      return
     if file_path == Constants.random_id:
       file_path = select_save_location()
-    chat_history = chat_instance.load_chat()
-    if not os.path.exists(os.path.dirname(file_path)):
+    if os.path.dirname(file_path) and not os.path.exists(os.path.dirname(file_path)):
       os.makedirs(os.path.dirname(file_path))
+    # the session log is streamed into a json list, never loaded as a whole
     with open(Path.absolute(Path(file_path)), 'w') as f:
-      json.dump([itr.toDict() for itr in chat_history], f)
+      f.write("[")
+      for i, message in enumerate(chat_log(session).messages()):
+        f.write(", " if i else "")
+        json.dump(message, f)
+      f.write("]")
   except Exception as e:
     raise e
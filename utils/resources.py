@@ -0,0 +1,97 @@
+import threading
+from .constants import Constants
+from .workspace import workspace
+
+
+class Resources:
+  """
+  Heavy, shared resources of the app (embedding model, chromadb client and collections).
+  Nothing is built at import time, each resource is created on first use and then reused.
+  """
+  _lock = threading.RLock()
+  _embedding_model = None
+  _local_db = None
+  # collection of every workspace and the stat of its generation file when it was fetched,
+  # see `reset_collection`
+  _collections: dict[str, tuple[object, tuple | None]] = {}
+
+  @classmethod
+  def embedding_model(cls):
+    """The sentence transformer used for both ingestion and queries, on the `embedding_backend`."""
+    if cls._embedding_model is None:
+      with cls._lock:
+        if cls._embedding_model is None:
+          from .embedding_backends import load_embedding_model
+          cls._embedding_model = load_embedding_model()
+    return cls._embedding_model
+
+  @classmethod
+  def local_db(cls):
+    """The persistent chromadb client."""
+    if cls._local_db is None:
+      with cls._lock:
+        if cls._local_db is None:
+          import chromadb
+          cls._local_db = chromadb.PersistentClient(
+            path=str(Constants.parent_path / "chromadb"))
+    return cls._local_db
+
+  @classmethod
+  def _generation(cls, current):
+    try:
+      stat = current.collection_generation_file.stat()
+      return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+      return None
+
+  @classmethod
+  def collection(cls, name: str = None):
+    """The chromadb collection holding the document chunks of a workspace, the current one by default."""
+    current = workspace(name)
+    generation = cls._generation(current)
+    collection, fetched = cls._collections.get(current.name, (None, None))
+    if collection is None or generation != fetched:
+      with cls._lock:
+        collection, fetched = cls._collections.get(current.name, (None, None))
+        if collection is None or generation != fetched:
+          collection = cls.local_db().get_or_create_collection(current.collection_name)
+          cls._collections[current.name] = (collection, generation)
+    return collection
+
+  @classmethod
+  def reset_collection(cls):
+    """
+    Drop and recreate the collection.
+    The generation file is rewritten so that other processes (the daemon, a sync watcher)
+    fetch the new collection instead of using the dropped one.
+    """
+    current = workspace()
+    with cls._lock:
+      try:
+        cls.local_db().delete_collection(current.collection_name)
+      except ValueError:
+        # it did not exist yet
+        pass
+      cls._collections.pop(current.name, None)
+      generation = current.collection_generation_file
+      generation.parent.mkdir(parents=True, exist_ok=True)
+      count = int(generation.read_text() or 0) if generation.exists() else 0
+      generation.write_text(str(count + 1))
+    return cls.collection()
+
+  @classmethod
+  def drop_collection(cls, name: str):
+    """Delete the collection of a workspace for good."""
+    with cls._lock:
+      try:
+        cls.local_db().delete_collection(workspace(name).collection_name)
+      except ValueError:
+        pass
+      cls._collections.pop(name, None)
+
+  @classmethod
+  def is_loaded(cls, name: str) -> bool:
+    """Whether the given resource (of the current workspace for the collection) has already been built."""
+    if name == "collection":
+      return workspace().name in cls._collections
+    return getattr(cls, f"_{name}") is not None
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from .constants import Constants
+from .resources import Resources
+from .cache import query_cache
+from .catalog import catalog
+from .text_store import text_store
+from .workspace import workspace
+
+
+# A scope narrows retrieval to some documents: any of the given sources and, when tags are
+# given, any of the given tags. It is pushed down into the chroma `where` filter, tags being
+# stored on every chunk as boolean `tag:<name>` metadata keys. Large scopes get a partition:
+# their vectors copied once into a memory-mapped matrix that a scoped query scans exactly,
+# rebuilt when the collection version changes.
+
+tag_pattern = re.compile(r"^[\w.-]+$")
+
+
+def validate_tags(tags) -> list[str]:
+  for tag in tags:
+    if not tag_pattern.match(tag):
+      raise ValueError(f"Invalid tag: {tag!r}, use letters, digits, '_', '-' and '.'")
+  return sorted(set(tags))
+
+
+def tag_metadata(tags) -> dict:
+  return {f"tag:{tag}": True for tag in tags}
+
+
+def resolve_sources(values) -> list[str]:
+  """Loaded documents matching the given paths, a directory standing for every document below it."""
+  loaded = catalog.paths()
+  sources = set()
+  for value in values:
+    path = str(Path(value).expanduser().absolute())
+    matches = [source for source in loaded if source == path or source.startswith(path.rstrip(os.sep) + os.sep)]
+    if not matches:
+      raise ValueError(f"No loaded document matches the source {value}")
+    sources.update(matches)
+  return sorted(sources)
+
+
+class Scope:
+
+  def __init__(self, sources=(), tags=()):
+    self.sources = sorted(set(sources))
+    self.tags = validate_tags(tags)
+
+  @classmethod
+  def from_options(cls, sources=(), tags=()) -> "Scope | None":
+    """The scope of the `--source` and `--tag` options, None when both are empty."""
+    if not sources and not tags:
+      return None
+    return cls(resolve_sources(sources) if sources else (), tags)
+
+  def where(self) -> dict:
+    conditions = []
+    if self.sources:
+      conditions.append({"source": {"$in": self.sources}})
+    if self.tags:
+      tag_conditions = [{f"tag:{tag}": True} for tag in self.tags]
+      conditions.append(tag_conditions[0] if len(tag_conditions) == 1 else {"$or": tag_conditions})
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+  def paths(self) -> list[str]:
+    paths = set(self.sources) if self.sources else set(catalog.paths())
+    if self.tags:
+      paths &= catalog.tagged_paths(self.tags)
+    return sorted(paths)
+
+  def key(self) -> str:
+    return hashlib.sha256(json.dumps([self.sources, self.tags]).encode()).hexdigest()[:16]
+
+  def describe(self) -> str:
+    parts = []
+    if self.sources:
+      parts.append(f"{len(self.sources)} sources")
+    if self.tags:
+      parts.append("tags " + ", ".join(self.tags))
+    return " and ".join(parts)
+
+
+class Partition:
+  """The vectors and chunk ids of a scope, kept in `partitions_dir`."""
+
+  def __init__(self, scope: Scope):
+    self.scope = scope
+    self.directory = workspace().partitions_dir
+    base = self.directory / scope.key()
+    self.vectors_file = base.with_suffix(".npy")
+    self.norms_file = base.with_suffix(".norms.npy")
+    self.ids_file = base.with_suffix(".json")
+
+  def is_current(self) -> bool:
+    if not self.ids_file.exists():
+      return False
+    with open(self.ids_file, 'r') as f:
+      return json.load(f)["version"] == query_cache.collection_version()
+
+  def build(self, page_size: int = 5000):
+    import numpy as np
+
+    version = query_cache.collection_version()
+    vectors, ids = [], []
+    offset = 0
+    while True:
+      page = Resources.collection().get(
+        where=self.scope.where(), limit=page_size, offset=offset, include=["embeddings"])
+      if not page["ids"]:
+        break
+      vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+      ids.extend(page["ids"])
+      offset += len(page["ids"])
+    vectors = np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    self.directory.mkdir(parents=True, exist_ok=True)
+    # the ids file is written last, it marks the partition as complete
+    for target, array in ((self.vectors_file, vectors), (self.norms_file, (vectors ** 2).sum(axis=1))):
+      with open(target.with_suffix(".tmp"), 'wb') as f:
+        np.save(f, array)
+      os.replace(target.with_suffix(".tmp"), target)
+    with open(self.ids_file.with_suffix(".tmp"), 'w') as f:
+      json.dump({"version": version, "sources": self.scope.sources, "tags": self.scope.tags, "ids": ids}, f)
+    os.replace(self.ids_file.with_suffix(".tmp"), self.ids_file)
+
+  def search(self, embedding: list[float], n_results: int) -> tuple[list[str], list[float]]:
+    """Ids and squared l2 distances (as chroma reports them) of the nearest chunks of the scope."""
+    import numpy as np
+
+    if not self.is_current():
+      self.build()
+    with open(self.ids_file, 'r') as f:
+      ids = json.load(f)["ids"]
+    if not ids:
+      return [], []
+    vectors = np.load(self.vectors_file, mmap_mode="r")
+    norms = np.load(self.norms_file, mmap_mode="r")
+    query = np.asarray(embedding, dtype=np.float32)
+    distances = norms - 2 * (vectors @ query) + float(query @ query)
+    n_results = min(n_results, len(ids))
+    nearest = np.argpartition(distances, n_results - 1)[:n_results]
+    nearest = nearest[np.argsort(distances[nearest])]
+    return [ids[i] for i in nearest], [float(distances[i]) for i in nearest]
+
+
+def uses_partition(scope: Scope) -> bool:
+  """Whether queries of a scope search its partition, smaller scopes go through a where filter."""
+  return catalog.chunk_count(scope.paths()) >= Constants.partition_min_chunks
+
+
+def scoped_query(embedding: list[float], n_results: int, scope: Scope) -> dict:
+  """Chroma shaped results of a query restricted to a scope."""
+  if not uses_partition(scope):
+    return query_cache.query(embedding, n_results, where=scope.where())
+  ids, distances = Partition(scope).search(embedding, n_results)
+  stored = Resources.collection().get(ids=ids, include=["documents", "metadatas"])
+  by_id = dict(zip(stored["ids"], zip(text_store.fill(stored["documents"], stored["metadatas"]), stored["metadatas"])))
+  found = [(id, distance) for id, distance in zip(ids, distances) if id in by_id]
+  return {
+    "ids": [[id for id, _ in found]],
+    "documents": [[by_id[id][0] for id, _ in found]],
+    "metadatas": [[by_id[id][1] for id, _ in found]],
+    "distances": [[distance for _, distance in found]],
+  }
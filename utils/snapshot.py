@@ -0,0 +1,252 @@
+import click
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from .constants import Constants
+from .resources import Resources
+from .cache import query_cache
+from .lexical import lexical_index
+from .catalog import catalog
+from .embedding_backends import model_key
+from .faiss_index import faiss_index, index_kinds, compressions
+from .text_store import text_store, text_version
+from .index import timing_decorator
+
+
+# A snapshot is a directory holding everything needed to serve the loaded documents elsewhere
+# without embedding them again:
+#   snapshot.json  - format, model, dimension, counts and chunking settings
+#   embeddings.npy - float32 vectors of the chunks, row i of the chunk on line i of chunks.jsonl,
+#                    memory-mapped on import
+#   chunks.jsonl   - id, metadata and (for chunks stored with it) document of every chunk
+#   catalog.json   - manifest and tags of every document
+#   documents/     - the text store, which the chunk offsets point into
+# Import refuses a snapshot of another model, since its vectors would not match the queries.
+
+snapshot_format = 1
+
+
+def _rows(page_size: int):
+  """Pages of the collection, with their embeddings."""
+  collection = Resources.collection()
+  offset = 0
+  while True:
+    page = collection.get(limit=page_size, offset=offset, include=["embeddings", "metadatas", "documents"])
+    if not page["ids"]:
+      return
+    yield page
+    offset += len(page["ids"])
+
+
+def export_snapshot(directory: Path, page_size: int = 5000) -> dict:
+  """Write a snapshot of the collection, the catalog and the text store, returns its description."""
+  import numpy as np
+
+  count = Resources.collection().count()
+  if not count:
+    raise ValueError("The collection is empty, load some documents first")
+  partial = directory.with_name(directory.name + ".partial")
+  shutil.rmtree(partial, ignore_errors=True)
+  partial.mkdir(parents=True)
+
+  vectors, written = None, 0
+  with open(partial / "chunks.jsonl", 'w') as f:
+    for page in _rows(page_size):
+      embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+      if vectors is None:
+        vectors = np.lib.format.open_memmap(
+          partial / "embeddings.npy", mode="w+", dtype=np.float32, shape=(count, embeddings.shape[1]))
+      if written + len(embeddings) > count:
+        raise RuntimeError("The collection changed during the export, try again")
+      vectors[written:written + len(embeddings)] = embeddings
+      written += len(embeddings)
+      for id, metadata, document in zip(page["ids"], page["metadatas"], page["documents"]):
+        row = {"id": id, "metadata": metadata}
+        if document is not None:
+          row["document"] = document
+        f.write(json.dumps(row) + "\n")
+  if written != count:
+    raise RuntimeError("The collection changed during the export, try again")
+  dimension = int(vectors.shape[1])
+  vectors.flush()
+  del vectors
+
+  stats = catalog.stats()
+  with open(partial / "catalog.json", 'w') as f:
+    json.dump({path: {**catalog.get(path), "tags": catalog.tags(path)} for path in stats}, f)
+  if text_store.directory.exists():
+    shutil.copytree(text_store.directory, partial / "documents")
+  else:
+    (partial / "documents").mkdir()
+
+  description = {
+    "format": snapshot_format,
+    "model_key": model_key(),
+    "model_label": Constants.model_label,
+    "embedding_backend": Constants.embedding_backend,
+    "dimension": dimension,
+    "chunks": count,
+    "documents": len(stats),
+    "chunk_size": Constants.chunk_size,
+    "overlap": Constants.overlap,
+    "chunk_unit": Constants.chunk_unit,
+    "created": time.time(),
+  }
+  (partial / "snapshot.json").write_text(json.dumps(description, indent=2))
+  shutil.rmtree(directory, ignore_errors=True)
+  os.replace(partial, directory)
+  return description
+
+
+def read_description(directory: Path) -> dict:
+  path = directory / "snapshot.json"
+  if not path.exists():
+    raise ValueError(f"Not a snapshot, {path} is missing")
+  description = json.loads(path.read_text())
+  if description.get("format") != snapshot_format:
+    raise ValueError(f"Unsupported snapshot format: {description.get('format')}, expected {snapshot_format}")
+  if description["model_key"] != model_key():
+    raise ValueError(
+      f"The snapshot was embedded with {description['model_key']}, the current model is {model_key()}, "
+      f"set model_label (and embedding_backend) to match it")
+  return description
+
+
+def _chunk_pages(directory: Path, page_size: int):
+  page = []
+  with open(directory / "chunks.jsonl", 'r') as f:
+    for line in f:
+      page.append(json.loads(line))
+      if len(page) >= page_size:
+        yield page
+        page = []
+  if page:
+    yield page
+
+
+def import_snapshot(directory: Path, replace: bool = False, page_size: int = Constants.write_batch_size) -> dict:
+  """
+  Bulk load a snapshot into the collection, the lexical index, the catalog and the text store.
+  Documents of the snapshot replace the loaded ones with the same path, others are kept unless `replace`.
+  """
+  import numpy as np
+
+  description = read_description(directory)
+  vectors = np.load(directory / "embeddings.npy", mmap_mode="r")
+  if vectors.shape != (description["chunks"], description["dimension"]):
+    raise ValueError(f"The embeddings of the snapshot have shape {vectors.shape}, expected "
+                     f"({description['chunks']}, {description['dimension']})")
+  with open(directory / "catalog.json", 'r') as f:
+    manifests = json.load(f)
+
+  if replace:
+    Resources.reset_collection()
+    lexical_index.clear()
+    text_store.clear()
+    catalog.clear()
+  else:
+    # chunks of the previous version of a document that the snapshot does not have
+    stale_ids = []
+    for path, manifest in manifests.items():
+      known = catalog.get(path)
+      if known is not None:
+        stale_ids.extend(set(known["ids"]).difference(manifest["ids"]))
+    if stale_ids:
+      Resources.collection().delete(ids=stale_ids)
+      lexical_index.remove(stale_ids)
+
+  docs_dir = text_store.directory
+  docs_dir.mkdir(parents=True, exist_ok=True)
+  for source in (directory / "documents").iterdir():
+    partial = docs_dir / (source.name + ".partial")
+    shutil.copyfile(source, partial)
+    os.replace(partial, docs_dir / source.name)
+
+  collection = Resources.collection()
+  position = 0
+  for page in _chunk_pages(directory, page_size):
+    embeddings = vectors[position:position + len(page)]
+    position += len(page)
+    stored = [i for i, row in enumerate(page) if "document" in row]
+    bare = [i for i, row in enumerate(page) if "document" not in row]
+    if bare:
+      collection.upsert(ids=[page[i]["id"] for i in bare], embeddings=embeddings[bare].tolist(),
+                        metadatas=[page[i]["metadata"] for i in bare])
+    if stored:
+      collection.upsert(ids=[page[i]["id"] for i in stored], embeddings=embeddings[stored].tolist(),
+                        metadatas=[page[i]["metadata"] for i in stored],
+                        documents=[page[i]["document"] for i in stored])
+    metadatas = [row["metadata"] for row in page]
+    lexical_index.add([row["id"] for row in page], text_store.fill([row.get("document") for row in page], metadatas))
+  if position != description["chunks"]:
+    raise ValueError(f"The snapshot has {position} chunks, expected {description['chunks']}")
+
+  catalog.put_many({path: {key: manifest[key] for key in ("ids", "file_hash", "size", "mtime")}
+                    for path, manifest in manifests.items()})
+  for path, manifest in manifests.items():
+    catalog.add_tags(path, manifest["tags"])
+    text_store.prune(path, keep=text_version(manifest["file_hash"]))
+  query_cache.bump_version()
+  return description
+
+
+def build_index_from_snapshot(directory: Path, kind: str, compression: str) -> int:
+  """Build the faiss index straight from the vectors of a snapshot, when they are all the collection holds."""
+  import numpy as np
+
+  ids, sources = [], []
+  for page in _chunk_pages(directory, 50000):
+    ids.extend(row["id"] for row in page)
+    sources.extend(row["metadata"].get("source", "") for row in page)
+  if Resources.collection().count() != len(ids):
+    return faiss_index.build(kind, compression)
+  return faiss_index.build_from(np.load(directory / "embeddings.npy", mmap_mode="r"), ids, sources, kind, compression)
+
+
+@click.command(name="export_index")
+@click.argument("directory", type=click.Path(file_okay=False))
+@timing_decorator
+def export_index(directory: str):
+  '''
+    Export the loaded documents as a snapshot directory: embeddings, chunk metadata, catalog and texts.
+    `import_index` loads it on another host without embedding anything again.
+  '''
+  try:
+    description = export_snapshot(Path(directory).absolute())
+  except ValueError as e:
+    click.secho(str(e), fg="red")
+    return
+  click.secho(
+    f"Exported {description['chunks']} chunks of {description['documents']} documents "
+    f"({description['model_key']}, dimension {description['dimension']}) to {directory}", fg="green")
+
+
+@click.command(name="import_index")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--replace", is_flag=True, help="Drop every loaded document before importing")
+@click.option("--build-index", "build", is_flag=True,
+              help="Also build the faiss index (retrieval_backend=faiss) from the imported vectors")
+@click.option("--kind", type=click.Choice(index_kinds), default=Constants.faiss_index_kind, show_default=True)
+@click.option("--compression", type=click.Choice(compressions), default=Constants.faiss_compression,
+              show_default=True)
+@timing_decorator
+def import_index(directory: str, replace: bool, build: bool, kind: str, compression: str):
+  '''
+    Import a snapshot written by `export_index`, without embedding anything.
+    The snapshot must have been embedded with the current model_label and embedding_backend.
+  '''
+  directory = Path(directory).absolute()
+  try:
+    description = import_snapshot(directory, replace=replace)
+  except ValueError as e:
+    raise click.ClickException(str(e))
+  click.secho(f"Imported {description['chunks']} chunks of {description['documents']} documents.", fg="green")
+  changed = [name for name in ("chunk_size", "overlap", "chunk_unit") if description[name] != getattr(Constants, name)]
+  if changed:
+    click.secho(f"The snapshot was chunked with other settings ({', '.join(changed)}), "
+                f"documents changed later are chunked with the current ones.", fg="yellow")
+  if build:
+    count = build_index_from_snapshot(directory, kind, compression)
+    click.secho(f"Built a {kind} ({compression}) index of {count} chunks at {faiss_index.index_file}", fg="green")
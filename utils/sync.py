@@ -0,0 +1,109 @@
+import click
+import os
+from pathlib import Path
+from .constants import Constants
+from .index import timing_decorator
+from .crud_files import documentStore, ingest_files, acceptable_file_types
+from .catalog import catalog
+from .watch import directory_watcher, ChangeSet
+
+
+def scan_directory(root: Path) -> dict[str, os.stat_result]:
+  """Stat every supported document below `root`."""
+  files = {}
+  for current, _, filenames in os.walk(root):
+    for name in filenames:
+      path = Path(current) / name
+      if path.suffix.lower() not in acceptable_file_types:
+        continue
+      try:
+        files[str(path)] = path.stat()
+      except FileNotFoundError:
+        continue
+  return files
+
+
+def is_below(path: str, root: Path) -> bool:
+  return path == str(root) or path.startswith(str(root) + os.sep)
+
+
+def plan_full_sync(root: Path) -> tuple[list[Path], list[Path]]:
+  """
+  Compare the directory against the catalog.
+  Files whose size and mtime match their manifest are not even hashed.
+  """
+  files = scan_directory(root)
+  manifests = catalog.stats()
+  to_ingest = []
+  for path, stat in files.items():
+    manifest = manifests.get(path)
+    if manifest is None or (manifest.get("size"), manifest.get("mtime")) != (stat.st_size, stat.st_mtime):
+      to_ingest.append(Path(path))
+  to_remove = [Path(path) for path in manifests if is_below(path, root) and path not in files]
+  return to_ingest, to_remove
+
+
+def plan_changes(changes: ChangeSet) -> tuple[list[Path], list[Path]]:
+  """Turn the paths reported by the watcher into documents to ingest and to remove."""
+  manifests = catalog.stats()
+  to_ingest = [path for path in changes.changed
+               if path.suffix.lower() in acceptable_file_types and path.is_file()]
+  to_remove = set()
+  for removed in changes.removed:
+    if str(removed) in manifests:
+      to_remove.add(str(removed))
+    else:
+      # a whole directory went away
+      to_remove.update(path for path in manifests if is_below(path, removed))
+  return to_ingest, [Path(path) for path in to_remove if not Path(path).exists()]
+
+
+def apply_sync(to_ingest: list[Path], to_remove: list[Path], workers: int):
+  if not to_ingest and not to_remove:
+    click.secho("Everything is up to date.", fg="green")
+    return
+  click.secho(f"{len(to_ingest)} files to ingest, {len(to_remove)} to remove.", fg="yellow")
+  if to_ingest:
+    ingest_files(to_ingest, workers=workers)
+  for path in to_remove:
+    try:
+      documentStore.delete_document(path)
+    except FileNotFoundError as e:
+      click.secho(e, fg="red")
+
+
+@click.command(name="sync")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--watch", is_flag=True, help="Keep running and sync changes as they happen")
+@click.option("--workers", "-w", type=int, default=Constants.ingest_workers, show_default=True,
+              help="Parallel parsing processes")
+@click.option("--debounce", type=float, default=1.0, show_default=True,
+              help="Seconds without file events before a batch of changes is synced")
+@timing_decorator
+def sync(directory: str, watch: bool, workers: int, debounce: float) -> None:
+  """
+  Keep the context in sync with a directory. \n
+  New files are loaded, modified ones re-loaded and deleted ones removed.
+  With --watch, changes are picked up from file system notifications instead of rescanning.
+  """
+  root = Path.absolute(Path(directory))
+  click.secho(f"Syncing {root} ...", fg="yellow")
+
+  # watch before the initial scan, so that nothing changing during the scan is missed
+  watcher = directory_watcher(root) if watch else None
+  apply_sync(*plan_full_sync(root), workers)
+  if watcher is None:
+    return None
+
+  click.secho(f"Watching {root} for changes, press Ctrl+C to stop.", fg="green")
+  try:
+    for changes in watcher.batches(debounce):
+      if changes.rescan:
+        click.secho("Change notifications were lost, rescanning...", fg="yellow")
+        apply_sync(*plan_full_sync(root), workers)
+      else:
+        apply_sync(*plan_changes(changes), workers)
+  except KeyboardInterrupt:
+    click.secho("\nStopped watching.", fg="yellow")
+  finally:
+    watcher.close()
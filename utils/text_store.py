@@ -0,0 +1,189 @@
+import glob
+import hashlib
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from .workspace import PerWorkspace, Workspace
+
+
+# The text of every loaded document is written once under `docs_dir`, as utf-8 with universal
+# newlines (the text chunk offsets point into), instead of being copied into every chunk of the
+# collection. A chunk keeps its source, its (start, end) character offsets and the version of the
+# text (`text` metadata, from the file hash), and its text is sliced out of the memory-mapped file
+# when it is retrieved. Ascii text is sliced by offset directly, other text goes through a sparse
+# index of the byte offset of every `index_stride`-th character, in a `.idx` file next to it.
+
+index_stride = 256
+text_suffix = ".txt"
+index_suffix = ".idx"
+
+
+def source_key(source: str) -> str:
+  return hashlib.sha256(source.encode()).hexdigest()[:24]
+
+
+def text_version(file_hash: str) -> str:
+  return file_hash[:16]
+
+
+class MappedText:
+  """A memory-mapped document text and its byte index, `index` is None for ascii text."""
+
+  def __init__(self, path: Path):
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+    self.size = size
+    self.index = None
+    index_path = path.with_suffix(index_suffix)
+    if index_path.exists():
+      index = array("Q")
+      index.frombytes(index_path.read_bytes())
+      self.index = index
+
+  def slice(self, start: int, end: int) -> str:
+    if self.index is None:
+      return str(memoryview(self.data)[start:end], "utf-8")
+    first, last = start // index_stride, -(-end // index_stride)
+    low = self.index[first]
+    high = self.index[last] if last < len(self.index) else self.size
+    base = first * index_stride
+    return str(memoryview(self.data)[low:high], "utf-8")[start - base:end - base]
+
+
+class TextWriter:
+  """Writes the text of a document block by block, it becomes visible on `commit`."""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.partial = path.with_name(path.name + ".partial")
+    self.file = open(self.partial, 'wb')
+    self.index = array("Q")
+    self.length = 0
+    self.bytes = 0
+    self.ascii = True
+
+  def write(self, block: str):
+    position = 0
+    while position < len(block):
+      # cut the block at the characters of the index, and record their byte offsets
+      if self.length % index_stride == 0:
+        self.index.append(self.bytes)
+      piece = block[position:position + index_stride - self.length % index_stride]
+      data = piece.encode()
+      self.ascii = self.ascii and len(data) == len(piece)
+      self.file.write(data)
+      self.length += len(piece)
+      self.bytes += len(data)
+      position += len(piece)
+
+  def commit(self):
+    self.file.close()
+    index_path = self.path.with_suffix(index_suffix)
+    if not self.ascii:
+      partial_index = index_path.with_name(index_path.name + ".partial")
+      partial_index.write_bytes(self.index.tobytes())
+      os.replace(partial_index, index_path)
+    os.replace(self.partial, self.path)
+
+  def abort(self):
+    self.file.close()
+    self.partial.unlink(missing_ok=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    if kind is None:
+      self.commit()
+    else:
+      self.abort()
+
+
+class TextStore:
+  """The texts of the documents of a workspace, in its `docs_dir`."""
+
+  def __init__(self, workspace: Workspace, max_open: int = 64):
+    self.directory = workspace.docs_dir
+    self.max_open = max_open
+    self._open: OrderedDict[str, MappedText] = OrderedDict()
+    self._lock = threading.Lock()
+
+  def path(self, source: str, version: str) -> Path:
+    return self.directory / f"{source_key(source)}-{version}{text_suffix}"
+
+  def writer(self, source: str, version: str) -> TextWriter:
+    self.directory.mkdir(parents=True, exist_ok=True)
+    return TextWriter(self.path(source, version))
+
+  def write(self, source: str, version: str, text: str):
+    with self.writer(source, version) as writer:
+      writer.write(text)
+
+  def _mapped(self, source: str, version: str) -> MappedText:
+    name = f"{source_key(source)}-{version}"
+    with self._lock:
+      mapped = self._open.get(name)
+      if mapped is not None:
+        self._open.move_to_end(name)
+        return mapped
+    mapped = MappedText(self.path(source, version))
+    with self._lock:
+      self._open[name] = mapped
+      while len(self._open) > self.max_open:
+        self._open.popitem(last=False)
+    return mapped
+
+  def slice(self, source: str, version: str, start: int, end: int) -> str:
+    return self._mapped(source, version).slice(start, end)
+
+  def fill(self, documents: list[str | None], metadatas: list[dict]) -> list[str]:
+    """
+    Texts of chunks returned by the collection, sliced from the store for the chunks stored without one.
+    A chunk whose text is not committed yet (a document still being streamed in) reads as empty.
+    """
+    texts = []
+    for document, metadata in zip(documents, metadatas):
+      if document is None and metadata and "text" in metadata:
+        try:
+          document = self.slice(metadata["source"], metadata["text"], metadata["start"], metadata["end"])
+        except FileNotFoundError:
+          document = ""
+      texts.append(document if document is not None else "")
+    return texts
+
+  def fill_results(self, results: dict) -> dict:
+    """Fill the documents of chroma query results (one list per query) in place."""
+    results["documents"] = [self.fill(documents, metadatas)
+                            for documents, metadatas in zip(results["documents"], results["metadatas"])]
+    return results
+
+  def _forget(self, prefix: str):
+    with self._lock:
+      for name in [name for name in self._open if name.startswith(prefix)]:
+        del self._open[name]
+
+  def prune(self, source: str, keep: str = None):
+    """Delete the texts of a document, all but the `keep` version."""
+    key = source_key(source)
+    kept = f"{key}-{keep}" if keep else None
+    self._forget(key if kept is None else f"{key}-")
+    for name in glob.glob(str(self.directory / f"{key}-*")):
+      if kept is None or not Path(name).name.startswith(kept + "."):
+        Path(name).unlink(missing_ok=True)
+
+  def delete(self, source: str):
+    self.prune(source)
+
+  def clear(self):
+    with self._lock:
+      self._open.clear()
+    for path in self.directory.glob("*"):
+      if path.is_file():
+        path.unlink(missing_ok=True)
+
+
+text_store = PerWorkspace(TextStore)
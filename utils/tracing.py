@@ -0,0 +1,200 @@
+import click
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Spans of the stages of a command (parse, split, embed, upsert, retrieve, prompt, llm ...),
+# recorded only while profiling (`aikame --profile ...`). A span knows its parent, thread and
+# process and carries counters (chunks, tokens, bytes). They are summarized at the end of the
+# command and exported as jsonl (one span per line) or as chrome trace events, which
+# chrome://tracing and https://ui.perfetto.dev open as a timeline.
+
+_current = contextvars.ContextVar("aikame_span", default=None)
+
+
+class Span:
+
+  __slots__ = ("name", "id", "parent", "start", "end", "thread", "process", "attributes", "counters")
+
+  def __init__(self, name: str, id: int, parent: int | None, start: float, attributes: dict,
+               thread: str = None, process: int = None):
+    self.name = name
+    self.id = id
+    self.parent = parent
+    self.start = start
+    self.end = None
+    self.thread = thread or threading.current_thread().name
+    self.process = process or os.getpid()
+    self.attributes = attributes
+    self.counters = {}
+
+  @property
+  def seconds(self) -> float:
+    return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+  def set(self, **attributes):
+    self.attributes.update(attributes)
+
+  def count(self, **counters):
+    for name, value in counters.items():
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def to_dict(self, origin: float) -> dict:
+    return {
+      "name": self.name,
+      "id": self.id,
+      "parent": self.parent,
+      "start": round(self.start - origin, 6),
+      "seconds": round(self.seconds, 6),
+      "thread": self.thread,
+      "process": self.process,
+      "attributes": self.attributes,
+      "counters": self.counters,
+    }
+
+
+class NullSpan:
+  """What `span` yields when not profiling, so that call sites never branch."""
+
+  def set(self, **attributes):
+    pass
+
+  def count(self, **counters):
+    pass
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+
+  def __init__(self):
+    self.enabled = False
+    self.spans: list[Span] = []
+    self.origin = time.perf_counter()
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._root = None
+    self._root_token = None
+
+  def start(self, name: str, **attributes):
+    """Start recording, under a root span covering the whole command."""
+    with self._lock:
+      self.spans = []
+      self.origin = time.perf_counter()
+      self._ids = itertools.count(1)
+      self.enabled = True
+    self._root = self._open(name, attributes)
+    self._root_token = _current.set(self._root)
+
+  def stop(self) -> list[Span]:
+    if self._root is not None:
+      self._root.end = time.perf_counter()
+      _current.reset(self._root_token)
+      self._root = self._root_token = None
+    self.enabled = False
+    return self.spans
+
+  def _open(self, name: str, attributes: dict, start: float = None, parent: Span = None, **where) -> Span:
+    parent = parent or _current.get()
+    span = Span(name, next(self._ids), parent.id if parent else None,
+                start if start is not None else time.perf_counter(), attributes, **where)
+    with self._lock:
+      self.spans.append(span)
+    return span
+
+  @contextmanager
+  def span(self, name: str, **attributes):
+    """Time the enclosed block as a child of the current span."""
+    if not self.enabled:
+      yield null_span
+      return
+    span = self._open(name, attributes)
+    token = _current.set(span)
+    try:
+      yield span
+    finally:
+      span.end = time.perf_counter()
+      _current.reset(token)
+
+  def record(self, name: str, start: float, seconds: float, thread: str = None, process: int = None,
+             counters: dict = None, **attributes) -> Span:
+    """Add a span timed elsewhere, e.g. in a worker process (`perf_counter` is system wide)."""
+    if not self.enabled:
+      return null_span
+    span = self._open(name, attributes, start=start, thread=thread, process=process)
+    span.end = start + seconds
+    span.count(**(counters or {}))
+    return span
+
+  def current(self) -> Span | NullSpan:
+    return (_current.get() or null_span) if self.enabled else null_span
+
+  def summary(self) -> list[dict]:
+    """Calls, total and max seconds and counter totals of every span name, slowest first."""
+    rows = {}
+    for span in self.spans:
+      row = rows.setdefault(span.name, {"name": span.name, "calls": 0, "seconds": 0.0, "max": 0.0, "counters": {}})
+      row["calls"] += 1
+      row["seconds"] += span.seconds
+      row["max"] = max(row["max"], span.seconds)
+      for counter, value in span.counters.items():
+        row["counters"][counter] = row["counters"].get(counter, 0) + value
+    return sorted(rows.values(), key=lambda row: row["seconds"], reverse=True)
+
+  def export_jsonl(self, path: Path):
+    with open(path, 'w') as f:
+      for span in self.spans:
+        f.write(json.dumps(span.to_dict(self.origin)) + "\n")
+
+  def export_chrome(self, path: Path):
+    """Complete ("X") trace events, in microseconds, plus the names of the threads."""
+    threads = {}
+    events = []
+    for span in self.spans:
+      tid = threads.setdefault((span.process, span.thread), len(threads) + 1)
+      events.append({
+        "name": span.name,
+        "cat": span.name.split(".")[0],
+        "ph": "X",
+        "ts": round((span.start - self.origin) * 1e6, 3),
+        "dur": round(span.seconds * 1e6, 3),
+        "pid": span.process,
+        "tid": tid,
+        "args": {**span.attributes, **span.counters},
+      })
+    for (process, thread), tid in threads.items():
+      events.append({"name": "thread_name", "ph": "M", "pid": process, "tid": tid, "args": {"name": thread}})
+    with open(path, 'w') as f:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+  def export(self, path: str | Path):
+    """Spans as jsonl when the file ends with `.jsonl`, as a chrome trace otherwise."""
+    path = Path(path)
+    if path.suffix == ".jsonl":
+      self.export_jsonl(path)
+    else:
+      self.export_chrome(path)
+
+
+tracer = Tracer()
+
+
+def finish_profile(trace_file: str = None):
+  """Stop profiling, print the summary of the spans and write them to `trace_file`."""
+  spans = tracer.stop()
+  click.secho(f"Profile of {len(spans)} spans:", fg="yellow")
+  for row in tracer.summary():
+    counters = ", ".join(f"{name} {value}" for name, value in row["counters"].items())
+    click.secho(
+      f"{row['name']:>18}: {row['calls']:>5} calls, {row['seconds'] * 1000:>10.1f} ms total, "
+      f"{row['max'] * 1000:>9.1f} ms max" + (f", {counters}" if counters else ""), fg="yellow")
+  if trace_file:
+    tracer.export(trace_file)
+    click.secho(f"Spans written to {trace_file}", fg="green")
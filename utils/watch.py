@@ -0,0 +1,173 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Iterator
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+event_header = struct.Struct("iIII")
+
+
+class ChangeSet:
+  """Paths touched since the last batch. `rescan` is set when events were lost."""
+
+  def __init__(self):
+    self.changed: set[Path] = set()
+    self.removed: set[Path] = set()
+    self.rescan = False
+
+  def __bool__(self):
+    return bool(self.changed or self.removed or self.rescan)
+
+
+class InotifyWatcher:
+  """
+  Recursive directory watcher on top of linux inotify.
+  One watch per directory, so the cost is proportional to the changes, not to the number of files.
+  """
+
+  def __init__(self, root: Path):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self._rm_watch = libc.inotify_rm_watch
+    self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.root = root
+    self.directories: dict[int, Path] = {}
+    self.watch_tree(root)
+
+  def watch_tree(self, directory: Path) -> list[Path]:
+    """Watch a directory and all its subdirectories, returns the files found below it."""
+    files = []
+    for current, dirnames, filenames in os.walk(directory):
+      wd = self._add_watch(self.fd, os.fsencode(current), watch_mask)
+      if wd < 0:
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+          raise OSError(error, "inotify watch limit reached, raise fs.inotify.max_user_watches")
+        # the directory vanished in the meantime
+        continue
+      self.directories[wd] = Path(current)
+      files.extend(Path(current) / name for name in filenames)
+    return files
+
+  def unwatch_tree(self, directory: Path):
+    """Stop watching a directory that was moved away or deleted, along with its subdirectories."""
+    for wd, path in list(self.directories.items()):
+      if path == directory or path.is_relative_to(directory):
+        self._rm_watch(self.fd, wd)
+        del self.directories[wd]
+
+  def close(self):
+    os.close(self.fd)
+
+  def _read(self, timeout: float | None) -> list[tuple[int, int, str]]:
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return []
+    try:
+      data = os.read(self.fd, 1 << 16)
+    except BlockingIOError:
+      return []
+    events, offset = [], 0
+    while offset < len(data):
+      wd, mask, _, length = event_header.unpack_from(data, offset)
+      offset += event_header.size
+      name = data[offset:offset + length].rstrip(b"\0")
+      offset += length
+      events.append((wd, mask, os.fsdecode(name)))
+    return events
+
+  def _apply(self, events: list[tuple[int, int, str]], changes: ChangeSet):
+    for wd, mask, name in events:
+      if mask & IN_Q_OVERFLOW:
+        changes.rescan = True
+        continue
+      if mask & IN_IGNORED:
+        self.directories.pop(wd, None)
+        continue
+      directory = self.directories.get(wd)
+      if directory is None:
+        continue
+      if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        changes.removed.add(directory)
+        self.unwatch_tree(directory)
+        continue
+      path = directory / name
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          # files may have landed in the new directory before its watch was added
+          changes.changed.update(self.watch_tree(path))
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          changes.removed.add(path)
+          self.unwatch_tree(path)
+      elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        changes.removed.discard(path)
+        changes.changed.add(path)
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        changes.changed.discard(path)
+        changes.removed.add(path)
+
+  def batches(self, debounce: float) -> Iterator[ChangeSet]:
+    """Yield the accumulated changes once no event arrived for `debounce` seconds."""
+    while True:
+      changes = ChangeSet()
+      self._apply(self._read(None), changes)
+      while True:
+        events = self._read(debounce)
+        if not events:
+          break
+        self._apply(events, changes)
+      if changes:
+        yield changes
+
+
+class PollingWatcher:
+  """Fallback for platforms without inotify, reports a rescan at a fixed interval."""
+
+  def __init__(self, root: Path, interval: float = 5.0):
+    self.root = root
+    self.interval = interval
+
+  def close(self):
+    pass
+
+  def batches(self, debounce: float) -> Iterator[ChangeSet]:
+    while True:
+      time.sleep(max(self.interval, debounce))
+      changes = ChangeSet()
+      changes.rescan = True
+      yield changes
+
+
+def directory_watcher(root: Path):
+  """Best watcher available on this platform."""
+  if sys.platform.startswith("linux"):
+    return InotifyWatcher(root)
+  return PollingWatcher(root)
@@ -0,0 +1,175 @@
+import click
+import contextvars
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+from .constants import Constants
+
+
+# A workspace is a separate set of documents: its own chroma collection, catalog, text store,
+# lexical index, caches, faiss index and chat sessions. The default workspace keeps the layout of
+# `parent_path`, the others live in `workspaces_dir/<name>` with the same file names.
+# The chroma client (and the embedding model) are shared, every workspace has its own collection in it.
+# The workspace of a command (`aikame --workspace <name> ...`) is held in a context variable, so
+# threads started with a copy of the context (pipeline stages, fan-out searches) stay in it.
+
+default_workspace = "default"
+# the name ends up in the chroma collection name, which only allows these
+workspace_name_pattern = re.compile(r"^[a-zA-Z0-9](?:[\w-]{0,38}[a-zA-Z0-9])?$")
+
+_current = contextvars.ContextVar("aikame_workspace", default=None)
+
+
+def validate_workspace(name: str) -> str:
+  if not workspace_name_pattern.match(name):
+    raise ValueError(
+      f"Invalid workspace name: {name!r}, use at most 40 letters, digits, '_' and '-', starting and ending "
+      f"with a letter or a digit")
+  return name
+
+
+class Workspace:
+
+  def __init__(self, name: str):
+    self.name = validate_workspace(name)
+    self.is_default = name == default_workspace
+    self.path = Constants.parent_path if self.is_default else Constants.workspaces_dir / name
+    self.collection_name = Constants.collection_name if self.is_default else f"{Constants.collection_name}-{name}"
+
+  def _file(self, default: Path) -> Path:
+    """A file of `parent_path`, at the same place in the directory of the workspace."""
+    return default if self.is_default else self.path / default.relative_to(Constants.parent_path)
+
+  @property
+  def docs_dir(self) -> Path:
+    return self._file(Constants.docs_dir)
+
+  @property
+  def metadata_file(self) -> Path:
+    return self._file(Constants.metadata_file)
+
+  @property
+  def catalog_file(self) -> Path:
+    return self._file(Constants.catalog_file)
+
+  @property
+  def collection_generation_file(self) -> Path:
+    return self._file(Constants.collection_generation_file)
+
+  @property
+  def chat_history_file(self) -> Path:
+    return self._file(Constants.chat_history_file)
+
+  @property
+  def chats_dir(self) -> Path:
+    return self._file(Constants.chats_dir)
+
+  @property
+  def cache_file(self) -> Path:
+    return self._file(Constants.cache_file)
+
+  @property
+  def lexical_file(self) -> Path:
+    return self._file(Constants.lexical_file)
+
+  @property
+  def faiss_dir(self) -> Path:
+    return self._file(Constants.faiss_dir)
+
+  @property
+  def partitions_dir(self) -> Path:
+    return self._file(Constants.partitions_dir)
+
+  def exists(self) -> bool:
+    return self.is_default or self.path.is_dir()
+
+
+_workspaces: dict[str, Workspace] = {}
+
+
+def workspace(name: str = None) -> Workspace:
+  """The workspace of a name, defaults to the current one."""
+  name = name or _current.get() or Constants.workspace
+  if name not in _workspaces:
+    _workspaces[name] = Workspace(name)
+  return _workspaces[name]
+
+
+def use_workspace(name: str):
+  """Make a workspace the current one, for the rest of the current context."""
+  _current.set(workspace(name).name)
+
+
+@contextmanager
+def in_workspace(name: str):
+  token = _current.set(workspace(name).name)
+  try:
+    yield workspace(name)
+  finally:
+    _current.reset(token)
+
+
+def list_workspaces() -> list[str]:
+  names = [path.name for path in Constants.workspaces_dir.iterdir()
+           if path.is_dir() and workspace_name_pattern.match(path.name)] if Constants.workspaces_dir.exists() else []
+  return [default_workspace] + sorted(name for name in names if name != default_workspace)
+
+
+class PerWorkspace:
+  """
+  One instance of a class per workspace, built on first use by `factory`.
+  Attributes are looked up on the instance of the current workspace, so a module level
+  `catalog = PerWorkspace(Catalog)` is used exactly like a single instance.
+  """
+
+  def __init__(self, factory: Callable[[Workspace], object]):
+    self._factory = factory
+    self._instances = {}
+    self._lock = threading.Lock()
+
+  def instance(self, name: str = None):
+    current = workspace(name)
+    instance = self._instances.get(current.name)
+    if instance is None:
+      with self._lock:
+        instance = self._instances.get(current.name)
+        if instance is None:
+          instance = self._instances[current.name] = self._factory(current)
+    return instance
+
+  def __getattr__(self, name: str):
+    return getattr(self.instance(), name)
+
+
+@click.command(name="workspaces")
+@click.option("--delete", "to_delete", help="Delete a workspace: its collection, catalog, texts, caches and chats")
+def workspaces(to_delete: str):
+  '''
+    List the workspaces, with the number of documents and chunks of each.
+    `aikame --workspace <name> ...` runs a command in a workspace, created on first use.
+  '''
+  from .catalog import catalog
+  from .resources import Resources
+
+  if to_delete:
+    try:
+      target = workspace(validate_workspace(to_delete))
+    except ValueError as e:
+      raise click.BadParameter(str(e))
+    if target.is_default:
+      raise click.BadParameter("The default workspace cannot be deleted, use `clear_context` to empty it")
+    if not target.exists():
+      raise click.BadParameter(f"No workspace named {to_delete}")
+    Resources.drop_collection(target.name)
+    shutil.rmtree(target.path)
+    click.secho(f"Workspace {to_delete} deleted.", fg="green")
+    return
+  current = workspace().name
+  for name in list_workspaces():
+    stats = catalog.instance(name).stats()
+    click.secho(
+      f"{'*' if name == current else ' '} {name}: {len(stats)} documents, "
+      f"{sum(row['chunks'] for row in stats.values())} chunks", fg="green" if name == current else None)